@@ -3,7 +3,7 @@ from django.contrib import admin
 from kukan.models import TestSource
 from .models import Kanji, KanjiDetails, Reading, Bushu, Classification, YomiType, YomiJoyo, Example, Kanken
 from .models import Kotowaza, KoukiBushu, TestResult
-from .models import Bunrui, Yoji
+from .models import Bunrui, Yoji, AnkiSyncMark
 
 
 class KanjiInline(admin.TabularInline):
@@ -43,4 +43,5 @@ admin.site.register(Kotowaza)
 admin.site.register(Bunrui)
 admin.site.register(Yoji)
 admin.site.register(TestResult, TestResultAdmin)
-admin.site.register(TestSource)
\ No newline at end of file
+admin.site.register(TestSource)
+admin.site.register(AnkiSyncMark)
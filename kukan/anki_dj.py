@@ -7,14 +7,24 @@ import pandas as pd
 from anki.collection import Collection
 from anki.collection import ImportCsvRequest
 from anki.sync_pb2 import SyncStatusResponse
+from anki.utils import ids2str
 from django.conf import settings
 
 Deck = namedtuple('Deck', ['name', 'model', 'file_name'])
 logger = logging.getLogger(__name__)
 
 
+def get_deleted_file_name(file_name):
+    """File of the keys of the notes to delete, next to the import file of a deck exported in delta mode"""
+    return os.path.splitext(file_name)[0] + '_deleted.csv'
+
+
 class AnkiProfile:
-    def __init__(self, profile, max_delete_count=0):
+    def __init__(self, profile, max_delete_count=0, import_dir=settings.ANKI_IMPORT_DIR):
+        """
+        :param import_dir: directory of the files exported by Exporter (one directory per profile when the
+                           profiles are synchronized in parallel)
+        """
         self.name = profile
         self.profile = settings.ANKI_ACCOUNTS[profile]
         self.profile['decks'] = [
@@ -26,6 +36,7 @@ class AnkiProfile:
                 ('諺', 'Kotowaza', 'dj_anki_kotowaza'),
             ]]
         self.max_delete_count = max_delete_count
+        self.import_dir = import_dir
         self.col = None
         self._finalizer = weakref.finalize(self, self.close_collection)
 
@@ -46,9 +57,8 @@ class AnkiProfile:
     def kind_list(self):
         return [d.file_name[3:-4] for d in self.profile['decks']]
 
-    @staticmethod
-    def get_deck_import_file(deck):
-        file_name = os.path.join(settings.ANKI_IMPORT_DIR, deck.file_name)
+    def get_deck_import_file(self, deck):
+        file_name = os.path.join(self.import_dir, deck.file_name)
         assert os.path.exists(file_name)
         return file_name
 
@@ -62,32 +72,33 @@ class AnkiProfile:
                 len(response.log.first_field_match),
                 len(response.log.duplicate))
 
-    def delete_missing_notes(self, deck, df_anki_export_all):
-        file_name = self.get_deck_import_file(deck)
-        df_anki_export = df_anki_export_all[
-            df_anki_export_all.iloc[:, 2] == deck.name]
-
-        df_web_side = self.read_anki_csv(file_name)
+    def delete_missing_notes(self, df_anki_export_all):
+        """
+        Delete the notes of the decks missing from their import file, for all the decks in one pass: the
+        (notetype, deck, key) triples of the Anki export are looked up in the hash index of the triples of all the
+        import files, and the GUIDs of the missing ones are mapped to note ids with a single query
+        :return: deck name -> number of deleted notes
+        """
+        df_web_side = pd.concat([self.read_anki_csv(self.get_deck_import_file(deck))
+                                 for deck in self.profile['decks']], ignore_index=True)
         df_web_side[2] = df_web_side[2].astype(str)
-        df_web_side.columns = [1, 2, 3]
-        assert not df_web_side.duplicated().any()
+        web_index = pd.MultiIndex.from_frame(df_web_side)
+        assert not web_index.duplicated().any()
 
-        df_merge = pd.merge(df_anki_export.set_index([1, 2, 3]),
-                            df_web_side.set_index([1, 2, 3]),
-                            left_index=True, right_index=True, how='outer',
-                            indicator=True)
-        df_merge.columns = ['GUID', '_merge']
-        assert df_merge[df_merge['_merge'] == 'right_only'].empty
+        decks = [deck.name for deck in self.profile['decks']]
+        df_anki_export = df_anki_export_all[df_anki_export_all.iloc[:, 2].isin(decks)]
+        anki_index = pd.MultiIndex.from_frame(df_anki_export.iloc[:, 1:4].astype({3: str}))
+        assert web_index.isin(anki_index).all()
 
-        # DF of GUID, ID
+        df_missing = df_anki_export[~anki_index.isin(web_index)]
         df_ids = pd.DataFrame(self.col.db.all("select guid, id from notes"),
-                              columns=['GUID', 'ID'])
+                              columns=[df_anki_export.columns[0], 'ID'])
+        df_missing = df_missing.merge(df_ids)
 
-        list_to_delete = pd.merge(
-            df_ids,
-            df_merge[df_merge['_merge'] == 'left_only']
-        )['ID'].to_list()
+        return {deck: self.remove_notes(df_missing.loc[df_missing.iloc[:, 2] == deck, 'ID'].to_list())
+                for deck in decks}
 
+    def remove_notes(self, list_to_delete):
         if (len_del := len(list_to_delete)) == 0:
             pass
         if len_del > self.max_delete_count:
@@ -101,6 +112,19 @@ class AnkiProfile:
 
         return len_del
 
+    def delete_listed_notes(self, deck):
+        """Delta export: delete the notes of the deck listed in the deleted file (first field of the notes)"""
+        with open(get_deleted_file_name(self.get_deck_import_file(deck)), encoding='utf-8') as input_file:
+            keys = {line.strip() for line in input_file if line.strip()}
+        if not keys:
+            return 0
+
+        note_ids = self.col.find_notes(f'"deck:{deck.name}" "note:{deck.model}"')
+        list_to_delete = [note_id for note_id, fields
+                          in self.col.db.all(f'select id, flds from notes where id in {ids2str(note_ids)}')
+                          if fields.split('\x1f')[0] in keys]
+        return self.remove_notes(list_to_delete)
+
     @staticmethod
     def read_anki_csv(file_name, with_guid=False):
         comments = [
@@ -117,7 +141,11 @@ class AnkiProfile:
                            skiprows=len(comments), header=None,
                            delimiter='\t')
 
-    def apply_to_anki(self):
+    def apply_to_anki(self, delta=False):
+        """
+        :param delta: the import files only contain the changed notes (Exporter in delta mode): the notes to delete
+                      are listed in the deleted files, instead of being all the notes missing from the import files
+        """
         decks = [d.name for d in self.profile['decks']]
         assert not len(set(decks) -
                        set(e.name for e in self.col.decks.all_names_and_ids()))
@@ -126,17 +154,20 @@ class AnkiProfile:
                               ['added', 'updated', 'deleted', 'unchanged'])
 
         for deck in self.profile['decks']:
-            file_name = os.path.join(settings.ANKI_IMPORT_DIR, deck.file_name)
-            assert os.path.exists(file_name)
+            self.get_deck_import_file(deck)
 
             # Import the additions/changes
             res_df.loc[deck.name, ['added', 'updated', 'unchanged']] = \
                 self.import_file(deck)
 
+        if delta:
+            for deck in self.profile['decks']:
+                res_df.loc[deck.name, 'deleted'] = self.delete_listed_notes(deck)
+            return res_df
+
         # Export the current Anki note in file with below format
         # CC[7j9a$Y`<tab>Japanese Kanji<tab>漢字<tab>一<tab>one...
-        anki_export_file = os.path.join(settings.ANKI_IMPORT_DIR,
-                                        'anki_export.csv')
+        anki_export_file = os.path.join(self.import_dir, 'anki_export.csv')
         self.col.export_note_csv(
             out_path=anki_export_file, limit=100000,
             with_html=True, with_notetype=True, with_deck=True,
@@ -144,10 +175,9 @@ class AnkiProfile:
         df_anki_export_all = self.read_anki_csv(anki_export_file, True)
         assert not df_anki_export_all.duplicated().any()
 
-        for deck in self.profile['decks']:
-            # Remove notes deleted from the web
-            res_df.loc[deck.name, 'deleted'] = self.delete_missing_notes(
-                deck, df_anki_export_all)
+        # Remove notes deleted from the web
+        for deck, deleted in self.delete_missing_notes(df_anki_export_all).items():
+            res_df.loc[deck, 'deleted'] = deleted
 
         return res_df
 
@@ -179,10 +209,10 @@ class AnkiProfile:
             else:
                 raise Exception('Full sync not allowed on final sync')
 
-    def sync(self):
+    def sync(self, delta=False):
         self.open_collection()
         self.sync_server(initial_sync=True)
-        res_df = self.apply_to_anki()
+        res_df = self.apply_to_anki(delta)
         self.sync_server(initial_sync=False)
         logger.info(res_df.to_string())
 
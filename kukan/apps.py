@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class kukanConfig(AppConfig):
     name = 'kukan'
+
+    def ready(self):
+        from kukan.search import repair_search_indexes
+        post_migrate.connect(repair_search_indexes, sender=self, dispatch_uid='repair_search_indexes')
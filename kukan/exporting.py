@@ -1,17 +1,19 @@
 import csv
+import hashlib
 import os
 from collections import defaultdict
-from functools import reduce
+from functools import partialmethod, reduce
 
 from django.conf import settings
-from django.db.models import Q
-from django.http import HttpResponse
+from django.db.models import Count, Max, Prefetch, Q
+from django.db.models.functions import Substr
+from django.http import HttpResponse, StreamingHttpResponse
 from django.template.loader import render_to_string
 
-from kukan.anki_dj import AnkiProfile
+from kukan.anki_dj import AnkiProfile, get_deleted_file_name
 from kukan.jautils import JpnText
 from kukan.templatetags.ja_tags import furigana_ruby
-from .models import Kanji, Example, Yoji
+from .models import AnkiDeletedNote, Kanji, Example, Kotowaza, Reading, Yoji
 
 
 class Exporter:
@@ -22,10 +24,33 @@ class Exporter:
                               [Q(definition__contains=x) for x
                                in ['kaki', 'yomi', 'hyogai', 'kotowaza']])
 
-    def __init__(self, kind, profile_name, out_dir=settings.ANKI_IMPORT_DIR):
+    header_rows = [['#separator:tab'], ['#html:true'], ['#notetype column:1'], ['#deck column:2']]
+
+    # Decks depending on the profile: kind -> {profile name: filter of the exported objects}
+    profile_filters = {
+        'anki_kaki': {'Ayumi': Q(kanken__difficulty__gte=8) | Q(ex_kind__in=[Example.TAIGI, Example.RUIGI])},
+    }
+
+    # Rows fetched per query: the rows are generated one by one (rows_<kind>), without loading the whole table.
+    # The prefetch queries run again for each chunk (anki_kanji: 1 query + 3 per chunk)
+    chunk_size = 500
+
+    # Beyond that number of changed yoji, the delta export exports all the yoji (bounded IN lists of yoji halves)
+    max_changed_yoji = 400
+
+    def __init__(self, kind, profile_name, out_dir=settings.ANKI_IMPORT_DIR, since=None, cache=None):
+        """
+        :param profile_name: None for the rows of all the profiles (profile_filters not applied)
+        :param since: delta export: only the notes changed after this time are exported, and the keys of the notes
+                      to delete (deleted or not exported anymore) are written in a separate file for each deck
+                      (anki_kanji is always fully exported)
+        :param cache: ExportCache: the decks are derived from the rows shared by the profiles
+        """
         self.kind = kind
-        self.profile = AnkiProfile(profile_name)
+        self.profile = AnkiProfile(profile_name) if profile_name is not None else None
         self.out_dir = out_dir
+        self.since = since
+        self.cache = cache
 
     def export(self):
         if self.kind == 'all':
@@ -39,14 +64,87 @@ class Exporter:
                 self._export_kind(kind)
 
     def _export_kind(self, choice):
-        with open(os.path.join(self.out_dir, 'dj_' + choice + '.csv'),
-                  'w', newline='', encoding="utf-8") as csvfile:
+        file_name = os.path.join(self.out_dir, 'dj_' + choice + '.csv')
+        exported = set()
+        with open(file_name, 'w', newline='', encoding="utf-8") as csvfile:
             writer = csv.writer(csvfile, delimiter='\t', quotechar='"')
-            writer.writerow(['#separator:tab'])
-            writer.writerow(['#html:true'])
-            writer.writerow(['#notetype column:1'])
-            writer.writerow(['#deck column:2'])
-            getattr(self, 'export_' + choice)(writer)
+            writer.writerows(self.header_rows)
+            rows = self.cache.get_rows(self, choice) if self.cache is not None else self.get_rows(choice)
+            for row in rows:
+                exported.add(str(row[2]))
+                writer.writerow(row)
+
+        if self.since is not None and choice != 'anki_kanji':
+            candidates = self.cache.get_deleted_candidates(self, choice) if self.cache is not None \
+                else self.get_deleted_candidates(choice)
+            with open(get_deleted_file_name(file_name), 'w', newline='', encoding="utf-8") as csvfile:
+                writer = csv.writer(csvfile, delimiter='\t', quotechar='"')
+                writer.writerows([x] for x in sorted(candidates - exported))
+
+    @staticmethod
+    def get_note_model(choice):
+        """Model of the objects exported as notes (first field of the note: pk of the object)"""
+        return Yoji if choice == 'anki_yoji' else Example
+
+    def get_changed_filter(self, choice):
+        """Filter of the objects whose note changed since the last export (on the annotations of only_changed)"""
+        if choice == 'anki_yoji':
+            # The note of a yoji lists the other yoji with the same first / second half
+            changed = (list(Yoji.objects.filter(updated_time__gt=self.since).values_list('yoji', flat=True))
+                       + list(AnkiDeletedNote.objects.filter(model=getattr(Yoji, '_meta').label,
+                                                                deleted_time__gt=self.since)
+                              .values_list('note_key', flat=True)))
+            if len(changed) > self.max_changed_yoji:
+                return Q()
+            return (Q(updated_time__gt=self.since) | Q(yoji_start__in={x[0:2] for x in changed})
+                    | Q(yoji_end__in={x[2:4] for x in changed}))
+        if choice == 'anki_kotowaza':
+            return Q(updated_time__gt=self.since) | Q(kotowaza__updated_time__gt=self.since)
+        return Q(updated_time__gt=self.since)
+
+    def only_changed(self, choice, q_set):
+        """q_set, restricted to the changed objects in delta export"""
+        if self.since is None:
+            return q_set
+        if choice == 'anki_yoji':
+            q_set = q_set.annotate(yoji_start=Substr('yoji', 1, 2), yoji_end=Substr('yoji', 3, 2))
+        return q_set.filter(self.get_changed_filter(choice))
+
+    def get_deleted_candidates(self, choice):
+        """
+        Keys of the objects changed or deleted since the last export: the notes of the candidates not exported are
+        deleted (e.g. not matching the filter of the deck anymore). Keys of notes not in Anki are ignored by the import.
+        """
+        model = self.get_note_model(choice)
+        changed = {str(x) for x in self.only_changed(choice, model.objects.all()).values_list('pk', flat=True)}
+        deleted = set(AnkiDeletedNote.objects.filter(model=getattr(model, '_meta').label, deleted_time__gt=self.since)
+                      .values_list('note_key', flat=True))
+        return changed | deleted
+
+    def filter_profile(self, choice, q_set):
+        """q_set, restricted to the objects exported for the profile"""
+        if self.profile is None or self.profile.name not in self.profile_filters.get(choice, {}):
+            return q_set
+        return q_set.filter(self.profile_filters[choice][self.profile.name])
+
+    def get_profile_keys(self, choice):
+        """Profile name -> keys of the objects exported for the profile, for the profile filters of the deck"""
+        model = self.get_note_model(choice)
+        return {name: {str(x) for x in model.objects.filter(q).values_list('pk', flat=True)}
+                for name, q in self.profile_filters.get(choice, {}).items()}
+
+    def get_rows(self, choice):
+        """Generator of the rows of the export choice"""
+        return getattr(self, 'rows_' + choice)()
+
+    def write_rows(self, choice, writer):
+        writer.writerows(self.get_rows(choice))
+
+    export_anki_kaki = partialmethod(write_rows, 'anki_kaki')
+    export_anki_yomi = partialmethod(write_rows, 'anki_yomi')
+    export_anki_kotowaza = partialmethod(write_rows, 'anki_kotowaza')
+    export_anki_kanji = partialmethod(write_rows, 'anki_kanji')
+    export_anki_yoji = partialmethod(write_rows, 'anki_yoji')
 
     @staticmethod
     def std_alt_maps():
@@ -62,7 +160,7 @@ class Exporter:
 
         return std_to_alt, alt_to_std
 
-    def export_anki_kaki(self, writer):
+    def rows_anki_kaki(self):
         std_to_alt, alt_to_std = Exporter.std_alt_maps()
 
         q_set = (Example.objects
@@ -70,12 +168,11 @@ class Exporter:
                                       Example.RUIGI])
                  .exclude(sentence='')
                  .exclude(kanken__difficulty__gt=11)
-                 .exclude(self.excl_in_progress))
-        if self.profile.name == 'Ayumi':
-            q_set = q_set.filter(Q(kanken__difficulty__gte=8) |
-                                 Q(ex_kind__in=[Example.TAIGI, Example.RUIGI]))
+                 .exclude(self.excl_in_progress)
+                 .select_related('kanken'))
+        q_set = self.filter_profile('anki_kaki', q_set)
 
-        for example in q_set:
+        for example in self.only_changed('anki_kaki', q_set).iterator(chunk_size=self.chunk_size):
             word = example.word_native or example.word
             yomi = example.yomi_native or example.yomi
             hyogai_tag = '<span class=tag_hyogai>表外</span>' \
@@ -93,13 +190,13 @@ class Exporter:
             if example.word_variation != '':
                 word += '\n（{}）'.format(example.word_variation)
 
-            writer.writerow(['Kakitori', '書き取り',
-                             example.id,
-                             sentence,
-                             word,
-                             example.kanken])
+            yield ['Kakitori', '書き取り',
+                   example.id,
+                   sentence,
+                   word,
+                   example.kanken]
 
-    def export_anki_yomi(self, writer):
+    def rows_anki_yomi(self):
         std_to_alt, alt_to_std = Exporter.std_alt_maps()
 
         q_set = Example.objects.exclude(sentence='').exclude(
@@ -108,7 +205,7 @@ class Exporter:
             Q(kanken__difficulty__gte=11) | Q(ex_kind=Example.YOMI)
         ).exclude(ex_kind=Example.KOTOWAZA)
 
-        for example in q_set:
+        for example in self.only_changed('anki_yomi', q_set).iterator(chunk_size=self.chunk_size):
             word = example.word_native or example.word
             yomi = example.yomi_native or example.yomi
             hyogai_tag = '<span class=tag_hyogai>表外</span>' \
@@ -137,20 +234,20 @@ class Exporter:
             if example.word_variation != '':
                 word += '\n（{}）'.format(example.word_variation)
 
-            writer.writerow(['Yomi',
-                             '読み',
-                             example.id,
-                             sentence,
-                             yomi,
-                             definition])
+            yield ['Yomi',
+                   '読み',
+                   example.id,
+                   sentence,
+                   yomi,
+                   definition]
 
-    @staticmethod
-    def export_anki_kotowaza(writer):
+    def rows_anki_kotowaza(self):
         q_set = (Example.objects.filter(ex_kind=Example.KOTOWAZA)
                  .exclude(kotowaza__isnull=True)
-                 .exclude(kotowaza__yomi=''))
+                 .exclude(kotowaza__yomi='')
+                 .select_related('kotowaza'))
 
-        for example in q_set:
+        for example in self.only_changed('anki_kotowaza', q_set).iterator(chunk_size=self.chunk_size):
             word = example.word_native or example.word
             yomi = example.yomi_native or example.yomi
             furigana = JpnText.from_furigana_format(
@@ -158,43 +255,51 @@ class Exporter:
             sentence = furigana.replace(
                 word, '<span class="font-color01">' + yomi + '</span>')
 
-            writer.writerow(['Kotowaza',
-                             '諺',
-                             example.id,
-                             sentence,
-                             word,
-                             example.kotowaza.get_definition_html(),
-                             example.kotowaza.yomi])
-
-    @staticmethod
-    def export_anki_kanji(writer):
-        for kj in Kanji.objects.exclude(kanken__difficulty__gt=10):
+            yield ['Kotowaza',
+                   '諺',
+                   example.id,
+                   sentence,
+                   word,
+                   example.kotowaza.get_definition_html(),
+                   example.kotowaza.yomi]
+
+    @classmethod
+    def rows_anki_kanji(cls):
+        q_set = (Kanji.objects.exclude(kanken__difficulty__gt=10)
+                 .select_related('kanjidetails', 'bushu', 'kanken', 'classification')
+                 .prefetch_related(Prefetch('reading_set',
+                                            queryset=Reading.objects.select_related('joyo')
+                                            .prefetch_related(Reading.prefetch_ex_anki())),
+                                   Kanji.prefetch_jukuji()))
+
+        # Readings, their examples and the jukuji prefetched for each chunk of kanji
+        for kj in q_set.iterator(chunk_size=cls.chunk_size):
             anki_read_table = render_to_string('kukan/AnkiReadTable.html',
                                                {'kanji': kj})
-            writer.writerow(['Japanese Kanji',
-                             '漢字',
-                             kj.kanji,
-                             kj.kanjidetails.anki_English,
-                             kj.kanjidetails.anki_Examples,
-                             kj.kanjidetails.anki_Kanji_Radical,
-                             kj.kanjidetails.anki_Traditional_Form,
-                             kj.kanjidetails.anki_Traditional_Radical,
-                             anki_read_table,
-                             kj.bushu.bushu,
-                             kj.kanjidetails.anki_kjBushuMei,
-                             kj.kanken.kyu,
-                             kj.classification,
-                             kj.kanjidetails.anki_kjIjiDoukun])
-
-    @staticmethod
-    def export_anki_yoji(writer):
+            yield ['Japanese Kanji',
+                   '漢字',
+                   kj.kanji,
+                   kj.kanjidetails.anki_English,
+                   kj.kanjidetails.anki_Examples,
+                   kj.kanjidetails.anki_Kanji_Radical,
+                   kj.kanjidetails.anki_Traditional_Form,
+                   kj.kanjidetails.anki_Traditional_Radical,
+                   anki_read_table,
+                   kj.bushu.bushu,
+                   kj.kanjidetails.anki_kjBushuMei,
+                   kj.kanken.kyu,
+                   kj.classification,
+                   kj.kanjidetails.anki_kjIjiDoukun]
+
+    def rows_anki_yoji(self):
         test_start = defaultdict(list)
         test_end = defaultdict(list)
-        for yoji in Yoji.objects.filter(in_anki=True):
-            test_start[yoji.yoji[0:2]].append(yoji.yoji[2:4])
-            test_end[yoji.yoji[2:4]].append(yoji.yoji[0:2])
+        for yoji in Yoji.objects.filter(in_anki=True).values_list('yoji', flat=True):
+            test_start[yoji[0:2]].append(yoji[2:4])
+            test_end[yoji[2:4]].append(yoji[0:2])
 
-        for yoji in Yoji.objects.filter(in_anki=True):
+        for yoji in (self.only_changed('anki_yoji', Yoji.objects.filter(in_anki=True))
+                     .iterator(chunk_size=self.chunk_size)):
             cloze = "{{{{c{0}::{1}::{2}}}}}{{{{c{3}::{4}::{5}}}}}".format(
                 yoji.anki_cloze[0],
                 yoji.yoji[0:2],
@@ -205,25 +310,133 @@ class Exporter:
                 '、'.join([x for x in test_start[yoji.yoji[0:2]]
                           if x != yoji.yoji[2:4]]),
             )
-            writer.writerow(['Cloze Yoji',
-                             '四字熟語',
-                             yoji.yoji,
-                             cloze,
-                             yoji.reading,
-                             yoji.get_definition_html()[3:-4],
-                             ])
+            yield ['Cloze Yoji',
+                   '四字熟語',
+                   yoji.yoji,
+                   cloze,
+                   yoji.reading,
+                   yoji.get_definition_html()[3:-4],
+                   ]
+
+
+class ExportCache:
+    """
+    Deck rows shared by the profiles, generated once (Exporter without profile) and stored in cache_dir as
+    <kind>_<key>.csv, each row prefixed by the profiles of Exporter.profile_filters exporting it. The deck of a
+    profile is derived by filtering the shared rows.
+
+    The key is a hash of the export parameters and of the state of the tables the deck depends on:
+        - kinds of reusable_dependencies: all the tables record their changes (update time, or rows only added /
+          deleted), the file is reused by the next runs as long as the tables are unchanged
+        - other kinds (e.g. the definitions of the kanji are not timestamped): the file is only shared within a run
+    """
+    # Increment when the format of the rows changes, to invalidate the reusable files
+    version = 1
+
+    reusable_dependencies = {
+        'anki_yoji': [Yoji, AnkiDeletedNote],
+        'anki_kotowaza': [Example, Kotowaza, AnkiDeletedNote],
+    }
+
+    def __init__(self, run_id, cache_dir=None):
+        """
+        :param run_id: identifier of the sync run, e.g. its start time
+        :param cache_dir: ANKI_EXPORT_CACHE_DIR by default
+        """
+        self.run_id = str(run_id)
+        self.cache_dir = cache_dir or settings.ANKI_EXPORT_CACHE_DIR
+
+    @staticmethod
+    def get_table_state(model):
+        fields = [f.name for f in getattr(model, '_meta').concrete_fields]
+        aggregates = [Count('pk'), Max('pk')] + [Max(x) for x in ['updated_time', 'deleted_time'] if x in fields]
+        return list(model.objects.aggregate(*aggregates).values())
+
+    def get_key(self, choice, since):
+        if choice in self.reusable_dependencies:
+            state = [self.get_table_state(x) for x in self.reusable_dependencies[choice]]
+        else:
+            state = self.run_id
+        return hashlib.sha1(repr((self.version, choice, since, state)).encode()).hexdigest()[:16]
+
+    def get_files(self, exporter, choice):
+        """(rows file, deleted candidates file) of the deck, generated if not in the cache"""
+        base_name = os.path.join(self.cache_dir, f'{choice}_{self.get_key(choice, exporter.since)}')
+        file_name, deleted_file_name = base_name + '.csv', base_name + '_deleted.csv'
+        if os.path.exists(file_name):
+            os.utime(file_name)
+            os.utime(deleted_file_name)
+            return file_name, deleted_file_name
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        shared = Exporter(choice, None, since=exporter.since)
+        profile_keys = shared.get_profile_keys(choice)
+        # Written under a temporary name: workers of a parallel sync can generate the same file
+        suffix = f'.{os.getpid()}.tmp'
+        with open(file_name + suffix, 'w', newline='', encoding="utf-8") as csvfile:
+            writer = csv.writer(csvfile, delimiter='\t', quotechar='"')
+            for row in shared.get_rows(choice):
+                profiles = ' '.join(name for name, keys in profile_keys.items() if str(row[2]) in keys)
+                writer.writerow([profiles] + row)
+        with open(deleted_file_name + suffix, 'w', newline='', encoding="utf-8") as csvfile:
+            writer = csv.writer(csvfile, delimiter='\t', quotechar='"')
+            if exporter.since is not None and choice != 'anki_kanji':
+                writer.writerows([x] for x in sorted(shared.get_deleted_candidates(choice)))
+        os.replace(deleted_file_name + suffix, deleted_file_name)
+        os.replace(file_name + suffix, file_name)
+        return file_name, deleted_file_name
+
+    def get_rows(self, exporter, choice):
+        """Generator of the rows of the deck for the profile of the exporter"""
+        file_name, _ = self.get_files(exporter, choice)
+        filtered = exporter.profile.name in Exporter.profile_filters.get(choice, {})
+        with open(file_name, newline='', encoding="utf-8") as csvfile:
+            for profiles, *row in csv.reader(csvfile, delimiter='\t', quotechar='"'):
+                if not filtered or exporter.profile.name in profiles.split():
+                    yield row
+
+    def get_deleted_candidates(self, exporter, choice):
+        _, deleted_file_name = self.get_files(exporter, choice)
+        with open(deleted_file_name, newline='', encoding="utf-8") as csvfile:
+            return {x[0] for x in csv.reader(csvfile, delimiter='\t', quotechar='"')}
+
+    def prune(self, before):
+        """Delete the files not used since the timestamp before"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            file_name = os.path.join(self.cache_dir, name)
+            if os.path.getmtime(file_name) < before:
+                os.unlink(file_name)
+
+
+class PseudoBuffer:
+    """File-like object returning the written value instead of storing it, to stream the output of a csv.writer"""
+    @staticmethod
+    def write(value):
+        return value
 
 
 class ExporterAsResp(Exporter):
-    def __init__(self, kind, profile_name):
+    def __init__(self, kind, profile_name, streaming=True):
+        """
+        :param streaming: stream the rows as they are generated (StreamingHttpResponse), instead of building the
+                          whole file in memory first
+        """
         super().__init__(kind, profile_name)
+        self.streaming = streaming
 
     def export(self):
         choice = self.kind
-        response = HttpResponse(content_type='text/csv')
+        if self.streaming:
+            writer = csv.writer(PseudoBuffer(), delimiter='\t', quotechar='"')
+            response = StreamingHttpResponse((writer.writerow(row) for row in self.get_rows(choice)),
+                                             content_type='text/csv')
+        else:
+            response = HttpResponse(content_type='text/csv')
+            writer = csv.writer(response, delimiter='\t', quotechar='"')
+            self.write_rows(choice, writer)
         response['Content-Disposition'] = 'attachment; filename="dj_' \
                                           + choice + '.csv"'
-        writer = csv.writer(response, delimiter='\t', quotechar='"')
-        getattr(self, 'export_' + choice)(writer)
 
         return response
@@ -1,19 +1,55 @@
 import collections
+import hashlib
 import json
 import urllib.parse
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models import Max, Min, Q
+from django.db.models.signals import post_delete, post_save
 
 import kukan.jautils as jau
 from .models import KoukiBushu, Reading
+from .search import filter_contains
+from .yomi_index import YomiIndex, reading_index, yomi_indexes
+
+# Beyond that number of matches of the yomi indexes, filter in SQL rather than with a long IN list
+max_in_list = 900
+yomi_index_modes = {'位始': YomiIndex.START, '位含': YomiIndex.CONTAINS}
+
+# Model -> cache keys of the filter metadata (get_extra_json) computed from that model
+metadata_keys = collections.defaultdict(set)
+
+
+def invalidate_filter_metadata(sender, **kwargs):
+    cache.delete_many(list(metadata_keys[sender]))
+
+
+def get_path_models(model, path):
+    """Models traversed by a lookup path, e.g. (Example, Kanken) for Example and 'kanken__kyu'"""
+    models = [model]
+    for part in path.lstrip('-').split('__'):
+        try:
+            fld = getattr(models[-1], '_meta').get_field(part)
+        except FieldDoesNotExist:
+            break
+        if not fld.is_relation:
+            break
+        models.append(fld.related_model)
+    return models
 
 
 class FFilter(ABC):
     kind = ''
     label = ''
     value = ''
+    # Maximum age of the cached metadata, for changes made by other processes (management commands, other workers):
+    # the cache is local to the process (no CACHES configured), the signals only invalidate it in the saving process.
+    # Same timeout as the count of the paginator
+    metadata_timeout = 60
+    metadata_key = None
 
     @staticmethod
     def get_filter_context_strings():
@@ -47,11 +83,30 @@ class FFilter(ABC):
 
     def to_json(self):
         return "{{'name':'{}', 'label':'{}', 'extra':{}, 'value':'{}'}}".format(
-            self.kind, self.label, self.get_extra_json(), urllib.parse.quote(self.value))
+            self.kind, self.label, self.get_cached_extra_json(), urllib.parse.quote(self.value))
 
     def get_extra_json(self):
         return "{}"
 
+    def cache_extra_json(self, models, *key_items):
+        """
+        Cache the result of get_extra_json until an object of one of the models is saved or deleted
+        :param models: models get_extra_json is computed from
+        :param key_items: parameters of the filter changing the result of get_extra_json
+        """
+        key = '|'.join(str(x) for x in [self.__class__.__name__, self.label, *key_items])
+        self.metadata_key = 'filter_metadata:' + hashlib.md5(key.encode()).hexdigest()
+        for model in models:
+            metadata_keys[model].add(self.metadata_key)
+            dispatch_uid = f'filter_metadata_{getattr(model, "_meta").label}'
+            post_save.connect(invalidate_filter_metadata, sender=model, dispatch_uid=dispatch_uid)
+            post_delete.connect(invalidate_filter_metadata, sender=model, dispatch_uid=dispatch_uid)
+
+    def get_cached_extra_json(self):
+        if self.metadata_key is None:
+            return self.get_extra_json()
+        return cache.get_or_set(self.metadata_key, self.get_extra_json, self.metadata_timeout)
+
     def filter(self, request, qry):
         flt = request.GET.get(self.label, None)
         if flt is not None:
@@ -72,6 +127,8 @@ class FGenericCheckbox(FFilter):
         self.none_label = none_label
         self.none_position = none_position
         super().__init__(title, 'v-filter-checkbox')
+        self.cache_extra_json({*get_path_models(model, field), *get_path_models(model, self.order)},
+                              getattr(model, '_meta').label, field, self.nb_col, self.order, none_label, none_position)
 
     def add_to_query(self, flt, qry):
         flt = flt.split(', ')
@@ -159,9 +216,12 @@ class FGenericString(FFilter):
         super().__init__(title, 'v-filter-string')
 
     def add_to_query(self, flt, qry):
-        kwargs = {self.lh_criteria: self.rh_fct(flt)}
-        qry = qry.filter(**kwargs).distinct()
-        return qry
+        if self.lh_criteria == self.field + '__contains':
+            # Full-text search index when the field has one
+            qry = filter_contains(qry, self.field, self.rh_fct(flt))
+        else:
+            qry = qry.filter(**{self.lh_criteria: self.rh_fct(flt)})
+        return qry.distinct()
 
 
 class FGenericYesNo(FFilter):
@@ -199,6 +259,12 @@ class FYomiSimple(FFilter):
         yomi, position = flt.split('_')
         yomi = yomi.translate(jau.kat2hir)
 
+        index = yomi_indexes.get((qry.model, self.field))
+        if index is not None:
+            pks = [pk for pk, _ in index.search(yomi, yomi_index_modes.get(position, YomiIndex.EXACT))]
+            if len(pks) <= max_in_list:
+                return qry.filter(pk__in=pks)
+
         if position == '位始':
             kwargs = {self.field + '__startswith': yomi}
         elif position == '位含':
@@ -214,9 +280,21 @@ class FYomi(FFilter):
     def __init__(self):
         super().__init__('読み', 'v-filter-yomi')
 
+    @staticmethod
+    def is_selected(onkun, joyo, yomi_type, yomi_joyo):
+        return ((onkun != '読音' or yomi_type == '音') and (onkun != '読訓' or yomi_type == '訓')
+                and (joyo != '常用' or yomi_joyo != '表外') and (joyo != '常外' or yomi_joyo == '表外'))
+
     def add_to_query(self, flt, qry):
         yomi, position, onkun, joyo = flt.split('_')
         yomi = yomi.translate(jau.kat2hir)
+
+        kanji_ids = {kanji_id for _, (kanji_id, yomi_type, yomi_joyo)
+                     in reading_index.search(yomi, yomi_index_modes.get(position, YomiIndex.EXACT))
+                     if self.is_selected(onkun, joyo, yomi_type, yomi_joyo)}
+        if len(kanji_ids) <= max_in_list:
+            return qry.filter(pk__in=kanji_ids)
+
         readings = Reading.objects.all()
 
         # Filter position yomi
@@ -246,6 +324,7 @@ class FYomi(FFilter):
 class FBushu(FFilter):
     def __init__(self):
         super().__init__('部首', 'v-filter-bushu')
+        self.cache_extra_json([KoukiBushu])
 
     def get_extra_json(self):
         dct = collections.defaultdict(list)
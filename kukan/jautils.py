@@ -1,5 +1,14 @@
+import functools
+import itertools as it
+import json
+import logging
+import queue
 import re
+import sqlite3
+import threading
+from collections import namedtuple, OrderedDict
 from janome.tokenizer import Tokenizer
+from janome.version import JANOME_VERSION
 from multiprocessing.connection import Client
 
 from django.conf import settings
@@ -22,6 +31,190 @@ kat2hir = str.maketrans(katakana_chart, hiragana_chart)
 
 digit_ful2half = str.maketrans(fullwidth_digit_chart, halfwidth_digit_chart)
 
+# Compiled patterns shared by JpnText and the template filters (kukan.templatetags.ja_tags)
+kanji_range = '一-龥'
+# Split a word in (leading non-kanji, block starting and ending with a kanji, trailing non-kanji)
+kanji_block_pattern = re.compile(r'([^{0}]*)(.*?)([^{0}]*)'.format(kanji_range), re.DOTALL)
+ruby_split_pattern = re.compile(r'(<ruby>.+?</ruby>)')
+ruby_pattern = re.compile(r'<ruby>(.+?)<rt>(.*?)</rt></ruby>')
+furigana_split_pattern = re.compile(r'(\[.+?\|.+?\|f\])')
+furigana_pattern = re.compile(r'\[(.+?)\|(.+?)\|f\]')
+# Lenient version used for display, accepting empty parts
+furigana_display_pattern = re.compile(r'\[(.*?)\|(.*?)\|f\]')
+furigana_marker = '|f]'
+
+logger = logging.getLogger(__name__)
+
+# The system dictionary (ipadic) is bundled with Janome, so its version identifies both
+TOKENIZER_VERSION = f'janome-{JANOME_VERSION}'
+
+# Lightweight token as returned by the resident tokenizer (only the fields used by JpnText)
+Token = namedtuple('Token', ['surface', 'reading'])
+
+
+def find_reading_combinations(candidates, yomi, find_all=False):
+    """
+    Find the combinations of one reading per position whose concatenation is yomi.
+    Depth-first search over the positions, keeping only the readings which are a prefix of the rest of the yomi, and
+    memorizing the dead ends (position, offset in yomi): linear in the yomi length instead of the product of the number
+    of readings. Combinations are returned in the order of itertools.product(*candidates).
+
+    :param candidates: one list of (key, reading) per position
+    :param yomi: the reading to match, in the same kana as the candidates
+    :param find_all: return every combination, instead of only the first one
+    :return: list of combinations, each being a list of keys (one per position)
+    """
+    @functools.lru_cache(maxsize=None)
+    def solve(position, offset):
+        if position == len(candidates):
+            return [[]] if offset == len(yomi) else []
+        res = []
+        for key, reading in candidates[position]:
+            if yomi.startswith(reading, offset):
+                for tail in solve(position + 1, offset + len(reading)):
+                    res.append([key, *tail])
+                    if not find_all:
+                        return res
+        return res
+
+    return solve(0, 0)
+
+
+class TokenizerError(Exception):
+    """Failure reported by the resident tokenizer"""
+
+
+class TokenizerConnectionPool:
+    """
+    Keep open connections to the resident tokenizer (utilskanji/janome_daemon.py), so that the connect /
+    authentication handshake is not paid on every call. Can be shared by the threads of a process.
+    """
+
+    def __init__(self, address, authkey, max_size=4):
+        self.address = address
+        self.authkey = authkey
+        self._idle = queue.LifoQueue(max_size)
+
+    def _acquire(self, fresh=False):
+        if not fresh:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+        return Client(self.address, authkey=self.authkey)
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, args):
+        # An idle connection can be stale if the daemon was restarted: retry once on a new connection
+        for retry in [False, True]:
+            conn = self._acquire(fresh=retry)
+            try:
+                conn.send(args)
+                res = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                if retry:
+                    raise
+                continue
+            self._release(conn)
+            # Failed request: b'Error', followed by the message of the daemon
+            if isinstance(res, bytes) and res.startswith(b'Error'):
+                raise TokenizerError(f'Tokenizer daemon: {res.decode(errors="replace")}')
+            return res
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of the tokenizer output, keyed by text and tokenizer version.
+
+    An optional SQLite file adds a second tier, shared between the processes (Apache workers, management
+    commands) and surviving restarts. Entries of another tokenizer version are never returned.
+    """
+
+    def __init__(self, max_size=1024, db_path=None, version=TOKENIZER_VERSION):
+        self.max_size = max_size
+        self.db_path = db_path
+        self.version = version
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _get_db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute('create table if not exists token_cache ('
+                             'version text, text text, tokens text, primary key (version, text))')
+        return self._db
+
+    def _remember(self, text, tokens):
+        self._entries[text] = tokens
+        self._entries.move_to_end(text)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, text):
+        """
+        :return: the list of Token for text, or None if not cached
+        """
+        with self._lock:
+            tokens = self._entries.get(text)
+            if tokens is not None:
+                self._entries.move_to_end(text)
+                self.hits += 1
+                return tokens
+            if self.db_path:
+                row = self._get_db().execute('select tokens from token_cache where version=? and text=?',
+                                             (self.version, text)).fetchone()
+                if row:
+                    tokens = [Token(*t) for t in json.loads(row[0])]
+                    self._remember(text, tokens)
+                    self.db_hits += 1
+                    return tokens
+            self.misses += 1
+            return None
+
+    def put(self, text, tokens):
+        tokens = [Token(t.surface, t.reading) for t in tokens]
+        with self._lock:
+            self._remember(text, tokens)
+            if self.db_path:
+                self._get_db().execute('insert or replace into token_cache values (?, ?, ?)',
+                                       (self.version, text, json.dumps(tokens, ensure_ascii=False)))
+        return tokens
+
+    def invalidate(self, texts=None):
+        """
+        Invalidation hook: drop the given texts, or everything (both tiers) if texts is None
+        """
+        with self._lock:
+            if texts is None:
+                self._entries.clear()
+                if self.db_path:
+                    self._get_db().execute('delete from token_cache')
+            else:
+                for text in texts:
+                    self._entries.pop(text, None)
+                    if self.db_path:
+                        self._get_db().execute('delete from token_cache where text=?', (text,))
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'db_hits': self.db_hits, 'misses': self.misses}
+
 
 class JpnText:
     """
@@ -37,15 +230,33 @@ class JpnText:
         """
 
         full_tokenizer = Tokenizer() if not hasattr(settings, 'JANOME_PORT') else None
+        pool = TokenizerConnectionPool(('localhost', settings.JANOME_PORT), settings.JANOME_KEY,
+                                       getattr(settings, 'JANOME_POOL_SIZE', 4)) if full_tokenizer is None else None
+        cache = TokenCache(getattr(settings, 'JANOME_CACHE_SIZE', 1024), getattr(settings, 'JANOME_CACHE_DB', None))
 
         @classmethod
         def tokenize(cls, text):
-            if cls.full_tokenizer:
-                res = cls.full_tokenizer.tokenize(text)
-            else:
-                with Client(('localhost', settings.JANOME_PORT), authkey=settings.JANOME_KEY) as conn:
-                    conn.send([text])
-                    res = conn.recv()
+            return cls.tokenize_batch([text])[0]
+
+        @classmethod
+        def tokenize_batch(cls, texts):
+            """
+            Tokenize several texts in one round trip to the resident process
+            :param texts: iterable of strings
+            :return: list (one item per text) of list of tokens
+            """
+            texts = list(texts)
+            res = [cls.cache.get(text) for text in texts]
+            missing = list(dict.fromkeys(text for text, tokens in zip(texts, res) if tokens is None))
+            if missing:
+                if cls.full_tokenizer:
+                    tokenized = [cls.full_tokenizer.tokenize(text) for text in missing]
+                else:
+                    tokenized = cls.pool.request(('batch', missing))
+                    tokenized = [[Token(*t) for t in tokens] for tokens in tokenized]
+                tokenized = {text: cls.cache.put(text, tokens) for text, tokens in zip(missing, tokenized)}
+                res = [tokenized[text] if tokens is None else tokens for text, tokens in zip(texts, res)]
+                logger.debug(f'Tokenizer cache: {cls.cache.stats()}')
             return res
 
     tokenizer = LightTokenizer()
@@ -88,15 +299,9 @@ class JpnText:
             token_list = []
             furigana = furigana_raw.translate(kat2hir)
 
-            sentinel_text = 'sentinel'
-            kanji_pattern = '[一-龥]'
-            if re.search(kanji_pattern, origin):
-                split_token = re.split(u'({}+)'.format(kanji_pattern), '{0}{1}{0}'.format(sentinel_text, origin))
-
-                pre_kanji = split_token[0][len(sentinel_text):] if split_token[0] != sentinel_text else ''
-                post_kanji = split_token[-1][:-len(sentinel_text)] if split_token[-1] != sentinel_text else ''
-
-                kanji = origin[len(pre_kanji):-len(post_kanji) or None]
+            # Leading kana / trailing kana are separated from the block starting and ending with a kanji
+            pre_kanji, kanji, post_kanji = kanji_block_pattern.fullmatch(origin).groups()
+            if kanji:
                 kana = furigana[len(pre_kanji):-len(post_kanji) or None]
 
                 if not all([furigana.startswith(pre_kanji.translate(kat2hir)),
@@ -132,16 +337,42 @@ class JpnText:
 
         return cls(text, token_list=token_list, expected_yomi=expected_yomi)
 
+    @classmethod
+    def from_texts(cls, texts, expected_yomis=None):
+        """
+        Same as from_text for many texts, tokenized in one pass.
+        A token whose reading does not match its surface is kept without furigana and reported by
+        get_furigana_errors() instead of raising, so that one bad text does not fail the whole batch.
+
+        :param texts: iterable of texts
+        :param expected_yomis: optional iterable of expected yomi, in the same order as texts
+        :return: list of JpnText
+        """
+        texts = list(texts)
+        res = []
+        for text, expected_yomi, tokens in zip(texts, expected_yomis or it.repeat(None),
+                                               cls.tokenizer.tokenize_batch(texts)):
+            token_list = []
+            errors = []
+            for tok in tokens:
+                try:
+                    token_list.extend(cls.TextToken.get_sub_token(tok.surface, tok.reading))
+                except ValueError:
+                    token_list.append(cls.TextToken(tok.surface))
+                    errors.append('振り仮名を推測出来ない: 「{}」'.format(tok.surface))
+            jpn_text = cls(text, token_list=token_list, expected_yomi=expected_yomi)
+            jpn_text._furigana_errors = errors + jpn_text._furigana_errors
+            res.append(jpn_text)
+        return res
+
     @classmethod
     def from_ruby(cls, text):
         token_list = []
-        pattern_all = r'(<ruby>.+?</ruby>)'
-        pattern_sub = r'<ruby>(.+?)<rt>(.*?)</rt></ruby>'
-        for item in re.split(pattern_all, text):
+        for item in ruby_split_pattern.split(text):
             if not item:
                 pass
             elif item[:6] == '<ruby>' and item[-7:] == '</ruby>':
-                match_obj = re.match(pattern_sub, item)
+                match_obj = ruby_pattern.match(item)
                 token_list.extend(cls.TextToken.get_sub_token(match_obj[1], match_obj[2]))
             else:
                 token_list.append(cls.TextToken(item))
@@ -151,13 +382,16 @@ class JpnText:
     @classmethod
     def from_furigana_format(cls, furigana_format, text=None, expected_yomi=None):
         token_list = []
-        pattern_all = r'(\[.+?\|.+?\|f\])'
-        pattern_sub = r'\[(.+?)\|(.+?)\|f\]'
-        for item in re.split(pattern_all, furigana_format):
+        if furigana_marker not in furigana_format:
+            # Fast path: plain text
+            items = [furigana_format]
+        else:
+            items = furigana_split_pattern.split(furigana_format)
+        for item in items:
             if not item:
                 pass
             elif item[:1] == '[' and item[-1:] == ']':
-                match_obj = re.match(pattern_sub, item)
+                match_obj = furigana_pattern.match(item)
                 token_list.extend(cls.TextToken.get_sub_token(match_obj[1], match_obj[2]))
             else:
                 token_list.append(cls.TextToken(item))
@@ -0,0 +1,112 @@
+import logging
+
+from kukan.jautils import JpnText, furigana_pattern
+from kukan.models import Example, Kotowaza
+from utils_django.management_command import FBaseCommand
+
+logger = logging.getLogger(__name__)
+
+
+class Command(FBaseCommand):
+    """
+    Re-check the furigana of the whole corpus, tokenizing a chunk of rows at a time:
+        - Kotowaza.furigana is checked against kotowaza / yomi, and guessed when empty (saved with --fix)
+        - The furigana inside Example.sentence are checked for consistency and compared with the guessed reading
+    """
+    help = 'Check the furigana of Kotowaza and Example sentences, backfill the missing Kotowaza ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            dest='fix',
+            action='store_true',
+            help='Save the guessed furigana of the Kotowaza without furigana',
+        )
+        parser.add_argument(
+            '--chunk_size',
+            dest='chunk_size',
+            type=int,
+            default=500,
+            help='Number of rows per tokenizer batch and bulk_update',
+        )
+
+    @staticmethod
+    def iter_chunks(q_set, chunk_size):
+        chunk = []
+        for obj in q_set.iterator(chunk_size=chunk_size):
+            chunk.append(obj)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def report(self, obj, text, errors):
+        for error in errors:
+            msg = f'{obj.__class__.__name__} {obj.pk} 「{text}」: {error}'
+            logger.warning(msg)
+            self.stdout.write(msg)
+        return 1 if errors else 0
+
+    def check_kotowaza(self, chunk, fix):
+        nb_errors = 0
+        to_guess = []
+        for kotowaza in chunk:
+            if not kotowaza.furigana:
+                to_guess.append(kotowaza)
+                continue
+            try:
+                errors = JpnText.from_furigana_format(kotowaza.furigana, kotowaza.kotowaza,
+                                                      kotowaza.yomi).get_furigana_errors()
+            except ValueError as e:
+                errors = [str(e)]
+            nb_errors += self.report(kotowaza, kotowaza.furigana, errors)
+
+        to_update = []
+        guessed = JpnText.from_texts([k.kotowaza for k in to_guess], [k.yomi for k in to_guess])
+        for kotowaza, jpn_text in zip(to_guess, guessed):
+            if jpn_text.get_furigana_errors():
+                nb_errors += self.report(kotowaza, kotowaza.kotowaza, jpn_text.get_furigana_errors())
+            elif fix:
+                kotowaza.furigana = jpn_text.furigana()
+                to_update.append(kotowaza)
+        Kotowaza.objects.bulk_update(to_update, ['furigana'])
+
+        return nb_errors, len(to_update)
+
+    def check_example(self, chunk):
+        nb_errors = 0
+        segments = []
+        for example in chunk:
+            try:
+                errors = JpnText.from_furigana_format(example.sentence).get_furigana_errors()
+            except ValueError as e:
+                errors = [str(e)]
+            nb_errors += self.report(example, example.sentence, errors)
+            if not errors:
+                segments.extend((example, m[1], m[2]) for m in furigana_pattern.finditer(example.sentence))
+
+        guessed = JpnText.from_texts([origin for _, origin, _ in segments], [yomi for _, _, yomi in segments])
+        wrong_guess = set()
+        for (example, origin, yomi), jpn_text in zip(segments, guessed):
+            if self.report(example, f'{origin}|{yomi}', jpn_text.get_furigana_errors()):
+                wrong_guess.add(example.pk)
+
+        return nb_errors + len(wrong_guess)
+
+    def handle_cmd(self, *args, **options):
+        chunk_size = options['chunk_size']
+        nb_rows = nb_errors = nb_fixed = 0
+        for chunk in self.iter_chunks(Kotowaza.objects.order_by('pk'), chunk_size):
+            errors, fixed = self.check_kotowaza(chunk, options['fix'])
+            nb_rows += len(chunk)
+            nb_errors += errors
+            nb_fixed += fixed
+
+        for chunk in self.iter_chunks(Example.objects.filter(sentence__contains='|f]').order_by('pk'), chunk_size):
+            nb_errors += self.check_example(chunk)
+            nb_rows += len(chunk)
+
+        summary = f'Checked {nb_rows} rows: {nb_errors} with errors, {nb_fixed} furigana saved'
+        logger.info(summary)
+        self.stdout.write(summary)
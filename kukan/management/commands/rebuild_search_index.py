@@ -0,0 +1,11 @@
+from django.db import connection
+
+from kukan.search import create_search_indexes
+from utils_django.management_command import FBaseCommand
+
+
+class Command(FBaseCommand):
+    help = 'Recreate the full-text search indexes and their triggers (needed after a migration rebuilding the tables)'
+
+    def handle_cmd(self, *args, **options):
+        create_search_indexes(connection)
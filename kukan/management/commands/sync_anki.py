@@ -1,13 +1,49 @@
+import logging
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from django.conf import settings
 from django.core.mail import mail_admins
+from django.core.management import CommandError
+from django.db import connections
+from django.db.models import Min
+from django.utils import timezone
 
 from kukan.anki_dj import AnkiProfile
-from kukan.exporting import Exporter
+from kukan.exporting import Exporter, ExportCache
+from kukan.models import AnkiDeletedNote, AnkiSyncMark
 from utils_django.management_command import FBaseCommand
 
+logger = logging.getLogger(__name__)
+
+
+def sync_profile(profile, max_delete_count, delta, import_dir, start_time, cache):
+    """
+    Export and sync one profile (run in a worker process in parallel mode)
+    :param start_time: start time of the run, recorded as the mark of the profile: changes made during the sync are
+                       exported again by the next one, and the profiles synced together share their delta export
+    :param cache: ExportCache of the run
+    :return: (profile, result DataFrame or None, duration in seconds, error or None)
+    """
+    start = time.perf_counter()
+    try:
+        os.makedirs(import_dir, exist_ok=True)
+        list(map(os.unlink, (os.path.join(import_dir, f) for f in os.listdir(import_dir)
+                             if os.path.isfile(os.path.join(import_dir, f)))))
+
+        mark = AnkiSyncMark.objects.filter(profile=profile).first()
+        since = mark.exported_time if delta and mark else None
+        Exporter('all', profile, out_dir=import_dir, since=since, cache=cache).export()
+        res_df = AnkiProfile(profile, max_delete_count, import_dir).sync(delta=since is not None)
+        AnkiSyncMark.objects.update_or_create(profile=profile, defaults={'exported_time': start_time})
+        return profile, res_df, time.perf_counter() - start, None
+    except Exception as e:
+        logger.exception(f'{profile}: sync failure')
+        return profile, None, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
 
 class Command(FBaseCommand):
     help = 'Sync Anki'
@@ -27,18 +63,56 @@ class Command(FBaseCommand):
             default=5,
             help='Maximum number of card which can be deleted',
         )
+        parser.add_argument(
+            '--delta',
+            action='store_true',
+            help='Only export the notes changed since the last sync of the profile'
+                 ' (full export if the profile was never synced)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes syncing the profiles in parallel'
+                 ' (each profile is exported in its own sub-directory of the import directory)',
+        )
 
     def handle_cmd(self, *args, **options):
-        res_dfs = {}
-        for profile in options['profile'].split() or AnkiProfile.profile_list():
-            dir_to_clear = settings.ANKI_IMPORT_DIR
-            list(map(os.unlink, (os.path.join(dir_to_clear, f)
-                                 for f in os.listdir(dir_to_clear))))
+        start_time = timezone.now()
+        # Decks generated once for all the profiles
+        cache = ExportCache(run_id=start_time.isoformat())
+        profiles = options['profile'].split() or list(AnkiProfile.profile_list())
+        args_list = [(profile, options['max_delete_count'], options['delta'],
+                      settings.ANKI_IMPORT_DIR if options['workers'] <= 1
+                      else os.path.join(settings.ANKI_IMPORT_DIR, profile),
+                      start_time, cache)
+                     for profile in profiles]
 
-            Exporter('all', profile).export()
-            res_dfs[profile] = AnkiProfile(profile,
-                                           options['max_delete_count']).sync()
+        if options['workers'] <= 1:
+            results = [sync_profile(*x) for x in args_list]
+        else:
+            # The forked workers must not share the connections of this process
+            connections.close_all()
+            # Forked: the workers inherit the configured Django (settings, apps, logging) of this process
+            with ProcessPoolExecutor(max_workers=min(options['workers'], len(profiles)),
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(sync_profile, *zip(*args_list)))
+
+        res_dfs = {profile: res_df for profile, res_df, _, _ in results if res_df is not None}
+        summary_df = pd.DataFrame([(duration, error or '') for _, _, duration, error in results],
+                                  [profile for profile, *_ in results], ['duration (s)', 'error']).round(1)
+        logger.info(summary_df.to_string())
+        cache.prune(start_time.timestamp())
+
+        # Deletions already applied to all the profiles
+        marks = AnkiSyncMark.objects.filter(profile__in=AnkiProfile.profile_list())
+        if marks.count() == len(AnkiProfile.profile_list()):
+            oldest_mark = marks.aggregate(Min('exported_time'))['exported_time__min']
+            AnkiDeletedNote.objects.filter(deleted_time__lte=oldest_mark).delete()
 
         mail_admins('Anki sync results', '',
                     fail_silently=False,
-                    html_message=pd.concat(res_dfs).to_html())
+                    html_message=(pd.concat(res_dfs).to_html() if res_dfs else '') + summary_df.to_html())
+
+        if failed := [profile for profile, _, _, error in results if error]:
+            raise CommandError(f'Sync failure of the profile(s): {", ".join(failed)}')
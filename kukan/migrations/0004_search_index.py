@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_indexes(apps, schema_editor):
+    from kukan.search import create_search_indexes
+    create_search_indexes(schema_editor.connection)
+
+
+def drop_indexes(apps, schema_editor):
+    from kukan.search import drop_search_indexes
+    drop_search_indexes(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kukan', '0003_auto_20200405_2309'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
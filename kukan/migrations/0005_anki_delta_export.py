@@ -0,0 +1,51 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def create_indexes(apps, schema_editor):
+    # The kotowaza and yoji tables are rebuilt by SQLite to add the column, which drops the triggers of their index
+    from kukan.search import create_search_indexes
+    create_search_indexes(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kukan', '0004_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kotowaza',
+            name='updated_time',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='変更日付'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='yoji',
+            name='updated_time',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='変更日付'),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='AnkiSyncMark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('profile', models.CharField(max_length=50, unique=True, verbose_name='プロフィール')),
+                ('exported_time', models.DateTimeField(verbose_name='エクスポート日付')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnkiDeletedNote',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=50)),
+                ('note_key', models.CharField(max_length=20)),
+                ('deleted_time', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'deleted_time'], name='kukan_ankid_model_046b93_idx')],
+            },
+        ),
+        migrations.RunPython(create_indexes, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,15 @@
-import itertools as it
+import collections
 import json
 import logging
 import random
 import re
+import threading
 
 import markdown
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
-from django.db.models import Max
+from django.db.models import F, Max
+from django.db.models.signals import post_delete, post_save
 from django.urls import reverse
 from django.utils.functional import cached_property
 
@@ -24,7 +26,7 @@ class Classification(models.Model):
         return self.classification
 
 
-@QuickGetKey('yomi_joyo')
+@QuickGetKey('yomi_joyo', cached=True)
 class YomiJoyo(models.Model):
     yomi_joyo = models.CharField('常用漢字表', max_length=5)
 
@@ -32,7 +34,7 @@ class YomiJoyo(models.Model):
         return self.yomi_joyo
 
 
-@QuickGetKey('yomi_type')
+@QuickGetKey('yomi_type', cached=True)
 class YomiType(models.Model):
     yomi_type = models.CharField('読み種別', max_length=1)
 
@@ -41,7 +43,7 @@ class YomiType(models.Model):
 
 
 @OrderFromAttr('difficulty')
-@QuickGetKey('kyu')
+@QuickGetKey('kyu', cached=True)
 class Kanken(models.Model):
     kyu = models.CharField('漢字検定', max_length=3)
     difficulty = models.IntegerField()
@@ -139,6 +141,13 @@ class Kanji(models.Model):
                                  + str(self.jitai['std'][1].kanji) + '</a>'])
         return list_fld
 
+    @staticmethod
+    def prefetch_jukuji():
+        """Prefetch of the data of get_jukuji, for a list of kanji"""
+        return models.Prefetch('exmap_set', to_attr='jukuji_exmaps',
+                               queryset=ExMap.objects.filter(in_joyo_list=True, is_ateji=True)
+                               .select_related('example').order_by('example'))
+
     @cached_property
     def jitai(self):
         jitai_dict = {}
@@ -152,8 +161,13 @@ class Kanji(models.Model):
 
     def get_jukuji(self):
         list_jukuji = []
-        maps = ExMap.objects.filter(kanji=self.kanji, in_joyo_list=True, is_ateji=True)
-        for jk_ex in self.example_set.filter(exmap__in=maps):
+        if hasattr(self, 'jukuji_exmaps'):
+            # Prefetched (Kanji.prefetch_jukuji)
+            jukuji_examples = [x.example for x in self.jukuji_exmaps]
+        else:
+            maps = ExMap.objects.filter(kanji=self.kanji, in_joyo_list=True, is_ateji=True)
+            jukuji_examples = self.example_set.filter(exmap__in=maps)
+        for jk_ex in jukuji_examples:
             jk = jk_ex.word
             word = re.sub(r'（.*', '', jk)
             # TODO: just to be able to do the comparison with old data
@@ -172,6 +186,57 @@ class Kanji(models.Model):
         return res
 
 
+class KanjiKankenMap:
+    """
+    In-memory map kanji -> Kanken id, to get the kanken of a word without query (with the Kanken cache of qget_pk).
+    Built at the first use, updated on the post_save / post_delete signals of Kanji (bulk updates and other processes
+    are not seen: clear() to reload).
+    For read paths only: the kanken saved with a word is computed from the database (query_max_kanken), the map may
+    be stale after a change of another process.
+    """
+    def __init__(self):
+        self._map = None
+        self._lock = threading.Lock()
+        post_save.connect(self.on_save, sender=Kanji, weak=False, dispatch_uid='kanji_kanken_map')
+        post_delete.connect(self.on_delete, sender=Kanji, weak=False, dispatch_uid='kanji_kanken_map')
+
+    def get_map(self):
+        with self._lock:
+            if self._map is None:
+                self._map = dict(Kanji.objects.values_list('kanji', 'kanken_id'))
+            return self._map
+
+    def clear(self):
+        with self._lock:
+            self._map = None
+
+    def on_save(self, instance, **kwargs):
+        with self._lock:
+            if self._map is not None:
+                self._map[instance.kanji] = instance.kanken_id
+
+    def on_delete(self, instance, **kwargs):
+        with self._lock:
+            if self._map is not None:
+                self._map.pop(instance.kanji, None)
+
+    def __contains__(self, kanji):
+        return kanji in self.get_map()
+
+    def get_max_kanken(self, word):
+        """Kanken of the word (highest Kanken id of its kanji, as an aggregate Max('kanken'))"""
+        kanken_map = self.get_map()
+        return Kanken.qget_pk(max((kanken_map[x] for x in word if x in kanken_map), default=None))
+
+    @staticmethod
+    def query_max_kanken(word):
+        """Same as get_max_kanken, from the database"""
+        return Kanken.qget_pk(Kanji.objects.filter(kanji__in=word).aggregate(Max('kanken'))['kanken__max'])
+
+
+kanji_kanken_map = KanjiKankenMap()
+
+
 class KanjiDetails(models.Model):
     kanji = models.OneToOneField(Kanji, on_delete=models.CASCADE, verbose_name='漢字')
     meaning = models.TextField('意味', max_length=1000, blank=True)
@@ -256,11 +321,21 @@ class Reading(models.Model):
         return list_ex
 
     def get_list_ex_anki(self):
-        list_ex = "、".join(map(Example.goo_link,
-                               Example.objects.filter(exmap__reading=self,
-                                                      exmap__in_joyo_list=True)))
+        if hasattr(self, 'anki_exmaps'):
+            # Prefetched (Reading.prefetch_ex_anki)
+            examples = [x.example for x in self.anki_exmaps]
+        else:
+            examples = Example.objects.filter(exmap__reading=self, exmap__in_joyo_list=True)
+        list_ex = "、".join(map(Example.goo_link, examples))
         return list_ex
 
+    @staticmethod
+    def prefetch_ex_anki():
+        """Prefetch of the data of get_list_ex_anki, for a list of readings"""
+        return models.Prefetch('exmap_set', to_attr='anki_exmaps',
+                               queryset=ExMap.objects.filter(in_joyo_list=True)
+                               .select_related('example').order_by('example'))
+
     def is_joyo(self):
         return self.joyo.yomi_joyo != '表外'
 
@@ -270,6 +345,7 @@ class Kotowaza(models.Model):
     yomi = models.CharField('読み方', max_length=100, blank=True)
     furigana = models.CharField('振り仮名', max_length=200, blank=True)
     definition = models.CharField('諺の意味', max_length=10000, blank=True)
+    updated_time = models.DateTimeField('変更日付', auto_now=True)
 
     def __str__(self):
         return '{1} - {0}'.format(self.kotowaza, self.pk)
@@ -364,19 +440,38 @@ class Example(models.Model):
                 if Example.objects.filter(word=self.word, yomi=self.yomi, ex_kind=self.ex_kind).exists():
                     raise ValidationError('この言葉は既に登録されている。')
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, update_kanken=True, **kwargs):
+        """
+        :param update_kanken: False when the kanken was already set from the kanji and readings of the word
+        """
         self.validate_unique()
-        kanken = Kanken.objects.get(id=Kanji.objects.filter(kanji__in=self.word).
-                                    aggregate(Max('kanken'))['kanken__max'])
-        # Any example with 表外 reading is at least 準一級
-        if (self.pk is not None
-                and kanken.difficulty < Kanken.objects.get(kyu='準１級').difficulty
-                and Reading.objects.filter(exmap__example__pk=self.pk, joyo__yomi_joyo='表外').exists()):
-            kanken = Kanken.objects.get(kyu='準１級')
-        self.kanken = kanken
+        if update_kanken:
+            kanken = kanji_kanken_map.query_max_kanken(self.word)
+            # Any example with 表外 reading is at least 準一級
+            if (self.pk is not None
+                    and kanken.difficulty < Kanken.qget('準１級').difficulty
+                    and Reading.objects.filter(exmap__example__pk=self.pk, joyo__yomi_joyo='表外').exists()):
+                kanken = Kanken.qget('準１級')
+            self.kanken = kanken
 
         super().save(*args, **kwargs)
 
+    @staticmethod
+    def get_word_kanken(kanji_kanken_ids, has_hyogai):
+        """
+        Same result as Example.save, without query
+        :param kanji_kanken_ids: Kanken id of the kanji of the word, from the database
+        :param has_hyogai: True if one of the readings of the word is 表外
+        """
+        # Highest id, as the aggregate of Example.save
+        kanken = Kanken.qget_pk(max(kanji_kanken_ids, default=None))
+        # Any example with 表外 reading is at least 準一級
+        if has_hyogai:
+            jun_1kyu = Kanken.qget('準１級')
+            if kanken.difficulty < jun_1kyu.difficulty:
+                kanken = jun_1kyu
+        return kanken
+
     def get_absolute_url(self):
         return reverse('kukan:example_detail', kwargs={'pk': self.pk})
 
@@ -410,11 +505,9 @@ class Example(models.Model):
         return markdown.markdown(self.definition2)
 
     def is_hyogai(self):
-        return ((Kanken.objects.get(id=Kanji.objects.filter(kanji__in=self.word).
-                                    aggregate(Max('kanken'))['kanken__max'])
-                 <= Kanken.objects.get(kyu='２級'))
+        return ((kanji_kanken_map.get_max_kanken(self.word) <= Kanken.qget('２級'))
                 and
-                (self.kanken >= Kanken.objects.get(kyu='準１級')))
+                (Kanken.qget_pk(self.kanken_id) >= Kanken.qget('準１級')))
 
     @transaction.atomic
     def create_exmap(self, reading_selected: list):
@@ -423,11 +516,12 @@ class Example(models.Model):
         :param reading_selected: list of Reading ID, in the order of the kanji of the word.
                 "Ateji_<kanji>" can be used as well. Example: "1245, Ateji_宴"
         """
-
-        self.save()
+        word_native = self.get_word_native()
+        kanjis = dict(Kanji.objects.filter(kanji__in=set(word_native) | set(self.word))
+                      .values_list('kanji', 'kanken_id'))
 
         # Filter out all characters not in the Kanji database (Kana, ...)
-        word = [x for x in self.get_word_native() if Kanji.objects.filter(kanji=x).exists()]
+        word = [x for x in word_native if x in kanjis]
 
         if len(word) != len(reading_selected):
             logger.error(f'Kanji and reading number mismatch for {self}({self.pk}); '
@@ -436,67 +530,72 @@ class Example(models.Model):
             raise AssertionError('Reading number mismatch')
 
         # Ensure we're not trying to change readings of a Joyo Kanji
-        joyo_exmaps = ExMap.objects.filter(example=self, in_joyo_list=True).order_by('map_order')
-        joyo_exmaps_per_order = {x.map_order: x for x in joyo_exmaps}
-        try:
-            for joyo_exmap in joyo_exmaps:
-                i = joyo_exmap.map_order
-                if joyo_exmap.is_ateji:
-                    reading_match = reading_selected[i] == f'Ateji_{joyo_exmap.kanji}'
-                else:
-                    reading_match = reading_selected[i] == str(joyo_exmap.reading.id)
-                if not (joyo_exmap.kanji.kanji == word[i] and reading_match):
-                    raise AssertionError
-        except (AssertionError, IndexError):
-            logger.error(f'Trying to modify a Joyo reading for {self}({self.pk}); '
-                         f'word: {word}, reading_selected: {reading_selected}')
-            raise AssertionError('Existing Joyo reading cannot be modified')
+        exmaps = list(ExMap.objects.filter(example=self)) if self.pk is not None else []
+        joyo_exmaps_per_order = {x.map_order: x for x in exmaps if x.in_joyo_list}
+        for i, joyo_exmap in sorted(joyo_exmaps_per_order.items()):
+            if joyo_exmap.is_ateji:
+                reading_match = i < len(word) and reading_selected[i] == f'Ateji_{joyo_exmap.kanji_id}'
+            else:
+                reading_match = i < len(word) and reading_selected[i] == str(joyo_exmap.reading_id)
+            if not (reading_match and joyo_exmap.kanji_id == word[i]):
+                logger.error(f'Trying to modify a Joyo reading for {self}({self.pk}); '
+                             f'word: {word}, reading_selected: {reading_selected}')
+                raise AssertionError('Existing Joyo reading cannot be modified')
 
-        map_list = []
-        for map_order, (kj, reading) in enumerate(zip(word, reading_selected)):
-            kanji = Kanji.qget(kj)
+        readings = Reading.objects.select_related('joyo').in_bulk(
+            [int(x) for x in reading_selected if x[:6] != 'Ateji_'])
 
-            if map_order in joyo_exmaps_per_order.keys():
+        # (kanji, reading, map_order, is_ateji, in_joyo_list) of the expected maps
+        expected = []
+        for map_order, (kj, reading) in enumerate(zip(word, reading_selected)):
+            if map_order in joyo_exmaps_per_order:
                 ex_map = joyo_exmaps_per_order[map_order]
+                expected.append((ex_map.kanji_id, ex_map.reading_id, map_order, ex_map.is_ateji, True))
             elif reading[:6] == 'Ateji_':
-                ex_map, create = self.exmap_set.get_or_create(kanji=kanji,
-                                                              example=self,
-                                                              map_order=map_order,
-                                                              is_ateji=True,
-                                                              in_joyo_list=False)
+                expected.append((kj, None, map_order, True, False))
             else:
-                ex_map, create = self.exmap_set.get_or_create(kanji=kanji,
-                                                              reading=Reading.objects.get(kanji=kj, id=reading),
-                                                              example=self,
-                                                              map_order=map_order,
-                                                              is_ateji=False,
-                                                              in_joyo_list=False)
-            map_list.append(ex_map.id)
-
-        # Delete the maps not relevant anymore
-        ExMap.objects.filter(example=self).exclude(id__in=map_list).delete()
-
-        # Save again to trigger the update of the Kyu done part of Example.save (issue #27)
-        self.save()
+                if int(reading) not in readings or readings[int(reading)].kanji_id != kj:
+                    raise Reading.DoesNotExist(f'No reading {reading} for {kj}')
+                expected.append((kj, int(reading), map_order, False, False))
+
+        # Kanken update done by Example.save (issue #27), from the maps about to be saved
+        has_hyogai = any(readings[x[1]].joyo.yomi_joyo == '表外' for x in expected if x[1] is not None)
+        self.kanken = self.get_word_kanken([kanjis[x] for x in self.word if x in kanjis], has_hyogai)
+        self.save(update_kanken=False)
+
+        existing = {(x.kanji_id, x.reading_id, x.map_order, x.is_ateji, x.in_joyo_list): x.id for x in exmaps}
+        # Delete the maps not relevant anymore, and create the missing ones
+        obsolete = [pk for key, pk in existing.items() if key not in expected]
+        obsolete += [x.id for x in exmaps if x.id not in existing.values()]  # Duplicates
+        if obsolete:
+            ExMap.objects.filter(id__in=obsolete).delete()
+        ExMap.objects.bulk_create([ExMap(example=self, kanji_id=kanji, reading_id=reading, map_order=map_order,
+                                         is_ateji=is_ateji, in_joyo_list=in_joyo_list)
+                                   for kanji, reading, map_order, is_ateji, in_joyo_list in expected
+                                   if (kanji, reading, map_order, is_ateji, in_joyo_list) not in existing])
+
         logger.info(f'Modified {self}({self.pk}) with reading_selected: {reading_selected}')
 
     @staticmethod
-    def find_yomi_pk(word, yomi):
+    def find_yomi_pk(word, yomi, find_all=False):
         """
         Given a word (kanji) and its yomi (kana), return a matching combination a Reading IDs.
         The first matching combination is returned, which could lead to incorrect answer in rare case.
 
         :param word: word in kanji
         :param yomi: its reading in Kana
+        :param find_all: return the list of all the matching combinations instead
         :return: list of Reading objects ids, which lead to the word / yomi
         """
-        data = []
         yomi = yomi.translate(jau.hir2kat).replace('・', '')
-        for candidate in it.product(*filter(None, (Reading.objects.filter(kanji=kj) for kj in word))):
-            if ''.join([re.sub('[（）]', '', r.reading.translate(jau.hir2kat)) for r in candidate]) == yomi:
-                data = [r.id for r in candidate]
-                break
-        return data
+        readings = collections.defaultdict(list)
+        for pk, kanji, reading in Reading.objects.filter(kanji__in=set(word)).values_list('id', 'kanji', 'reading'):
+            readings[kanji].append((pk, re.sub('[（）]', '', reading.translate(jau.hir2kat))))
+        # Characters without reading (kana...) are ignored
+        data = jau.find_reading_combinations([readings[kj] for kj in word if readings[kj]], yomi, find_all)
+        if find_all:
+            return data
+        return data[0] if data else []
 
 
 class ExMap(models.Model):
@@ -538,13 +637,13 @@ class Yoji(models.Model):
     external_ref = models.CharField('外部辞典', max_length=1000, blank=True)
     in_anki = models.BooleanField('日課', default=False)
     anki_cloze = models.CharField('Cloze sequence', max_length=4, blank=True)
+    updated_time = models.DateTimeField('変更日付', auto_now=True)
 
     def __str__(self):
         return self.yoji
 
     def save(self, *args, **kwargs):
-        self.kanken = Kanken.objects.get(id=Kanji.objects.filter(kanji__in=self.yoji).
-                                         aggregate(Max('kanken'))['kanken__max'])
+        self.kanken = kanji_kanken_map.query_max_kanken(self.yoji)
         # Only create the cloze pattern once
         if self.anki_cloze == '':
             idx_list = ["11", "22"]
@@ -603,3 +702,63 @@ class TestResult(models.Model):
 
     def __str__(self):
         return '{} {} {} - {}'.format(self.name, self.kanken.kyu, self.test_number, self.date)
+
+
+class AnkiSyncMark(models.Model):
+    """High-water mark of the Anki export of a profile: start time of the last successful sync"""
+    profile = models.CharField('プロフィール', max_length=50, unique=True)
+    exported_time = models.DateTimeField('エクスポート日付')
+
+    def __str__(self):
+        return f'{self.profile} - {self.exported_time}'
+
+
+class AnkiDeletedNote(models.Model):
+    """Example / Yoji deleted from the database, whose note is to be deleted from Anki by the delta export"""
+    model = models.CharField(max_length=50)
+    note_key = models.CharField(max_length=20)
+    deleted_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'deleted_time']),
+        ]
+
+    def __str__(self):
+        return f'{self.model} - {self.note_key}'
+
+    @staticmethod
+    def on_delete(sender, instance, **kwargs):
+        AnkiDeletedNote.objects.create(model=getattr(sender, '_meta').label, note_key=str(instance.pk))
+
+
+for _model in [Example, Yoji]:
+    post_delete.connect(AnkiDeletedNote.on_delete, sender=_model, dispatch_uid=f'anki_deleted_note_{_model.__name__}')
+
+
+class TableVersion(models.Model):
+    """
+    Version of a table, incremented on the post_save / post_delete signals of its model: changes made by other
+    processes are seen without scanning the table (bulk updates are not seen)
+    """
+    table = models.CharField(max_length=100, primary_key=True)
+    version = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.table} - {self.version}'
+
+    @classmethod
+    def get_version(cls, model):
+        return cls.objects.filter(table=getattr(model, '_meta').label).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls, sender, **kwargs):
+        table = getattr(sender, '_meta').label
+        if not cls.objects.filter(table=table).update(version=F('version') + 1):
+            cls.objects.bulk_create([cls(table=table, version=1)], ignore_conflicts=True)
+
+
+# Connected before the receivers reading the version (kukan.yomi_index)
+for _model in [Reading, Yoji]:
+    for _signal in [post_save, post_delete]:
+        _signal.connect(TableVersion.bump, sender=_model, dispatch_uid=f'table_version_{_model.__name__}')
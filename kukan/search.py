@@ -0,0 +1,159 @@
+"""
+SQLite FTS5 (trigram) search indexes, used instead of a LIKE '%text%' scan for the substring searches (field__contains)
+"""
+import logging
+import sqlite3
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models.expressions import RawSQL
+
+from .models import Example, Kotowaza, Yoji
+
+logger = logging.getLogger(__name__)
+
+
+def is_supported(conn):
+    """FTS5 with the trigram tokenizer requires SQLite 3.34"""
+    if conn.vendor != 'sqlite' or sqlite3.sqlite_version_info < (3, 34, 0):
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return 'ENABLE_FTS5' in [x[0] for x in cursor.fetchall()]
+
+
+class SearchIndex:
+    """
+    FTS5 table indexing text fields of a model, kept in sync by triggers on the model table:
+        - Integer primary key: external content table (the text is not duplicated), with the pk as rowid
+        - Other primary key (implicit rowid, renumbered by VACUUM): the pk is stored as an unindexed column
+
+    Django drops the triggers when it rebuilds the model table in a migration: the index is recreated after the
+    migrations (repair_search_indexes), and not used while a trigger is missing.
+    """
+    # A trigram index cannot search shorter strings
+    min_length = 3
+
+    def __init__(self, model, fields):
+        meta = getattr(model, '_meta')
+        self.model = model
+        self.fields = fields
+        self.columns = [meta.get_field(x).column for x in fields]
+        self.table = meta.db_table
+        self.index_table = f'{self.table}_fts'
+        self.pk_column = meta.pk.column
+        self.external_content = meta.pk.get_internal_type() in ['AutoField', 'BigAutoField', 'IntegerField']
+        self.triggers = [f'{self.index_table}_{x}' for x in ['ai', 'ad', 'au']]
+        self._available = None
+
+    def get_create_sql(self):
+        idx, pk = self.index_table, self.pk_column
+        cols = ', '.join(self.columns)
+        new_cols = ', '.join(f'new.{x}' for x in self.columns)
+        old_cols = ', '.join(f'old.{x}' for x in self.columns)
+        if self.external_content:
+            create = (f"CREATE VIRTUAL TABLE {idx} USING fts5({cols}, content='{self.table}', content_rowid='{pk}', "
+                      f"tokenize='trigram')")
+            insert = f'INSERT INTO {idx}(rowid, {cols}) VALUES (new.{pk}, {new_cols});'
+            delete = f"INSERT INTO {idx}({idx}, rowid, {cols}) VALUES ('delete', old.{pk}, {old_cols});"
+            populate = f"INSERT INTO {idx}({idx}) VALUES ('rebuild')"
+        else:
+            create = f"CREATE VIRTUAL TABLE {idx} USING fts5({pk} UNINDEXED, {cols}, tokenize='trigram')"
+            insert = f'INSERT INTO {idx}({pk}, {cols}) VALUES (new.{pk}, {new_cols});'
+            delete = f'DELETE FROM {idx} WHERE {pk} = old.{pk};'
+            populate = f'INSERT INTO {idx}({pk}, {cols}) SELECT {pk}, {cols} FROM {self.table}'
+
+        return [
+            create,
+            f'CREATE TRIGGER {idx}_ai AFTER INSERT ON {self.table} BEGIN {insert} END',
+            f'CREATE TRIGGER {idx}_ad AFTER DELETE ON {self.table} BEGIN {delete} END',
+            f'CREATE TRIGGER {idx}_au AFTER UPDATE OF {pk}, {cols} ON {self.table} BEGIN {delete} {insert} END',
+            populate,
+        ]
+
+    def get_drop_sql(self):
+        return [f'DROP TRIGGER IF EXISTS {x}' for x in self.triggers] + [f'DROP TABLE IF EXISTS {self.index_table}']
+
+    def create(self, cursor):
+        """(Re)create the index and its triggers, and index the current rows"""
+        for sql in self.get_drop_sql() + self.get_create_sql():
+            cursor.execute(sql)
+        self._available = None
+
+    def drop(self, cursor):
+        for sql in self.get_drop_sql():
+            cursor.execute(sql)
+        self._available = None
+
+    def get_missing(self, conn):
+        """Missing index table and triggers"""
+        names = [self.index_table] + self.triggers
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT name FROM sqlite_master WHERE name IN ({', '.join(['%s'] * len(names))})", names)
+            existing = {x[0] for x in cursor.fetchall()}
+        return [x for x in names if x not in existing]
+
+    def is_available(self):
+        if self._available is None:
+            missing = self.get_missing(connection) if connection.vendor == 'sqlite' else [self.index_table]
+            if missing and self.index_table not in missing:
+                # Out of sync index
+                logger.warning(f'Missing triggers {missing}: substring searches without index '
+                               f'(run the rebuild_search_index command)')
+            self._available = not missing
+        return self._available
+
+    def filter(self, qry, field, text):
+        """Equivalent of qry.filter(<field>__contains=text), through the index when possible"""
+        if field not in self.fields or len(text) < self.min_length or not self.is_available():
+            return qry.filter(**{f'{field}__contains': text})
+
+        column = self.columns[self.fields.index(field)]
+        match = '{{{}}} : "{}"'.format(column, text.replace('"', '""'))
+        key = 'rowid' if self.external_content else self.pk_column
+        return qry.filter(pk__in=RawSQL(f'SELECT {key} FROM {self.index_table} WHERE {self.index_table} MATCH %s',
+                                        [match]))
+
+
+search_indexes = {
+    Example: SearchIndex(Example, ['word', 'sentence', 'definition']),
+    Kotowaza: SearchIndex(Kotowaza, ['kotowaza', 'definition']),
+    Yoji: SearchIndex(Yoji, ['meaning']),
+}
+
+
+def filter_contains(qry, field, text):
+    """qry.filter(<field>__contains=text), using the search index of the model if any"""
+    index = search_indexes.get(qry.model)
+    if index is None:
+        return qry.filter(**{f'{field}__contains': text})
+    return index.filter(qry, field, text)
+
+
+def create_search_indexes(conn):
+    if not is_supported(conn):
+        logger.warning('SQLite FTS5 trigram not supported: substring searches without index')
+        return
+    with conn.cursor() as cursor:
+        for index in search_indexes.values():
+            index.create(cursor)
+
+
+def drop_search_indexes(conn):
+    if conn.vendor != 'sqlite':
+        return
+    with conn.cursor() as cursor:
+        for index in search_indexes.values():
+            index.drop(cursor)
+
+
+def repair_search_indexes(using=DEFAULT_DB_ALIAS, **kwargs):
+    """post_migrate: recreate the indexes whose triggers were dropped by a migration rebuilding the model table"""
+    conn = connections[using]
+    if not is_supported(conn):
+        return
+    with conn.cursor() as cursor:
+        for index in search_indexes.values():
+            missing = index.get_missing(conn)
+            if missing and index.index_table not in missing:
+                logger.warning(f'Missing triggers {missing}: {index.index_table} recreated')
+                index.create(cursor)
@@ -1,8 +1,7 @@
 import json
 from django import template
 from django.utils.safestring import mark_safe
-from kukan.jautils import JpnText, kat2hir
-import re
+from kukan.jautils import JpnText, kat2hir, furigana_display_pattern
 
 register = template.Library()
 
@@ -37,24 +36,21 @@ def add_furigana(plain_text, furigana_text):
 def furigana_ruby(sentence):
     """Add furigana as Ruby HTML on top of text"""
 
-    res = mark_safe(re.sub(r'\[(.*?)\|(.*?)\|f\]', '<ruby>{}<rt>{}</rt></ruby>'.format(r'\1', r'\2'), sentence))
-    return res
+    return mark_safe(furigana_display_pattern.sub(lambda m: f'<ruby>{m[1]}<rt>{m[2]}</rt></ruby>', sentence))
 
 
 @register.filter(is_safe=True)
 def furigana_remove(sentence):
     """Remove furigana, display as simple text"""
 
-    res = re.sub(r'\[(.*?)\|(.*?)\|f\]', '{}'.format(r'\1'), sentence)
-    return res
+    return furigana_display_pattern.sub(lambda m: m[1], sentence)
 
 
 @register.filter(is_safe=True)
 def furigana_bracket(sentence):
     """Display furigana inside brackets"""
 
-    res = re.sub(r'\[(.*?)\|(.*?)\|f\]', '{}({})'.format(r'\1', r'\2'), sentence)
-    return res
+    return furigana_display_pattern.sub(lambda m: f'{m[1]}({m[2]})', sentence)
 
 
 @register.inclusion_tag('inclusion/single_field.html')
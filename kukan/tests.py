@@ -1,32 +1,53 @@
 import csv
 import itertools as it
 import json
+import math
 import os
+import random
 import re
+import tempfile
+import threading
 import urllib.parse
 from collections import Counter, namedtuple
 from io import StringIO
+from multiprocessing import connection
 from unittest.mock import mock_open, patch, MagicMock
 
+import pandas as pd
 import requests
 from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
 from django.contrib.auth.models import User
+from django.db import connection as db_connection
 from django.db.models import Count, Q
 from django.http import QueryDict
+from django.template.loader import get_template
 from django.test import Client
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
+from kukan.anki_dj import AnkiProfile
 from kukan.apps import kukanConfig
-from kukan.exporting import Exporter
+from kukan.exporting import Exporter, ExporterAsResp, ExportCache
 from kukan.forms import ExampleForm, KotowazaForm
-from kukan.jautils import JpnText, hir2kat
-from kukan.jautils import kat2hir
-from kukan.models import Kanji, Example, Reading, ExMap, Kanken, YomiJoyo, Kotowaza, Bushu
+from kukan.jautils import JpnText, hir2kat, TokenizerConnectionPool, TokenCache, Token, TokenizerError
+from kukan.jautils import kat2hir, find_reading_combinations
+from kukan.management.commands.sync_anki import Command as SyncAnkiCommand
+from kukan.filters import FBushu, FGenericCheckbox, FYomi, FYomiSimple
+from kukan.models import Kanji, Example, Reading, ExMap, Kanken, YomiJoyo, YomiType, Kotowaza, Bushu, Yoji, KoukiBushu, \
+    AnkiSyncMark, TableVersion, kanji_kanken_map
 from kukan.onlinepedia import DefinitionKanjipedia
+from kukan.search import filter_contains, repair_search_indexes, search_indexes
+from kukan.yomi_index import reading_index, YomiIndex
+from kukan.views import TableData
 from kukan.templatetags.ja_tags import furigana_ruby, furigana_remove, furigana_bracket, furigana_html
 from kukan.test_helpers import FixtureAppLevel, FixtureKukan, FixWebKukan, PatchRequestsGet
 from kukan.test_helpers import FixtureKanji
+from utilskanji.janome_daemon import TokenizerServer
 
 # Override SECURE_SSL_REDIRECT to avoid redirection of non-secured requests
 settings.SECURE_SSL_REDIRECT = False
@@ -227,6 +248,22 @@ class FuriganaTest(TestCase):
                 jpn_text = JpnText.from_text(sentence, expected_yomi=expected_yomi)
                 self.assertListEqual(expected_errors, jpn_text.get_furigana_errors())
 
+    def test_from_texts(self):
+        texts = ['身体は芭蕉の如し', '漢字', '', '漢字']
+        with patch.object(JpnText.LightTokenizer, 'tokenize_batch',
+                          wraps=JpnText.LightTokenizer.tokenize_batch) as mock_batch:
+            res = JpnText.from_texts(texts, ['しんたいはばしょうのごとし', 'かん', None, None])
+            mock_batch.assert_called_once_with(texts)
+        self.assertEqual(['[身体|しんたい|f]は[芭蕉|ばしょう|f]の[如|ごと|f]し', '[漢字|かんじ|f]', '', '[漢字|かんじ|f]'],
+                         [x.furigana() for x in res])
+        self.assertEqual([[], ['推測振り仮名と元の読み方が合致しない'], [], []], [x.get_furigana_errors() for x in res])
+
+        with patch('kukan.jautils.JpnText.LightTokenizer.tokenize_batch') as mock_batch:
+            mock_batch.return_value = [[MagicMock(surface='お身体', reading='カラダ')]]
+            jpn_text = JpnText.from_texts(['お身体'])[0]
+            self.assertEqual('お身体', jpn_text.furigana())
+            self.assertEqual(['振り仮名を推測出来ない: 「お身体」'], jpn_text.get_furigana_errors())
+
     def test_guess_furigana_error_kanji(self):
         with patch('kukan.jautils.JpnText.LightTokenizer.tokenize') as mock_tokenize:
             mock_tokenize.return_value = [MagicMock(surface='身体', reading='カラダ')]
@@ -263,6 +300,142 @@ class FuriganaTest(TestCase):
                 self.assertEqual(expected_result, furigana_html(*args))
 
 
+class TestTokenizerService(TestCase):
+    def setUp(self):
+        self.server = TokenizerServer(('localhost', 0), b'test_key', tokenizer=JpnText.LightTokenizer.full_tokenizer)
+        ready = threading.Event()
+        self.server_thread = threading.Thread(target=self.server.serve_forever, args=(ready,), daemon=True)
+        self.server_thread.start()
+        ready.wait(5)
+        self.pool = TokenizerConnectionPool(self.server.address, b'test_key', max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        self.server_thread.join(5)
+
+    def test_batch(self):
+        res = self.pool.request(('batch', ['お世話', '', '漢字']))
+        self.assertEqual([[('お世話', 'オセワ')], [], [('漢字', 'カンジ')]], res)
+
+    def test_connection_reused(self):
+        with patch('kukan.jautils.Client', wraps=connection.Client) as mock_client:
+            for _ in range(3):
+                self.pool.request(('batch', ['漢字']))
+            self.assertEqual(1, mock_client.call_count)
+
+    def test_concurrent_clients(self):
+        results = {}
+
+        def worker(idx):
+            results[idx] = self.pool.request(('batch', ['漢字'] * idx))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(1, 6)]
+        list(map(threading.Thread.start, threads))
+        list(map(threading.Thread.join, threads))
+        self.assertEqual({i: [[('漢字', 'カンジ')]] * i for i in range(1, 6)}, results)
+
+    def test_stale_connection(self):
+        self.pool.request(('batch', ['漢字']))
+        # Simulate a daemon restart: the idle connection is closed on the server side
+        stale = self.pool._idle.get_nowait()
+        stale.close()
+        self.pool._idle.put_nowait(stale)
+        self.assertEqual([[('漢字', 'カンジ')]], self.pool.request(('batch', ['漢字'])))
+
+    def test_invalid_request(self):
+        with connection.Client(self.server.address, authkey=b'test_key') as conn:
+            conn.send(['漢字'])
+            self.assertEqual(b'Error: invalid request', conn.recv())
+
+    def test_error_reply(self):
+        with self.assertRaisesRegex(TokenizerError, 'invalid request'):
+            self.pool.request(['漢字'])
+        with patch.object(self.server.tokenizer, 'tokenize', side_effect=ValueError('broken dictionary')):
+            with self.assertRaisesRegex(TokenizerError, 'broken dictionary'):
+                self.pool.request(('batch', ['漢字']))
+        # The connection is still usable
+        self.assertEqual([[('漢字', 'カンジ')]], self.pool.request(('batch', ['漢字'])))
+
+    def test_error_reply_light_tokenizer(self):
+        # Fake daemon answering every request with an error
+        with connection.Listener(('localhost', 0), authkey=b'test_key') as listener:
+            def serve():
+                with listener.accept() as conn:
+                    conn.recv()
+                    conn.send(b'Error: out of memory')
+
+            server_thread = threading.Thread(target=serve, daemon=True)
+            server_thread.start()
+            pool = TokenizerConnectionPool(listener.address, b'test_key')
+            with patch.object(JpnText.LightTokenizer, 'full_tokenizer', None), \
+                    patch.object(JpnText.LightTokenizer, 'pool', pool), \
+                    patch.object(JpnText.LightTokenizer, 'cache', TokenCache()):
+                with self.assertRaisesRegex(TokenizerError, 'Tokenizer daemon: Error: out of memory'):
+                    JpnText.LightTokenizer.tokenize_batch(['漢字'])
+            server_thread.join(5)
+            pool.close()
+
+    def test_from_text_through_pool(self):
+        with patch('kukan.jautils.JpnText.LightTokenizer.full_tokenizer', None), \
+                patch('kukan.jautils.JpnText.LightTokenizer.pool', self.pool):
+            jpn_text = JpnText.from_text('ご飯に差し支えない様に')
+            self.assertEqual('ご[飯|はん|f]に[差し支|さしつか|f]えない[様|よう|f]に', jpn_text.furigana())
+            self.assertEqual([['漢字'], ['お世話']],
+                             [[t.surface for t in tokens]
+                              for tokens in JpnText.LightTokenizer.tokenize_batch(['漢字', 'お世話'])])
+
+
+class TestTokenCache(TestCase):
+    def test_lru(self):
+        cache = TokenCache(max_size=2)
+        cache.put('一', [Token('一', 'イチ')])
+        cache.put('二', [Token('二', 'ニ')])
+        self.assertEqual([Token('一', 'イチ')], cache.get('一'))
+        cache.put('三', [Token('三', 'サン')])
+        self.assertIsNone(cache.get('二'))
+        self.assertEqual([Token('一', 'イチ')], cache.get('一'))
+        self.assertEqual({'size': 2, 'hits': 2, 'db_hits': 0, 'misses': 1}, cache.stats())
+
+    def test_invalidate(self):
+        cache = TokenCache()
+        cache.put('一', [Token('一', 'イチ')])
+        cache.put('二', [Token('二', 'ニ')])
+        cache.invalidate(['一'])
+        self.assertIsNone(cache.get('一'))
+        self.assertIsNotNone(cache.get('二'))
+        cache.invalidate()
+        self.assertIsNone(cache.get('二'))
+
+    def test_sqlite_tier(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'token_cache.sqlite3')
+            TokenCache(db_path=db_path).put('漢字', [Token('漢字', 'カンジ')])
+
+            # A new process (empty memory tier) finds the entry on disk, but only for the same version
+            cache = TokenCache(db_path=db_path)
+            self.assertEqual([Token('漢字', 'カンジ')], cache.get('漢字'))
+            self.assertEqual([Token('漢字', 'カンジ')], cache.get('漢字'))
+            self.assertEqual({'size': 1, 'hits': 1, 'db_hits': 1, 'misses': 0}, cache.stats())
+            self.assertIsNone(TokenCache(db_path=db_path, version='other').get('漢字'))
+
+            cache.invalidate()
+            self.assertIsNone(TokenCache(db_path=db_path).get('漢字'))
+            cache._db.close()
+
+    def test_from_text_uses_cache(self):
+        with patch('kukan.jautils.JpnText.LightTokenizer.cache', TokenCache()) as cache, \
+                patch.object(JpnText.LightTokenizer.full_tokenizer, 'tokenize',
+                             wraps=JpnText.LightTokenizer.full_tokenizer.tokenize) as mock_tokenize:
+            for _ in range(3):
+                self.assertEqual('[漢字|かんじ|f]の[勉強|べんきょう|f]', JpnText.from_text('漢字の勉強').furigana())
+            self.assertEqual(1, mock_tokenize.call_count)
+            self.assertEqual({'size': 1, 'hits': 2, 'db_hits': 0, 'misses': 1}, cache.stats())
+
+            JpnText.LightTokenizer.tokenize_batch(['漢字の勉強', '勉強', '勉強'])
+            self.assertEqual(2, mock_tokenize.call_count)
+
+
 class ModelTest(TestCase):
     fixtures = ['baseline', '閲']
 
@@ -283,6 +456,44 @@ class ModelTest(TestCase):
         self.assertEqual(example.kanken, Kanken.objects.get(kyu='準１級'))
 
 
+class TestCheckFurigana(TestCase):
+    fixtures = ['baseline', '閲', '覧']
+
+    def setUp(self):
+        Kotowaza.objects.create(kotowaza='一竿の風月', yomi='いっかんのふうげつ', furigana='[一竿|いっかん|f]の[風月|ふうげつ|f]')
+        Kotowaza.objects.create(kotowaza='一竿の風月', yomi='いっかんのふうげつ', furigana='[一竿|いっかん|f]の[風月|ふう|f]')
+        Kotowaza.objects.create(kotowaza='風月', yomi='ふうげつ')
+        Kotowaza.objects.create(kotowaza='身体', yomi='からだ')
+        Example.objects.create(word='閲覧', yomi='エツラン', sentence='資料を[閲覧|えつらん|f]する', is_joyo=False)
+        Example.objects.create(word='覧', yomi='ラン', sentence='[お閲|かな|f]覧', is_joyo=False)
+        Example.objects.create(word='閲', yomi='エツ', sentence='[閲覧|けみ|f]', is_joyo=False)
+        Example.objects.create(word='覧閲', yomi='ランエツ', sentence='閲覧', is_joyo=False)
+
+    def call_check_furigana(self, *args):
+        with StringIO() as out:
+            call_command('check_furigana', *args, stdout=out)
+            return out.getvalue().splitlines()
+
+    def test_check(self):
+        k = list(Kotowaza.objects.order_by('pk'))
+        ex = list(Example.objects.order_by('pk'))
+        for args in [['--chunk_size', '1'], ['--chunk_size', '500']]:
+            with self.subTest(args=args):
+                self.assertEqual([
+                    f'Kotowaza {k[1].pk} 「[一竿|いっかん|f]の[風月|ふう|f]」: 推測振り仮名と元の読み方が合致しない',
+                    f'Kotowaza {k[3].pk} 「身体」: 推測振り仮名と元の読み方が合致しない',
+                    f'Example {ex[1].pk} 「[お閲|かな|f]覧」: origin [お閲] does not match furigana [かな]',
+                    f'Example {ex[2].pk} 「閲覧|けみ」: 推測振り仮名と元の読み方が合致しない',
+                    'Checked 7 rows: 4 with errors, 0 furigana saved',
+                ], self.call_check_furigana(*args))
+        self.assertEqual('', Kotowaza.objects.get(kotowaza='風月').furigana)
+
+    def test_fix(self):
+        self.assertEqual('Checked 7 rows: 4 with errors, 1 furigana saved', self.call_check_furigana('--fix')[-1])
+        self.assertEqual('[風月|ふうげつ|f]', Kotowaza.objects.get(kotowaza='風月').furigana)
+        self.assertEqual('', Kotowaza.objects.get(kotowaza='身体').furigana)
+
+
 class ExampleFormTest(TestCase):
     fixtures = ['baseline', '閲', '覧', '斌', '劉', '遥']
 
@@ -529,6 +740,25 @@ class ExampleFormTest(TestCase):
                 self.assertEqual(200, response.status_code)
                 self.assertEqual(expected, response.json())
 
+    def test_find_yomi_pk(self):
+        with self.assertNumQueries(1):
+            self.assertEqual([7463, 6422, 7463, 6422], Example.find_yomi_pk('閲覧閲覧', 'えつらんえつらん'))
+        self.assertEqual([[7463, 6422]], Example.find_yomi_pk('閲覧', 'エツ・ラン', find_all=True))
+        self.assertEqual([], Example.find_yomi_pk('閲覧', 'エツミ', find_all=True))
+
+    def test_find_reading_combinations(self):
+        rnd = random.Random(0)
+        kana = 'アイウエオカキ'
+        for _ in range(200):
+            candidates = [[(f'{pos}-{i}', ''.join(rnd.choices(kana, k=rnd.randint(1, 3))))
+                           for i in range(rnd.randint(1, 6))] for pos in range(rnd.randint(0, 4))]
+            yomi = ''.join(rnd.choice(x)[1] for x in candidates)
+            expected = [[key for key, _ in x] for x in it.product(*candidates) if ''.join(r for _, r in x) == yomi]
+            with self.subTest(candidates=candidates, yomi=yomi):
+                self.assertEqual(expected, find_reading_combinations(candidates, yomi, find_all=True))
+                self.assertEqual(expected[:1], find_reading_combinations(candidates, yomi))
+                self.assertEqual([], find_reading_combinations(candidates, yomi + 'ン'))
+
     def test_duplicate_kanji(self):
         expected_error = '漢字「閲」は単語「閲覧」以外では使えない。(\'x\'で無視可)'
 
@@ -739,6 +969,241 @@ class TestExport(TestCase):
                              'Kakitori\t書き取り\t2\t"<span class=""font-color01"">テイショ</span>"\t汀渚[汀渚]\t準１級\r\n',
                              out.getvalue())
 
+    def test_export_as_response(self):
+        with StringIO() as out:
+            Exporter('anki_kaki', 'Fred').export_anki_kaki(csv.writer(out, delimiter='\t', quotechar='"'))
+            expected = out.getvalue()
+        response = ExporterAsResp('anki_kaki', 'Fred', streaming=False).export()
+        self.assertEqual(expected, response.content.decode())
+
+        # Nothing fetched before the response is iterated, then the rows come one by one
+        with self.assertNumQueries(0):
+            response = ExporterAsResp('anki_kaki', 'Fred').export()
+        self.assertTrue(response.streaming)
+        self.assertEqual('attachment; filename="dj_anki_kaki.csv"', response['Content-Disposition'])
+        content = iter(response.streaming_content)
+        first_row = next(content).decode()
+        self.assertEqual(expected.splitlines(keepends=True)[0], first_row)
+        self.assertEqual(expected, first_row + b''.join(content).decode())
+
+    def test_export_queries(self):
+        def count_queries():
+            res = {}
+            for kind in ['all', 'anki_kanji']:
+                with patch('builtins.open', mock_open()) as m, CaptureQueriesContext(db_connection) as queries:
+                    Exporter(kind, 'Fred').export()
+                res[kind] = (len(queries), ''.join(x.args[0] for x in m().write.mock_calls))
+            return res
+
+        # Loaded before open is mocked (cached template loader)
+        get_template('kukan/AnkiReadTable.html')
+        kanji_kanken_map.get_map()
+        Kanken.qget('準１級')
+        before = count_queries()
+
+        # Examples of all kinds, with joyo readings and jukuji for the kanji export, kotowaza and yoji
+        for kj in self.kanji_per_kyu[:4]:
+            reading = Reading.objects.filter(kanji=kj).first()
+            self.create_example_all_kinds([(kj, reading.reading_simple)])
+        ExMap.objects.update(in_joyo_list=True)
+        ExMap.objects.filter(kanji='一').update(is_ateji=True)
+        kotowaza = Kotowaza.objects.create(kotowaza='一竿の風月', yomi='いっかんのふうげつ',
+                                           furigana='[一竿|いっかん|f]の[風月|ふうげつ|f]')
+        Example.objects.create(word='一竿', yomi='イッカン', kotowaza=kotowaza, is_joyo=False,
+                               ex_kind=Example.KOTOWAZA)
+        Yoji.objects.create(yoji='一万一丈', reading='いちまんいちじょう', in_anki=True)
+        Yoji.objects.create(yoji='一万丁丁', reading='いちまんちょうちょう', in_anki=True)
+
+        after = count_queries()
+        # all: yoji (2), kaki (alt kanji, examples), yomi (alt kanji, examples), kotowaza
+        # anki_kanji: kanji, readings, examples of the readings, jukuji
+        self.assertEqual({'all': 7, 'anki_kanji': 4}, {kind: res[0] for kind, res in after.items()})
+        for kind in ['all', 'anki_kanji']:
+            with self.subTest(kind=kind):
+                self.assertGreater(len(after[kind][1]), len(before[kind][1]))
+                self.assertEqual(before[kind][0], after[kind][0])
+
+    def test_export_kanji_chunks(self):
+        get_template('kukan/AnkiReadTable.html')
+        for kj in self.kanji_per_kyu[:4]:
+            reading = Reading.objects.filter(kanji=kj).first()
+            self.create_example_all_kinds([(kj, reading.reading_simple)])
+        ExMap.objects.update(in_joyo_list=True)
+        nb_kanji = Kanji.objects.exclude(kanken__difficulty__gt=10).count()
+        expected = list(Exporter.rows_anki_kanji())
+
+        # Kanji query, then readings, examples of the readings and jukuji for each chunk
+        with patch.object(Exporter, 'chunk_size', 2), CaptureQueriesContext(db_connection) as queries:
+            self.assertEqual(expected, list(Exporter.rows_anki_kanji()))
+        self.assertGreater(nb_kanji, 2)
+        self.assertEqual(1 + 3 * math.ceil(nb_kanji / 2), len(queries))
+
+    def test_export_delta(self):
+        def export_delta(kind, since):
+            with tempfile.TemporaryDirectory() as out_dir:
+                Exporter(kind, 'Fred', out_dir=out_dir, since=since).export()
+                with open(os.path.join(out_dir, f'dj_{kind}.csv'), encoding='utf-8') as f:
+                    rows = [x.split('\t')[2] for x in f.read().splitlines()[len(Exporter.header_rows):]]
+                with open(os.path.join(out_dir, f'dj_{kind}_deleted.csv'), encoding='utf-8') as f:
+                    deleted = f.read().split()
+            return rows, deleted
+
+        kotowaza = Kotowaza.objects.create(kotowaza='一竿の風月', yomi='いっかんのふうげつ',
+                                           furigana='[一竿|いっかん|f]の[風月|ふうげつ|f]')
+        ex_kotowaza = Example.objects.create(word='一竿', yomi='イッカン', kotowaza=kotowaza, is_joyo=False,
+                                             ex_kind=Example.KOTOWAZA)
+        for yoji in ['一万一丈', '一万丁丁', '並乏且串', '久久一丈']:
+            Yoji.objects.create(yoji=yoji, reading='よじ', in_anki=True)
+        ex_1, ex_2 = Example.objects.filter(yomi='テイショ')
+        ex_2_pk = str(ex_2.pk)
+        since = timezone.now()
+        self.assertEqual(([], []), export_delta('anki_kaki', since))
+
+        ex_1.save()
+        ex_2.delete()
+        ex_3 = Example.objects.create(word=ex_1.word, yomi='テイショ', sentence=ex_1.word + '。', is_joyo=False,
+                                      ex_kind=Example.TAIGI)
+        ex_4 = Example.objects.create(word=ex_1.word, yomi='テイショ', sentence='', is_joyo=False,
+                                      ex_kind=Example.RUIGI)  # Not exported: no sentence
+        self.assertEqual(([str(ex_1.pk), str(ex_3.pk)], sorted([ex_2_pk, str(ex_4.pk)])),
+                         export_delta('anki_kaki', since))
+        # Not exported anymore
+        ex_1.definition = 'kaki'
+        ex_1.save()
+        self.assertEqual(([str(ex_3.pk)], sorted([str(ex_1.pk), ex_2_pk, str(ex_4.pk)])),
+                         export_delta('anki_kaki', since))
+
+        # Kotowaza changed
+        self.assertEqual(([], []), export_delta('anki_kotowaza', timezone.now()))
+        since = timezone.now()
+        kotowaza.save()
+        self.assertEqual(([str(ex_kotowaza.pk)], []), export_delta('anki_kotowaza', since))
+
+        # Yoji with the same first or second half
+        since = timezone.now()
+        Yoji.objects.get(yoji='一万丁丁').save()
+        self.assertEqual((['一万一丈', '一万丁丁'], []), export_delta('anki_yoji', since))
+        Yoji.objects.get(yoji='一万丁丁').delete()
+        self.assertEqual((['一万一丈'], ['一万丁丁']), export_delta('anki_yoji', since))
+        since = timezone.now()
+        yoji = Yoji.objects.get(yoji='久久一丈')
+        yoji.in_anki = False
+        yoji.save()
+        self.assertEqual((['一万一丈'], ['久久一丈']), export_delta('anki_yoji', since))
+
+        # Too many changed yoji: all exported
+        since = timezone.now()
+        Yoji.objects.get(yoji='一万一丈').save()
+        Yoji.objects.get(yoji='並乏且串').save()
+        self.assertEqual((['一万一丈', '並乏且串'], ['久久一丈']), export_delta('anki_yoji', since))
+        Yoji.objects.create(yoji='丁丁丁丁', reading='よじ', in_anki=True)
+        Yoji.objects.filter(yoji='丁丁丁丁').update(updated_time=since)
+        with patch.object(Exporter, 'max_changed_yoji', 1):
+            self.assertEqual((['一万一丈', '並乏且串', '丁丁丁丁'], ['久久一丈']), export_delta('anki_yoji', since))
+
+    def test_export_cache(self):
+        def export(profile, cache, since=None):
+            with tempfile.TemporaryDirectory() as out_dir:
+                Exporter('all', profile, out_dir=out_dir, since=since, cache=cache).export()
+                files = {}
+                for name in sorted(os.listdir(out_dir)):
+                    with open(os.path.join(out_dir, name), encoding='utf-8') as f:
+                        files[name] = f.read()
+            return files
+
+        Yoji.objects.create(yoji='一万一丈', reading='よじ', in_anki=True)
+        Example.objects.create(word='一丈', yomi='イチジョウ', sentence='一丈の布。', is_joyo=False,
+                               ex_kind=Example.KAKI)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ExportCache('run_1', cache_dir)
+            with patch.object(Exporter, 'get_rows', autospec=True, side_effect=Exporter.get_rows) as get_rows:
+                for profile in ['Fred', 'Ayumi']:
+                    with self.subTest(profile=profile):
+                        self.assertEqual(export(profile, None), export(profile, cache))
+                # Generated once for both profiles (and the direct exports)
+                self.assertEqual(2 * 4 + 4, get_rows.call_count)
+            self.assertNotEqual(export('Fred', cache)['dj_anki_kaki.csv'], export('Ayumi', cache)['dj_anki_kaki.csv'])
+            since = timezone.now()
+            self.assertEqual(export('Fred', None, since), export('Fred', cache, since))
+
+            # Next run: only the decks whose tables are unchanged are reused
+            cache = ExportCache('run_2', cache_dir)
+            with patch.object(Exporter, 'get_rows', autospec=True, side_effect=Exporter.get_rows) as get_rows:
+                export('Fred', cache)
+                self.assertEqual(['anki_kaki', 'anki_yomi'], sorted(x.args[1] for x in get_rows.call_args_list))
+                Yoji.objects.create(yoji='一万丁丁', reading='よじ', in_anki=True)
+                self.assertIn('一万丁丁', export('Fred', cache)['dj_anki_yoji.csv'])
+
+            before = os.path.getmtime(os.path.join(cache_dir, os.listdir(cache_dir)[0])) + 3600
+            cache.prune(before)
+            self.assertEqual([], os.listdir(cache_dir))
+
+    def test_delete_missing_notes(self):
+        kotowaza = Kotowaza.objects.create(kotowaza='一竿の風月', yomi='いっかんのふうげつ',
+                                           furigana='[一竿|いっかん|f]の[風月|ふうげつ|f]')
+        Example.objects.create(word='一竿', yomi='イッカン', kotowaza=kotowaza, is_joyo=False, ex_kind=Example.KOTOWAZA)
+        Yoji.objects.create(yoji='一万一丈', reading='よじ', in_anki=True)
+        with tempfile.TemporaryDirectory() as import_dir:
+            Exporter('all', 'Fred', out_dir=import_dir).export()
+            profile = AnkiProfile('Fred', max_delete_count=5, import_dir=import_dir)
+            df_web_side = pd.concat([profile.read_anki_csv(profile.get_deck_import_file(deck))
+                                     for deck in profile.profile['decks']], ignore_index=True)
+            # Notes in Anki: the exported ones, a deleted example and a note of a deck not synced
+            df_anki_export_all = pd.concat([df_web_side, pd.DataFrame([['Kakitori', '書き取り', '99999'],
+                                                                       ['Basic', 'Other', '99999']])],
+                                           ignore_index=True).astype(str)
+            df_anki_export_all.insert(0, 'guid', [f'g{i}' for i in range(len(df_anki_export_all))])
+            df_anki_export_all.columns = [0, 1, 2, 3]
+            profile.col = MagicMock()
+            profile.col.db.all.return_value = [(f'g{i}', 100 + i) for i in range(len(df_anki_export_all))]
+
+            deleted = profile.delete_missing_notes(df_anki_export_all)
+
+        self.assertEqual({'四字熟語': 0, '書き取り': 1, '読み': 0, '諺': 0}, deleted)
+        profile.col.remove_notes.assert_called_once_with([100 + len(df_web_side)])
+        profile.col.db.all.assert_called_once()
+
+    def test_sync_anki_error_isolation(self):
+        def sync(profile, delta=False):
+            if profile.name == 'Ayumi':
+                raise ValueError('Collection locked')
+            self.assertTrue(os.path.exists(os.path.join(profile.import_dir, 'dj_anki_kaki.csv')))
+            return pd.DataFrame('-', ['書き取り'], ['added', 'updated', 'deleted', 'unchanged'])
+
+        with tempfile.TemporaryDirectory() as import_dir, \
+                self.settings(ANKI_IMPORT_DIR=import_dir, ANKI_EXPORT_CACHE_DIR=os.path.join(import_dir, 'cache'),
+                              ADMINS=[('Admin', 'admin@dom.com')]), \
+                patch.object(AnkiProfile, 'sync', autospec=True, side_effect=sync):
+            with self.assertRaisesRegex(CommandError, 'Ayumi'):
+                SyncAnkiCommand().handle_cmd(profile='Ayumi Fred', max_delete_count=5, delta=False, workers=1)
+
+        self.assertEqual(['Fred'], list(AnkiSyncMark.objects.values_list('profile', flat=True)))
+        html, = [x.alternatives[0][0] for x in mail.outbox if x.subject.endswith('Anki sync results')]
+        self.assertIn('書き取り', html)
+        self.assertIn('duration (s)', html)
+        self.assertIn('ValueError: Collection locked', html)
+
+    def test_sync_anki_workers(self):
+        def sync(profile, delta=False):
+            if profile.name == 'Ayumi':
+                raise ValueError('Collection locked')
+            self.assertTrue(os.path.exists(os.path.join(profile.import_dir, 'dj_anki_kaki.csv')))
+            return pd.DataFrame('-', ['書き取り'], ['added', 'updated', 'deleted', 'unchanged'])
+
+        # Profiles synced by forked workers (mocks and settings inherited), each in its own directory
+        with tempfile.TemporaryDirectory() as import_dir, \
+                self.settings(ANKI_IMPORT_DIR=import_dir, ANKI_EXPORT_CACHE_DIR=os.path.join(import_dir, 'cache'),
+                              ADMINS=[('Admin', 'admin@dom.com')]), \
+                patch.object(AnkiProfile, 'sync', autospec=True, side_effect=sync):
+            with self.assertRaisesRegex(CommandError, 'Ayumi'):
+                SyncAnkiCommand().handle_cmd(profile='Ayumi Fred', max_delete_count=5, delta=False, workers=2)
+            for profile in ['Ayumi', 'Fred']:
+                self.assertTrue(os.path.exists(os.path.join(import_dir, profile, 'dj_anki_kaki.csv')))
+
+        html, = [x.alternatives[0][0] for x in mail.outbox if x.subject.endswith('Anki sync results')]
+        self.assertIn('書き取り', html)
+        self.assertIn('ValueError: Collection locked', html)
+
     def test_export_kaki(self):
         with patch('builtins.open', mock_open()) as m:
             Exporter('anki_kaki', 'Fred').export()
@@ -970,6 +1435,276 @@ class TestFilters(TestCase):
         self.assertEqual("'{}'".format('Test%20%22%23%24%25%26%27%28%29%22'), search_obj[0][7:-2])
 
 
+class TestSearchIndex(TestCase):
+    fixtures = ['baseline', '閲', '覧']
+
+    def setUp(self):
+        self.ex1 = Example.objects.create(word='閲覧', yomi='エツラン', sentence='資料を閲覧する', is_joyo=False,
+                                          definition='書物などを調べ読むこと。"Browse"')
+        self.ex2 = Example.objects.create(word='閲する', yomi='ケミスル', sentence='膨大な資料を閲する', is_joyo=False)
+
+    def assertSearch(self, expected, model, field, text):
+        qry = filter_contains(model.objects.all(), field, text)
+        self.assertEqual(set(expected), set(qry))
+        self.assertEqual(set(model.objects.filter(**{f'{field}__contains': text})), set(qry))
+        return str(qry.query)
+
+    def test_search(self):
+        self.assertTrue(all(x.is_available() for x in search_indexes.values()))
+        self.assertIn('MATCH', self.assertSearch([self.ex1, self.ex2], Example, 'sentence', '資料を'))
+        self.assertSearch([self.ex1], Example, 'definition', '"browse"')
+        self.assertSearch([self.ex2], Example, 'sentence', '膨大な資料を閲')
+        self.assertSearch([], Example, 'word', '閲覧する')
+        # Too short for trigrams, or field not indexed
+        self.assertNotIn('MATCH', self.assertSearch([self.ex1, self.ex2], Example, 'word', '閲'))
+        self.assertNotIn('MATCH', self.assertSearch([self.ex2], Example, 'yomi', 'ケミス'))
+
+    def test_sync(self):
+        self.ex1.sentence = '図書館で本を閲覧する'
+        self.ex1.save()
+        self.assertSearch([self.ex2], Example, 'sentence', '資料を')
+        self.assertSearch([self.ex1], Example, 'sentence', '図書館')
+        self.ex2.delete()
+        self.assertSearch([], Example, 'sentence', '資料を')
+
+        kotowaza = Kotowaza.objects.create(kotowaza='百聞は一見に如かず', definition='自分の目で確かめるほうが確実')
+        self.assertSearch([kotowaza], Kotowaza, 'kotowaza', '一見に')
+        yoji = Yoji.objects.create(yoji='閲覧覧閲', reading='えつらんらんえつ', meaning='一生に一度の出会い')
+        self.assertSearch([yoji], Yoji, 'meaning', '一度の')
+        Yoji.objects.filter(pk='閲覧覧閲').update(meaning='茶会の心得')
+        self.assertSearch([], Yoji, 'meaning', '一度の')
+        self.assertSearch([yoji], Yoji, 'meaning', '茶会の')
+
+    def test_rebuild(self):
+        call_command('rebuild_search_index')
+        self.assertSearch([self.ex1, self.ex2], Example, 'sentence', '資料を')
+
+    def test_missing_trigger(self):
+        # Trigger dropped by a migration rebuilding the table
+        index = search_indexes[Example]
+        with db_connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER kukan_example_fts_au')
+        with patch.object(index, '_available', None), self.assertLogs('kukan.search', 'WARNING') as logs:
+            self.ex1.sentence = '図書館で本を閲覧する'
+            self.ex1.save()
+            self.assertNotIn('MATCH', self.assertSearch([self.ex1], Example, 'sentence', '図書館'))
+        self.assertIn('kukan_example_fts_au', logs.output[0])
+
+        # Recreated after the migrations
+        with self.assertLogs('kukan.search', 'WARNING'):
+            repair_search_indexes()
+        self.assertEqual([], index.get_missing(db_connection))
+        self.assertTrue(index.is_available())
+        self.assertIn('MATCH', self.assertSearch([self.ex1], Example, 'sentence', '図書館'))
+
+    def test_views(self):
+        User.objects.create_user('test_user', password='pwd')
+        self.client.post('/login/', {'username': 'test_user', 'password': 'pwd'})
+        response = self.client.get('/example/list/', {'ajax': 1, 'page': 1, 'sort_by': 'kanken', '意味': '調べ読'})
+        self.assertEqual(1, response.json()['total_results'])
+        response = self.client.get('/ajax/get_similar_word/', {'word': '閲する', 'ex_id': ''})
+        self.assertIn('（1件）', response.json()['info_similar_word'][0])
+
+
+class TestYomiIndex(TestCase):
+    fixtures = ['baseline', '閲', '覧', '斌', '劉', '遥']
+
+    def assertSameAsSql(self, flt, value, qry):
+        with patch('kukan.filters.max_in_list', -1):
+            expected = set(flt.add_to_query(value, qry))
+        result = flt.add_to_query(value, qry)
+        self.assertEqual(expected, set(result))
+        return result
+
+    def test_fyomi(self):
+        qry = Kanji.objects.all()
+        for yomi, position, onkun, joyo in it.product(['え', 'エツ', 'はる', 'ら', ''], ['位始', '位含', '位全'],
+                                                      ['読両', '読音', '読訓'], ['常全', '常用', '常外']):
+            with self.subTest(yomi=yomi, position=position, onkun=onkun, joyo=joyo):
+                self.assertSameAsSql(FYomi(), f'{yomi}_{position}_{onkun}_{joyo}', qry)
+        self.assertEqual({'閲'}, {x.kanji for x in self.assertSameAsSql(FYomi(), 'えつ_位全_読両_常全', qry)})
+
+    def test_fyomi_simple(self):
+        Yoji.objects.create(yoji='閲覧覧閲', reading='えつらんらんえつ')
+        Yoji.objects.create(yoji='遥覧', reading='ようらん')
+        for yomi, position in it.product(['えつ', 'らん', 'えつらんらんえつ', 'ラ', 'ん'], ['位始', '位含', '位全']):
+            with self.subTest(yomi=yomi, position=position):
+                self.assertSameAsSql(FYomiSimple('reading'), f'{yomi}_{position}', Yoji.objects.all())
+
+    def test_incremental(self):
+        reading_index.search('', YomiIndex.START)
+        kanji = Kanji.objects.get(kanji='閲')
+        with patch.object(reading_index, 'rebuild') as mock_rebuild:
+            reading = Reading.objects.create(kanji=kanji, reading='ためし', joyo_order=10,
+                                             yomi_type=YomiType.objects.get(yomi_type='訓'),
+                                             joyo=YomiJoyo.objects.get(yomi_joyo='表外'))
+            self.assertEqual([(reading.pk, ('閲', '訓', '表外'))], reading_index.search('ため', YomiIndex.START))
+            reading.reading = 'こころみ'
+            reading.save()
+            self.assertEqual([], reading_index.search('ため', YomiIndex.CONTAINS))
+            self.assertIn(reading.pk, [x[0] for x in reading_index.search('ころみ', YomiIndex.CONTAINS)])
+            reading.delete()
+            self.assertEqual([], reading_index.search('こころみ', YomiIndex.EXACT))
+            mock_rebuild.assert_not_called()
+
+        # Changes of another process: only the version is bumped (by its signals), rebuild
+        Reading.objects.bulk_create([Reading(kanji=kanji, reading='ためし', reading_simple='ためし', joyo_order=10,
+                                             yomi_type=YomiType.objects.get(yomi_type='訓'),
+                                             joyo=YomiJoyo.objects.get(yomi_joyo='表外'))])
+        TableVersion.bump(Reading)
+        self.assertEqual(1, len(reading_index.search('ためし', YomiIndex.EXACT)))
+        Reading.objects.filter(reading_simple='ためし').update(reading_simple='ためす')
+        TableVersion.bump(Reading)
+        self.assertEqual([], reading_index.search('ためし', YomiIndex.EXACT))
+        self.assertEqual(1, len(reading_index.search('ためす', YomiIndex.EXACT)))
+
+        # Change of another process between a change of this process and its signal
+        reading = Reading.objects.get(reading_simple='ためす')
+        TableVersion.bump(Reading)
+        reading.delete()
+        with patch.object(reading_index, 'rebuild', wraps=reading_index.rebuild) as mock_rebuild:
+            self.assertEqual([], reading_index.search('ためす', YomiIndex.EXACT))
+            mock_rebuild.assert_called_once()
+
+    def test_search_queries(self):
+        reading_index.search('', YomiIndex.START)
+        with self.assertNumQueries(1):  # Version of the table
+            reading_index.search('えつ', YomiIndex.EXACT)
+
+
+class TestFilterMetadata(TestCase):
+    fixtures = ['baseline']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_checkbox(self):
+        flt = FGenericCheckbox('漢検', 'kanken__kyu', Example, order='-kanken__difficulty')
+        labels = [x['label'] for x in json.loads(flt.get_cached_extra_json())['elements']]
+        with self.assertNumQueries(0):
+            flt.to_json()
+
+        # Same filter in another view: same cache
+        with self.assertNumQueries(0):
+            FGenericCheckbox('漢検', 'kanken__kyu', Example, order='-kanken__difficulty').to_json()
+
+        # Related model saved: metadata recomputed
+        Kanken.objects.create(kyu='新', difficulty=0)
+        with self.assertNumQueries(1):
+            self.assertEqual(labels, [x['label'] for x in json.loads(flt.get_cached_extra_json())['elements']])
+
+    def test_bushu(self):
+        flt = FBushu()
+        self.assertEqual({'min': None, 'max': None}, json.loads(flt.get_cached_extra_json())['kakusu'])
+        bushu = KoukiBushu.objects.create(bushu='一', variations='', reading='いち', number=1, kakusu=1)
+        self.assertEqual({'min': 1, 'max': 1}, json.loads(flt.get_cached_extra_json())['kakusu'])
+        with self.assertNumQueries(0):
+            flt.to_json()
+        bushu.delete()
+        self.assertEqual([], json.loads(flt.get_cached_extra_json())['listBushu'])
+
+
+class TestKanjiDetail(TestCase):
+    fixtures = ['baseline', '閲', '覧']
+
+    def setUp(self):
+        User.objects.create_user('test_user', password='pwd')
+        self.client = Client()
+        self.client.post('/login/', {'username': 'test_user', 'password': 'pwd'})
+
+    def add_examples(self, start, stop):
+        for i in range(start, stop):
+            Example.objects.create(word=f'閲{i}', yomi='エツ', sentence=f'資料を閲する{i}', is_joyo=False)
+            Example.objects.create(word=f'閲覧{i}', yomi='エツラン', sentence=f'閲覧{i}', is_joyo=False,
+                                   ex_kind=Example.KOTOWAZA)
+
+    def get_detail(self):
+        with CaptureQueriesContext(db_connection) as queries:
+            response = self.client.get(reverse('kukan:kanji_detail', args='閲'))
+        self.assertEqual(200, response.status_code)
+        return {x['name']: x for x in json.loads(response.context_data['ctx'])}, len(queries)
+
+    def test_related_lookups(self):
+        self.assertEqual((['kanken'], []), TableData.get_related_lookups(Example, ['word', 'kanken', 'ex_num']))
+        self.assertEqual((['kanken'], ['bunrui']), TableData.get_related_lookups(Yoji, ['kanken', 'bunrui__bunrui']))
+        self.assertEqual((['kanji__kanken', 'yomi_type'], []),
+                         TableData.get_related_lookups(Reading, ['kanji', 'kanji__kanken__kyu', 'yomi_type']))
+
+    def test_query_count(self):
+        self.add_examples(0, 2)
+        ctx, nb_queries = self.get_detail()
+        self.assertEqual({'例文', '諺'}, set(ctx))
+        self.assertEqual(2, ctx['例文']['number'])
+        self.assertEqual(2, len(ctx['諺']['table_data']['data']))
+        self.assertEqual('３級', ctx['例文']['table_data']['data'][0]['kanken'])
+
+        self.add_examples(2, 20)
+        ctx, nb_queries_more = self.get_detail()
+        self.assertEqual(20, ctx['例文']['number'])
+        self.assertEqual(20, len(ctx['諺']['table_data']['data']))
+        self.assertEqual(nb_queries, nb_queries_more)
+
+
+class TestAjaxList(TestCase):
+    fixtures = ['baseline', '閲', '覧']
+
+    def setUp(self):
+        User.objects.create_user('test_user', password='pwd')
+        self.client = Client()
+        self.client.post('/login/', {'username': 'test_user', 'password': 'pwd'})
+
+    def get_list(self, url, sort_by, page=1, clear_cache=True):
+        if clear_cache:
+            # Total count and page boundaries of KeysetPaginator
+            cache.clear()
+        with CaptureQueriesContext(db_connection) as queries:
+            response = self.client.get(url, {'ajax': 1, 'page': page, 'sort_by': sort_by})
+        self.assertEqual(200, response.status_code)
+        return response.json()['table_data']['data'], len(queries)
+
+    def test_only_fields(self):
+        self.assertEqual((['kanken', 'word'], ['ex_num']),
+                         TableData.get_only_fields(Example, ['word', 'kanken', 'ex_num']))
+        self.assertEqual((['kanken', 'yoji'], []), TableData.get_only_fields(Yoji, ['yoji', 'kanken', 'bunrui__bunrui']))
+        self.assertEqual((['kanji__kanken__kyu', 'reading'], []),
+                         TableData.get_only_fields(Reading, ['reading', 'kanji__kanken__kyu']))
+        # Related object displayed with str(): loaded completely
+        self.assertEqual((['kanji'], []), TableData.get_only_fields(Reading, ['kanji', 'kanji__kanken__kyu']))
+
+    def test_query_count(self):
+        for i in range(2):
+            Example.objects.create(word=f'閲{i}', yomi='エツ', sentence=f'資料を閲する{i}', is_joyo=False)
+        data, nb_queries = self.get_list('/example/list/', 'kanken')
+        self.assertEqual(2, len(data))
+        self.assertEqual('３級', data[0]['kanken'])
+
+        for i in range(2, 30):
+            Example.objects.create(word=f'閲{i}', yomi='エツ', sentence=f'資料を閲する{i}', is_joyo=False)
+        data, nb_queries_more = self.get_list('/example/list/', 'kanken')
+        self.assertEqual(20, len(data))
+        self.assertEqual(nb_queries, nb_queries_more)
+
+    def test_keyset_pagination(self):
+        for i in range(45):
+            Example.objects.create(word=f'閲{i}', yomi='エツ', sentence=f'資料を閲する{i}', is_joyo=False)
+        for sort_by in ['kanken', '-updated_time', 'word']:
+            with self.subTest(sort_by=sort_by):
+                tie_breaker = '-pk' if sort_by.startswith('-') else 'pk'
+                expected = [x.word for x in Example.objects.order_by(sort_by, tie_breaker)]
+                pages = [self.get_list('/example/list/', sort_by, page, clear_cache=page == 1)[0]
+                         for page in [1, 2, 3]]
+                self.assertEqual(expected, [re.sub('<.*?>', '', x['word']) for page in pages for x in page])
+        response = self.client.get('/example/list/', {'ajax': 1, 'page': 4, 'sort_by': 'word'})
+        self.assertEqual(0, response.json()['total_results'])
+
+    def test_annotation_field(self):
+        example = Example.objects.create(word='閲する', yomi='ケミスル', sentence='膨大な資料を閲する', is_joyo=False)
+        ExMap.objects.create(example=example, kanji=Kanji.objects.get(kanji='閲'), is_ateji=False,
+                             in_joyo_list=False, map_order=0)
+        data, _ = self.get_list('/kanji/list/', 'kanken')
+        self.assertEqual({'閲': '1', '覧': '0'}, {re.sub('<.*?>', '', x['kanji']): x['ex_num'] for x in data})
+
+
 class TestIndexView(TestCase):
     fixtures = ['baseline', '閲', '覧', '斌', '劉', '遥']
 
@@ -1050,6 +1785,95 @@ class TestBushu(TestCase):
         self.assertEqual('匕　(ヒ さじ さじのひ)', str(Bushu.objects.first()))
 
 
+class TestQuickGetKeyCache(TestCase):
+    fixtures = ['baseline']
+
+    def setUp(self):
+        for model in [Kanken, YomiJoyo, YomiType]:
+            model.qclear()
+
+    def test_qget(self):
+        with self.assertNumQueries(1):
+            jun_1kyu = Kanken.qget('準１級')
+        self.assertEqual(jun_1kyu.pk, Kanken.objects.get(kyu='準１級').pk)
+        with self.assertNumQueries(0):
+            self.assertIs(jun_1kyu, Kanken.qget('準１級'))
+            self.assertIs(jun_1kyu, Kanken.qget_pk(jun_1kyu.pk))
+            self.assertLess(Kanken.qget('２級'), jun_1kyu)
+            kankens = Kanken.qall()
+        self.assertEqual([x.pk for x in Kanken.objects.all()], [x.pk for x in kankens])
+        with self.assertRaises(Kanken.DoesNotExist):
+            Kanken.qget('０級')
+        with self.assertRaises(Kanken.DoesNotExist):
+            Kanken.qget_pk(None)
+        with self.assertRaises(YomiJoyo.DoesNotExist):
+            YomiJoyo.qget('表内')
+
+    def test_invalidation(self):
+        yomi_type = YomiType.qget('音')
+        YomiType.objects.create(yomi_type='X')
+        self.assertEqual(YomiType.qget('X').yomi_type, 'X')
+
+        yomi_type.delete()
+        with self.assertRaises(YomiType.DoesNotExist):
+            YomiType.qget('音')
+
+        # Kanken not changed by the save of a related object
+        kanken = Kanken.qget('１０級')
+        Kanji.objects.create(kanji='一', kanken=kanken, strokes=1)
+        with self.assertNumQueries(0):
+            self.assertIs(kanken, Kanken.qget('１０級'))
+
+
+class TestKanjiKankenMap(TestCase):
+    fixtures = ['baseline', '閲', '覧', '斌']
+
+    def setUp(self):
+        kanji_kanken_map.clear()
+        Kanken.qclear()
+
+    def test_get_max_kanken(self):
+        with self.assertNumQueries(2):  # Map and Kanken cache
+            kanken = kanji_kanken_map.get_max_kanken('閲覧')
+        self.assertEqual(kanken.kyu, '３級')
+        with self.assertNumQueries(0):
+            self.assertEqual(kanji_kanken_map.get_max_kanken('閲覧する斌'), Kanken.qget('準１級'))
+            with self.assertRaises(Kanken.DoesNotExist):
+                kanji_kanken_map.get_max_kanken('する')
+
+    def test_kanji_signals(self):
+        kanji_kanken_map.get_map()
+        Kanji.objects.filter(kanji='覧').update(kanken=Kanken.qget('２級'))  # No signal
+        self.assertEqual(kanji_kanken_map.get_max_kanken('閲覧'), Kanken.qget('３級'))
+
+        kanji = Kanji.qget('覧')
+        kanji.save()
+        self.assertEqual(kanji_kanken_map.get_max_kanken('閲覧'), Kanken.qget('２級'))
+        Kanji.objects.create(kanji='一', kanken=Kanken.qget('１級'), strokes=1)
+        self.assertEqual(kanji_kanken_map.get_max_kanken('閲一'), Kanken.qget('１級'))
+        kanji.delete()
+        self.assertNotIn('覧', kanji_kanken_map)
+
+    def test_word_kanken(self):
+        example = Example.objects.create(word='閲覧', is_joyo=False)
+        kanji_kanken_map.get_map()
+        with self.assertNumQueries(0):
+            self.assertFalse(example.is_hyogai())
+        with self.assertNumQueries(2 + 2):  # Kanken of the kanji, insert + TableVersion (created)
+            Yoji.objects.create(yoji='閲覧斌斌', reading='えつらんひんぴん')
+        self.assertEqual(Yoji.objects.get(yoji='閲覧斌斌').kanken, Kanken.qget('準１級'))
+
+    def test_saved_kanken_stale_map(self):
+        # Change made by another process: the map is not updated, the saved kanken is still the current one
+        kanji_kanken_map.get_map()
+        Kanji.objects.filter(kanji='覧').update(kanken=Kanken.qget('２級'))
+        self.assertEqual(kanji_kanken_map.get_max_kanken('閲覧'), Kanken.qget('３級'))
+        example = Example.objects.create(word='閲覧', is_joyo=False)
+        self.assertEqual(Example.objects.get(pk=example.pk).kanken, Kanken.qget('２級'))
+        Yoji.objects.create(yoji='閲覧閲覧', reading='えつらんえつらん')
+        self.assertEqual(Yoji.objects.get(yoji='閲覧閲覧').kanken, Kanken.qget('２級'))
+
+
 class TestExampleCreateExmap(TestCase):
     fixtures = ['baseline', '閲', '覧', '斌', '劉', '遥']
 
@@ -1172,6 +1996,35 @@ class TestExampleCreateExmap(TestCase):
         for test_definition in test_definitions:
             self.run_tests(example, self.TestDef(*test_definition))
 
+    def test_create_exmap_queries(self):
+        example = Example.objects.create(word='閲覧斌', is_joyo=False)
+        reading_selected = self.get_reading_id_from_reading(('エツ', 'ラン', 'ヒン'))
+        Kanken.qget('準１級')  # Cached Kanken
+        # Kanji, existing maps, readings, update of the example, insert of the maps
+        with self.assertNumQueries(5 + 2):  # + savepoint / release
+            example.create_exmap(reading_selected)
+        self.check_database_after_create_exmap(example, '閲覧斌', ('エツ', 'ラン', 'ヒン'))
+        self.assertEqual(Example.objects.get(pk=example.pk).kanken, Kanken.qget('準１級'))  # ヒン is 表外
+
+        # Only the changed map is replaced
+        kept = set(ExMap.objects.filter(map_order__lt=2).values_list('id', flat=True))
+        with self.assertNumQueries(6 + 2):  # + delete of the old map
+            example.create_exmap(reading_selected[:2] + ['Ateji_斌'])
+        self.check_database_after_create_exmap(example, '閲覧斌', ('エツ', 'ラン', 'A斌'))
+        self.assertTrue(kept <= set(ExMap.objects.values_list('id', flat=True)))
+
+        example = Example.objects.create(word='閲する', is_joyo=False)
+        reading_selected = [str(Reading.objects.get(kanji='閲', reading='けみ（する）').id)]
+        with self.assertNumQueries(5 + 2):
+            example.create_exmap(reading_selected)
+        self.assertEqual(Example.objects.get(pk=example.pk).kanken, Kanken.objects.get(kyu='準１級'))
+
+    def test_create_exmap_wrong_reading(self):
+        example = Example.objects.create(word='閲', is_joyo=False)
+        with self.assertRaises(Reading.DoesNotExist):
+            example.create_exmap(self.get_reading_id_from_reading(('ラン',)))
+        self.assertFalse(ExMap.objects.exists())
+
     def test_create_exmap_no_kanji(self):
         # Not really possible to run any test for no kanji case due to following
         with self.assertRaises(Kanken.DoesNotExist):
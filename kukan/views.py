@@ -5,8 +5,9 @@ from functools import reduce
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import FieldDoesNotExist
 from django.core.paginator import Paginator, EmptyPage
-from django.db.models import Count
+from django.db.models import Count, F, Func, OuterRef, Subquery
 from django.http import JsonResponse
 from django.urls import reverse
 from django.urls import reverse_lazy
@@ -18,6 +19,8 @@ from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from kukan.exporting import ExporterAsResp
 from kukan.jautils import JpnText
 from kukan.onlinepedia import DefinitionWordBase
+from kukan.search import filter_contains
+from utils_django.paginator import KeysetPaginator
 from .filters import *
 from .forms import SearchForm, ExampleForm, ExportForm, KotowazaForm
 from .models import Kanji, Reading, Example, ExMap, Yoji, TestResult, Kotowaza
@@ -178,6 +181,88 @@ class TableData:
             if type(fld) is str:
                 fld = {'name': fld}
             self._field_prop_list.append(self.FieldProps(model, fld))
+        field_names = [x.props['field'] for x in self._field_prop_list]
+        self.select_related, self.prefetch_related = self.get_related_lookups(model, field_names)
+        self.only_fields, self.other_fields = self.get_only_fields(model, field_names)
+
+    @staticmethod
+    def get_related_lookups(model, field_names):
+        """
+        select_related / prefetch_related lookups for the relations followed when formatting the fields
+        (e.g. 'kanken' is displayed with str(obj.kanken)), so that the rows are formatted without extra queries
+        """
+        select, prefetch = set(), set()
+        for name in field_names:
+            path = []
+            is_multiple = False
+            current_model = model
+            for part in name.split('__'):
+                try:
+                    fld = getattr(current_model, '_meta').get_field(part)
+                except FieldDoesNotExist:
+                    # Annotation or property
+                    break
+                if not fld.is_relation:
+                    break
+                path.append(part)
+                is_multiple = is_multiple or fld.many_to_many or fld.one_to_many
+                (prefetch if is_multiple else select).add('__'.join(path))
+                current_model = fld.related_model
+
+        def longest_only(lookups):
+            return sorted(x for x in lookups if not any(y.startswith(x + '__') for y in lookups))
+
+        return longest_only(select), longest_only(prefetch)
+
+    @staticmethod
+    def get_only_fields(model, field_names):
+        """
+        Columns to load with only() to format the fields, and the field names which are not model fields
+        (annotations, properties). Related objects displayed with str() are loaded completely.
+        """
+        only, other = set(), set()
+        for name in field_names:
+            path = []
+            current_model = model
+            for part in name.split('__'):
+                try:
+                    fld = getattr(current_model, '_meta').get_field(part)
+                except FieldDoesNotExist:
+                    if path:
+                        # Property of a related object
+                        only.add('__'.join(path))
+                    else:
+                        other.add(name)
+                    break
+                if fld.many_to_many or fld.one_to_many:
+                    # Prefetched, nothing to load on this side
+                    break
+                if not fld.concrete:
+                    other.add(name)
+                    break
+                path.append(part)
+                if not fld.is_relation:
+                    only.add('__'.join(path))
+                    break
+                current_model = fld.related_model
+            else:
+                only.add('__'.join(path))
+
+        # A related object loaded completely does not need its columns listed
+        return sorted(x for x in only if not any(x.startswith(y + '__') for y in only)), sorted(other)
+
+    def optimize_query(self, qry):
+        """
+        Add the related lookups needed by the table to the queryset, and restrict the loaded columns to the displayed
+        fields when all of them are known (model fields or annotations of qry)
+        """
+        if self.select_related:
+            qry = qry.select_related(*self.select_related)
+        if self.prefetch_related:
+            qry = qry.prefetch_related(*self.prefetch_related)
+        if self.only_fields and all(x in qry.query.annotations for x in self.other_fields):
+            qry = qry.only(*self.only_fields)
+        return qry
 
     def get_col_template(self):
         return [x.get_props_dict() for x in self._field_prop_list]
@@ -199,6 +284,9 @@ class AjaxList(LoginRequiredMixin, generic.TemplateView):
     filters = None
     list_title = 'LIST_TITLE'
     is_mobile_card = True
+    # KeysetPaginator for large tables browsed deep
+    paginator_class = Paginator
+    paginate_by = 20
 
     def __init__(self):
         super().__init__()
@@ -216,10 +304,10 @@ class AjaxList(LoginRequiredMixin, generic.TemplateView):
         sort_by = request.GET.get('sort_by', self.default_sort)
         table_data = {'page': int(page), 'sort_by': sort_by, 'columns': '', 'data': []}
         start_time = time.time()
-        qry = self.get_filtered_list(request)
+        qry = self.table_data.optimize_query(self.get_filtered_list(request))
 
         try:
-            p = Paginator(qry.order_by(sort_by), 20, allow_empty_first_page=True)
+            p = self.paginator_class(qry.order_by(sort_by), self.paginate_by, allow_empty_first_page=True)
             table_data.update(self.table_data.get_table_full(p.page(page).object_list))
             end_time = time.time()
             data = {'total_results': p.count, 'table_data': table_data,
@@ -336,6 +424,7 @@ class ExampleList(AjaxList):
     template_name = 'kukan/default_list.html'
     default_sort = 'kanken'
     list_title = '例文'
+    paginator_class = KeysetPaginator
     filters = [
         FGenericString('単語', 'word'),
         FGenericCheckbox('漢検', 'kanken__kyu', model, is_two_column=True, order='-kanken__difficulty'),
@@ -387,6 +476,11 @@ class TestResultList(AjaxList):
     ])
 
 
+def count_subquery(qry):
+    """Correlated subquery counting the rows of qry, to annotate an outer query"""
+    return Subquery(qry.order_by().annotate(nb=Func(F('pk'), function='COUNT')).values('nb'))
+
+
 class KanjiDetail(LoginRequiredMixin, generic.DetailView):
     model = Kanji
     table_data = {'例文': TableData(Example, [
@@ -400,16 +494,32 @@ class KanjiDetail(LoginRequiredMixin, generic.DetailView):
                       'yomi', 'sentence', 'kanken']),
                   }
 
+    @staticmethod
+    def get_category_queries(kanji):
+        """
+        Querysets of each category of table_data
+        :param kanji: kanji character, or OuterRef('kanji') to build subqueries of a Kanji queryset
+        """
+        return {'例文': Example.objects.filter(word__contains=kanji
+                                             ).exclude(sentence='').exclude(ex_kind=Example.KOTOWAZA),
+                '四字熟語': Yoji.objects.filter(yoji__contains=kanji),
+                '諺': Example.objects.filter(word__contains=kanji, ex_kind=Example.KOTOWAZA)}
+
+    def get_queryset(self):
+        # The number of items per category is fetched with the kanji itself
+        sub_queries = self.get_category_queries(OuterRef('kanji'))
+        return super().get_queryset().annotate(
+            **{f'nb_{i}': count_subquery(sub_queries[k]) for i, k in enumerate(self.table_data)})
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        qry = {'例文': Example.objects.filter(word__contains=context['kanji']
-                                            ).exclude(sentence='').exclude(ex_kind=Example.KOTOWAZA),
-               '四字熟語': Yoji.objects.filter(yoji__contains=context['kanji']),
-               '諺': Example.objects.filter(word__contains=context['kanji'], ex_kind=Example.KOTOWAZA)}
-        context['ctx'] = json.dumps(
-            [{'name': k, 'number': qry[k].count(), 'table_data': v.get_table_full(qry[k])}
-             for k, v in self.table_data.items() if qry[k].count() > 0]
-        )
+        qry = self.get_category_queries(self.object.kanji)
+        ctx = []
+        for i, (k, v) in enumerate(self.table_data.items()):
+            number = getattr(self.object, f'nb_{i}')
+            if number > 0:
+                ctx.append({'name': k, 'number': number, 'table_data': v.get_table_full(v.optimize_query(qry[k]))})
+        context['ctx'] = json.dumps(ctx)
         return context
 
 
@@ -549,7 +659,7 @@ def set_yomi(request):
 def get_similar_word(request):
     word = request.GET.get('word', None)
     ex_id = request.GET.get('ex_id', None) or None
-    qry_sim = Example.objects.filter(word__contains=word).exclude(id=ex_id)
+    qry_sim = filter_contains(Example.objects.exclude(id=ex_id), 'word', word)
     sim_count = qry_sim.count()
     if sim_count > 0:
         str_more = '、...' if sim_count > 5 else ''
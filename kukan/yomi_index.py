@@ -0,0 +1,128 @@
+"""
+In-memory indexes of hiragana readings, for the yomi filters (exact / prefix / substring searches)
+"""
+import bisect
+import collections
+import threading
+
+from django.db.models.signals import post_delete, post_save
+
+from .models import Reading, TableVersion, Yoji
+
+
+class YomiIndex:
+    """
+    Index of a text field of a model, answering without table scan:
+        - exact: dictionary text -> pks
+        - start: bisect in the sorted (text, pk) list
+        - contains: intersection of the bigram postings (unigram for a single character), then substring check
+    The index is built at the first search, updated on the post_save / post_delete signals of the model and rebuilt
+    when the table was changed by another process (TableVersion of the model checked at each search).
+    """
+    EXACT = 'exact'
+    START = 'start'
+    CONTAINS = 'contains'
+
+    def __init__(self, model, field, values=()):
+        """
+        :param values: fields (lookup paths allowed) returned with each match, e.g. to filter on them
+        """
+        self.model = model
+        self.field = field
+        self.values = list(values)
+        self._lock = threading.RLock()
+        self._entries = None
+        self._version = None
+        uid = f'yomi_index_{getattr(model, "_meta").label}_{field}'
+        post_save.connect(self.on_save, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(self.on_delete, sender=model, weak=False, dispatch_uid=uid)
+
+    def get_version(self):
+        return TableVersion.get_version(self.model)
+
+    def _follow_version(self):
+        """After a change notified by a signal: rebuild at the next search if another process changed the table"""
+        version = self.get_version()
+        self._version = version if self._version is not None and version == self._version + 1 else None
+
+    @staticmethod
+    def ngrams(text):
+        return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def _add(self, pk, text, values):
+        self._entries[pk] = (text, values)
+        self._exact[text].add(pk)
+        bisect.insort(self._sorted, (text, pk))
+        for gram in self.ngrams(text):
+            self._postings[gram].add(pk)
+
+    def _remove(self, pk):
+        text, _ = self._entries.pop(pk)
+        self._exact[text].discard(pk)
+        del self._sorted[bisect.bisect_left(self._sorted, (text, pk))]
+        for gram in self.ngrams(text):
+            self._postings[gram].discard(pk)
+
+    def _load(self, qry):
+        for pk, text, *values in qry.values_list('pk', self.field, *self.values):
+            if pk in self._entries:
+                self._remove(pk)
+            self._add(pk, text, tuple(values))
+
+    def rebuild(self):
+        with self._lock:
+            self._entries = {}
+            self._exact = collections.defaultdict(set)
+            self._sorted = []
+            self._postings = collections.defaultdict(set)
+            self._version = self.get_version()
+            self._load(self.model.objects.all())
+
+    def on_save(self, instance, **kwargs):
+        with self._lock:
+            if self._entries is None:
+                return
+            self._load(self.model.objects.filter(pk=instance.pk))
+            self._follow_version()
+
+    def on_delete(self, instance, **kwargs):
+        with self._lock:
+            if self._entries is None:
+                return
+            if instance.pk in self._entries:
+                self._remove(instance.pk)
+            self._follow_version()
+
+    def search(self, text, mode):
+        """
+        :param mode: EXACT, START or CONTAINS
+        :return: list of (pk, values) of the matching rows
+        """
+        with self._lock:
+            if self._entries is None or self._version != self.get_version():
+                self.rebuild()
+
+            if not text:
+                pks = self._entries.keys() if mode != self.EXACT else self._exact.get(text, set())
+            elif mode == self.EXACT:
+                pks = self._exact.get(text, set())
+            elif mode == self.START:
+                start = bisect.bisect_left(self._sorted, (text,))
+                end = start
+                while end < len(self._sorted) and self._sorted[end][0].startswith(text):
+                    end += 1
+                pks = [pk for _, pk in self._sorted[start:end]]
+            else:
+                gram_size = min(2, len(text))
+                postings = sorted((self._postings.get(x, set()) for x in self.ngrams(text) if len(x) == gram_size),
+                                  key=len)
+                pks = [pk for pk in set.intersection(*postings) if text in self._entries[pk][0]]
+
+            return [(pk, self._entries[pk][1]) for pk in pks]
+
+
+reading_index = YomiIndex(Reading, 'reading_simple', ['kanji_id', 'yomi_type__yomi_type', 'joyo__yomi_joyo'])
+yoji_reading_index = YomiIndex(Yoji, 'reading')
+
+# (model, field) -> index
+yomi_indexes = {(x.model, x.field): x for x in [reading_index, yoji_reading_index]}
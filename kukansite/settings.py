@@ -143,6 +143,7 @@ DB_BACKUP = os.path.join(TOP_DIR, 'db', '_backup')
 
 ANKI_DB_DIR = os.path.join(TOP_DIR, 'db', 'Anki2')
 ANKI_IMPORT_DIR = os.path.join(ANKI_DB_DIR, r'import')
+ANKI_EXPORT_CACHE_DIR = os.path.join(ANKI_DB_DIR, r'export_cache')
 
 FIXTURE_DIRS = [os.path.join(BASE_DIR, 'kukan', 'fixtures', 'Kanji')]
 
@@ -163,6 +164,14 @@ CRON_CFG = [
         'schedule': '04 04  * * 0-6',
         'command': 'sync_anki',
     },
+    {
+        # Long-lived worker: one PSN login and one log file for the life of the process
+        'schedule': '@reboot',
+        'command': 'process_tempmon_queue',
+        'arguments': {
+            'interval': 5,
+        }
+    },
     {
         'schedule': '23 01 * * *  ',
         'command': 'certbot renew --quiet',
@@ -229,6 +238,10 @@ LOGGING = {
 # Dummy values to be overriden in prod
 DROPBOX_TOKEN = 0
 TEMPMON_API_KEY = '__dummy__'
+# Seconds during which the PSN presence (game currently played) is reused for the tempmon points
+TEMPMON_PSN_PRESENCE_TTL = 60
+# Seconds after which a queued tempmon point is not attributed to the game currently played (process_tempmon_queue)
+TEMPMON_QUEUE_STALE_AFTER = 300
 PSN_TOKEN = '__dummy__'
 
 ANKI_ACCOUNTS = {
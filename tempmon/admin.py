@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from tempmon.models import PsGame, PlaySession, GamePerSessionInfo
+from tempmon.models import PsGame, PlaySession, GamePerSessionInfo, QueuedPoint
 
 
 @admin.register(PsGame)
@@ -15,7 +15,32 @@ class PlaySessionAdmin(admin.ModelAdmin):
 
 @admin.register(GamePerSessionInfo)
 class GamePerSessionInfoAdmin(admin.ModelAdmin):
+    """
+    The play time of the games is maintained as the points are added (PlaySession.add_game_time): recomputed here
+    for the games of the edited / deleted infos
+    """
     def session_time(self, obj):
         return obj.session.start_time
 
-    list_display = ['session_time', 'game', 'duration']
\ No newline at end of file
+    list_display = ['session_time', 'game', 'duration']
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Previous game too, if it was changed
+        for game in PsGame.objects.filter(pk__in={obj.game_id, form.initial.get('game')} - {None}):
+            game.update_play_time()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        obj.game.update_play_time()
+
+    def delete_queryset(self, request, queryset):
+        games = list(PsGame.objects.filter(gamepersessioninfo__in=queryset).distinct())
+        super().delete_queryset(request, queryset)
+        for game in games:
+            game.update_play_time()
+
+
+@admin.register(QueuedPoint)
+class QueuedPointAdmin(admin.ModelAdmin):
+    list_display = ['received_time', 'session_time', 'current_time', 'temperature']
@@ -0,0 +1,61 @@
+import time
+
+from tempmon.models import PsnApiKey, QueuedPoint
+from tempmon.psn import login
+from utils_django.management_command import FBaseCommand
+
+
+class Command(FBaseCommand):
+    """
+    Add the points queued by add_temp_point / add_temp_points to their sessions.
+    Run once, or as a long-lived worker polling the queue every --interval seconds (started at boot by cron), for
+    --duration seconds if given.
+    The PSN client is logged in at the first batch with current points, and again when the npsso code is updated:
+    the presence cache and the game pks are kept for the life of the worker.
+    """
+    help = 'Process the queued tempmon points'
+
+    # Running as a worker: must not block the other commands
+    use_lock = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.psn = None
+        self.psn_token = None
+
+    def get_current_game(self):
+        token = PsnApiKey.objects.values_list('code', flat=True).first()
+        if token != self.psn_token:
+            self.psn_token = token
+            self.psn = login(token)
+        return self.psn.get_current_game() if self.psn else -1
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            default=500,
+            help='Number of points added per transaction',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0,
+            help='Poll the queue every interval seconds (process the queue once and exit by default)',
+        )
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=0,
+            help='Stop polling after duration seconds (no limit by default)',
+        )
+
+    def handle_cmd(self, *args, **options):
+        start = time.monotonic()
+        while True:
+            if count := QueuedPoint.process(self.get_current_game, options['batch_size']):
+                self.stdout.write(f'{count} point(s) processed')
+            if not options['interval'] or \
+                    (options['duration'] and time.monotonic() - start + options['interval'] > options['duration']):
+                break
+            time.sleep(options['interval'])
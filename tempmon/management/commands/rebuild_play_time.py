@@ -0,0 +1,9 @@
+from tempmon.models import PsGame
+from utils_django.management_command import FBaseCommand
+
+
+class Command(FBaseCommand):
+    help = 'Recompute the play time of the games per session and in total, from the points of the sessions'
+
+    def handle_cmd(self, *args, **options):
+        PsGame.rebuild_play_time()
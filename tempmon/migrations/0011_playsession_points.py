@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:27
+import pickle
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def split_data_points(apps, schema_editor):
+    PlaySession = apps.get_model("tempmon", "PlaySession")
+    SessionPoint = apps.get_model("tempmon", "SessionPoint")
+    for session in PlaySession.objects.all():
+        SessionPoint.objects.bulk_create([
+            SessionPoint(session=session, time=t, temperature=v[0], humidity=v[1], pressure=v[2], game_pk=v[3])
+            for t, v in pickle.loads(session.data_points).items()
+        ])
+
+
+def join_data_points(apps, schema_editor):
+    PlaySession = apps.get_model("tempmon", "PlaySession")
+    for session in PlaySession.objects.all():
+        session.data_points = pickle.dumps({x[0]: tuple(x[1:]) for x in session.sessionpoint_set.values_list(
+            'time', 'temperature', 'humidity', 'pressure', 'game_pk')})
+        session.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tempmon', '0010_alter_psgame_last_played'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.IntegerField(verbose_name='Time')),
+                ('temperature', models.FloatField(verbose_name='Temperature')),
+                ('humidity', models.FloatField(verbose_name='Humidity')),
+                ('pressure', models.FloatField(verbose_name='Pressure')),
+                ('game_pk', models.IntegerField(default=-1, verbose_name='Game')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tempmon.playsession')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='sessionpoint',
+            constraint=models.UniqueConstraint(fields=('session', 'time'), name='unique_session_point_time'),
+        ),
+        # Nullable first, so that the field can be added back when the migration is reverted
+        migrations.AlterField(
+            model_name='playsession',
+            name='data_points',
+            field=models.BinaryField(null=True, verbose_name='Data points'),
+        ),
+        migrations.RunPython(split_data_points, join_data_points),
+        migrations.RemoveField(
+            model_name='playsession',
+            name='data_points',
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tempmon', '0011_playsession_points'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_time', models.IntegerField(verbose_name='Session time')),
+                ('current_time', models.IntegerField(verbose_name='Current time')),
+                ('temperature', models.FloatField(verbose_name='Temperature')),
+                ('humidity', models.FloatField(verbose_name='Humidity')),
+                ('pressure', models.FloatField(verbose_name='Pressure')),
+                ('received_time', models.DateTimeField(auto_now_add=True, verbose_name='Received time')),
+            ],
+        ),
+    ]
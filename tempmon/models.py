@@ -1,14 +1,18 @@
-import pickle
+import logging
 from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 import datetime as dt
 from datetime import UTC
 
-from django.db.models import Sum, Max
+from django.db.models import Max, Min, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.utils.timezone import now
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class DataPoint:
@@ -40,7 +44,6 @@ class PlaySession(models.Model):
     end_time = models.DateTimeField(verbose_name='End time')
     start_temp = models.FloatField(verbose_name='Starting temperature')
     max_temp = models.FloatField(verbose_name='Max temperature')
-    data_points = models.BinaryField(verbose_name='Data points')
     duration = models.DurationField(verbose_name='Duration')
 
     def __str__(self):
@@ -48,60 +51,140 @@ class PlaySession(models.Model):
 
     @property
     def data_dict(self):
-        return pickle.loads(self.data_points)
+        """Dict of the data points of the session: time -> (temperature, humidity, pressure, game pk)"""
+        return {x[0]: tuple(x[1:]) for x in self.sessionpoint_set.values_list(
+            'time', 'temperature', 'humidity', 'pressure', 'game_pk')}
 
     @property
     def current_temp(self):
-        return self.data_dict[max(self.data_dict.keys())][0]
+        return self.sessionpoint_set.order_by('-time').values_list('temperature', flat=True)[0]
 
     @classmethod
     def add_point(cls, pt: DataPoint, game_pk=-1):
-        data = (*pt.values, game_pk)
-        try:
-            session = cls.objects.get(start_time=pt.session_time_dt)
-            current_data = session.data_dict
-            current_data[pt.current_time] = data
-
-            last_ts = max(current_data.keys())
-            last_dt = dt.datetime.fromtimestamp(last_ts).astimezone(UTC)
-            session.end_time = last_dt
-            session.duration = last_dt - pt.session_time_dt
-
-            session.max_temp = max(session.max_temp, pt.temperature)
-            session.data_points = pickle.dumps(current_data)
-            session.save()
-
-            session.update_game_per_session_info()
-
-        except PlaySession.DoesNotExist:
-            session = cls.objects.create(
-                start_time=pt.session_time_dt,
-                end_time=pt.current_time_dt,
-                duration=pt.current_time_dt - pt.session_time_dt,
-                start_temp=pt.temperature,
-                max_temp=pt.temperature,
-                data_points=pickle.dumps({pt.current_time: data})
-            )
-        return session
-
-    def get_time_per_game(self):
+        """
+        Add the point to its session (created by the first point): the point is appended to the points of the
+        session, and the end time, duration and max temperature are updated from the new point only, so that the
+        cost of a point does not depend on the length of the session
+        """
+        return cls.add_points([pt], game_pk)[0]
+
+    @classmethod
+    def add_points(cls, pts, game_pk=-1):
+        """
+        Add a batch of points (e.g. buffered by the sensor while offline) in one transaction, with one update of
+        each session. A point overrides the point of its session at the same time (the last one within the batch).
+        :return: the sessions of the points
+        """
+        by_session = defaultdict(dict)
+        for pt in pts:
+            by_session[pt.session_time][pt.current_time] = pt
+
+        sessions = []
+        with transaction.atomic():
+            for session_time, session_pts in by_session.items():
+                first = session_pts[min(session_pts)]
+                last_dt = session_pts[max(session_pts)].current_time_dt
+                max_temp = max(pt.temperature for pt in session_pts.values())
+                try:
+                    session = cls.objects.get(start_time=first.session_time_dt)
+                    session.end_time = max(session.end_time, last_dt)
+                    session.duration = session.end_time - session.start_time
+                    session.max_temp = max(session.max_temp, max_temp)
+                    session.save(update_fields=['end_time', 'duration', 'max_temp'])
+                    created = False
+                except PlaySession.DoesNotExist:
+                    session = cls.objects.create(
+                        start_time=first.session_time_dt,
+                        end_time=last_dt,
+                        duration=last_dt - first.session_time_dt,
+                        start_temp=first.temperature,
+                        max_temp=max_temp,
+                    )
+                    created = True
+                # Play time of the games: difference of the intervals around the new points only
+                window = (None, None) if created else session.get_window(min(session_pts), max(session_pts))
+                before = {} if created else session.get_time_per_game(*window)
+                SessionPoint.add(session, session_pts.values(), game_pk)
+                after = session.get_time_per_game(*window)
+                session.add_game_time({pk: after.get(pk, 0) - before.get(pk, 0) for pk in set(after) | set(before)})
+                sessions.append(session)
+        return sessions
+
+    def get_window(self, first, last):
+        """(time of the point before first, time of the point after last): bounds of the intervals between the points
+        changed by points added from first to last"""
+        points = self.sessionpoint_set
+        start = points.filter(time__lt=first).aggregate(Max('time'))['time__max']
+        end = points.filter(time__gt=last).aggregate(Min('time'))['time__min']
+        return first if start is None else start, last if end is None else end
+
+    def get_time_per_game(self, start=None, end=None):
         """Return a dict with each game pk as key, and the number
-         of seconds as value"""
-        d = self.data_dict
-        list_of_times = sorted(d.keys())
+         of seconds as value (for the points from start to end, all the points by default)"""
+        points = self.sessionpoint_set.all()
+        if start is not None:
+            points = points.filter(time__gte=start)
+        if end is not None:
+            points = points.filter(time__lte=end)
+        list_of_points = list(points.order_by('time').values_list('time', 'game_pk'))
         res = defaultdict(lambda: 0)
-        for t1, t2 in zip(list_of_times, list_of_times[1:]):
-            res[d[t1][3]] += (t2 - t1)
+        for (t1, game_pk), (t2, _) in zip(list_of_points, list_of_points[1:]):
+            res[game_pk] += (t2 - t1)
         return res
 
-    def update_game_per_session_info(self):
-        for game_pk, duration in self.get_time_per_game().items():
-            if game_pk == -1:
+    def add_game_time(self, delta):
+        """
+        Add the time played in the session to the GamePerSessionInfo of the games and to their totals
+        :param delta: game pk -> seconds (negative when points of the game were overridden)
+        """
+        for game_pk, seconds in delta.items():
+            if game_pk == -1 or not seconds:
                 continue
-            info = GamePerSessionInfo.objects.get_or_create(
-                session=self, game=PsGame.objects.get(pk=game_pk))[0]
-            info.duration = dt.timedelta(seconds=duration)
-            info.save()
+            duration = dt.timedelta(seconds=seconds)
+            info, created = GamePerSessionInfo.objects.get_or_create(session=self, game_id=game_pk,
+                                                                     defaults={'duration': duration})
+            game_update = {'play_time': Coalesce('play_time', Value(dt.timedelta(0))) + duration}
+            if created and not GamePerSessionInfo.objects.filter(game_id=game_pk).exclude(pk=info.pk).exists():
+                # First session of the game: replaces the creation time of the game
+                game_update['last_played'] = self.end_time
+            elif not created:
+                info.duration = (info.duration or dt.timedelta(0)) + duration
+                if info.duration > dt.timedelta(0):
+                    info.save(update_fields=['duration'])
+                else:
+                    info.delete()
+            PsGame.objects.filter(pk=game_pk).update(**game_update)
+
+        # Last played: end of the session, for the games played in the session
+        PsGame.objects.filter(gamepersessioninfo__session=self).update(last_played=Greatest(
+            'last_played', Value(self.end_time)))
+
+
+class SessionPoint(models.Model):
+    """Data point of a session: one row per point, added without rewriting the previous ones"""
+    session = models.ForeignKey(PlaySession, on_delete=models.CASCADE)
+    time = models.IntegerField(verbose_name='Time')
+    temperature = models.FloatField(verbose_name='Temperature')
+    humidity = models.FloatField(verbose_name='Humidity')
+    pressure = models.FloatField(verbose_name='Pressure')
+    game_pk = models.IntegerField(verbose_name='Game', default=-1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'time'], name='unique_session_point_time'),
+        ]
+
+    def __str__(self):
+        return f'{self.session} - {self.time}'
+
+    @classmethod
+    def add(cls, session, pts, game_pk=-1):
+        """Insert the points (at distinct times), or override the points of the session at the same time"""
+        cls.objects.bulk_create(
+            [cls(session=session, time=pt.current_time, temperature=pt.temperature, humidity=pt.humidity,
+                 pressure=pt.pressure, game_pk=game_pk) for pt in pts],
+            update_conflicts=True, unique_fields=['session', 'time'],
+            update_fields=['temperature', 'humidity', 'pressure', 'game_pk'])
 
 
 class PsGame(models.Model):
@@ -114,6 +197,32 @@ class PsGame(models.Model):
     def __str__(self):
         return f'{self.name}'
 
+    @classmethod
+    def rebuild_play_time(cls):
+        """
+        Recompute the GamePerSessionInfo of all the sessions from their points, and the play time / last played of
+        all the games (normally maintained incrementally as the points are added)
+        """
+        with transaction.atomic():
+            for session in PlaySession.objects.all():
+                times = session.get_time_per_game()
+                session.gamepersessioninfo_set.exclude(game_id__in=times).delete()
+                for game_pk, seconds in times.items():
+                    if game_pk != -1:
+                        GamePerSessionInfo.objects.update_or_create(
+                            session=session, game_id=game_pk, defaults={'duration': dt.timedelta(seconds=seconds)})
+
+            for game in cls.objects.all():
+                game.update_play_time()
+
+    def update_play_time(self):
+        """Recompute the play time / last played of the game from its GamePerSessionInfo"""
+        agg = self.gamepersessioninfo_set.aggregate(
+            Max('session__end_time'), Sum('duration'))
+        self.play_time = agg['duration__sum']
+        self.last_played = agg['session__end_time__max'] or self.last_played
+        self.save()
+
 
 class PsnApiKey(models.Model):
     code = models.CharField('npsso code', max_length=100,
@@ -131,13 +240,61 @@ class GamePerSessionInfo(models.Model):
     def __str__(self):
         return f' "{self.game}" played on "{self.session}"'
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        agg = self.game.gamepersessioninfo_set.aggregate(
-            Max('session__end_time'), Sum('duration'))
-        self.game.play_time = agg['duration__sum']
-        self.game.last_played = agg['session__end_time__max']
-        self.game.save()
+
+class QueuedPoint(models.Model):
+    """
+    Point received from the sensor, waiting in the queue to be added to its session by the process_tempmon_queue
+    command, so that the sensor request only costs one insert
+    """
+    session_time = models.IntegerField(verbose_name='Session time')
+    current_time = models.IntegerField(verbose_name='Current time')
+    temperature = models.FloatField(verbose_name='Temperature')
+    humidity = models.FloatField(verbose_name='Humidity')
+    pressure = models.FloatField(verbose_name='Pressure')
+    received_time = models.DateTimeField(verbose_name='Received time', auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.session_time} - {self.current_time}'
+
+    @property
+    def data_point(self):
+        return DataPoint(self.session_time, self.current_time, self.temperature, self.humidity, self.pressure)
+
+    @classmethod
+    def enqueue(cls, pts):
+        cls.objects.bulk_create([cls(**asdict(pt)) for pt in pts])
+
+    @classmethod
+    def process(cls, get_current_game, batch_size=500, stale_after=None):
+        """
+        Add the queued points to their sessions, batch by batch in the order of arrival, and remove them from the
+        queue in the same transaction
+        :param get_current_game: function returning the pk of the game currently played (-1 if none), called once
+                                 per batch
+        :param stale_after: timedelta (settings.TEMPMON_QUEUE_STALE_AFTER seconds by default): points received
+                            earlier (queued while the command was not running) are not attributed to the current game
+        :return: number of processed points
+        """
+        if stale_after is None:
+            stale_after = dt.timedelta(seconds=settings.TEMPMON_QUEUE_STALE_AFTER)
+        count = 0
+        while batch := list(cls.objects.order_by('pk')[:batch_size]):
+            # Server clock: the clock of the sensor may be off
+            stale_time = now() - stale_after
+            stale = [x.data_point for x in batch if x.received_time < stale_time]
+            current = [x.data_point for x in batch if x.received_time >= stale_time]
+            if stale:
+                logger.warning(f'{len(stale)} queued point(s) received before {stale_time}: '
+                               f'not attributed to the current game')
+            game_pk = get_current_game() if current else -1
+            with transaction.atomic():
+                for pts, pts_game_pk in [(stale, -1), (current, game_pk)]:
+                    if pts:
+                        PlaySession.add_points(pts, pts_game_pk)
+                cls.objects.filter(pk__in=[x.pk for x in batch]).delete()
+            count += len(batch)
+        return count
+
 
 # Reimporting from info log
 # import json
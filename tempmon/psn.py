@@ -0,0 +1,119 @@
+"""
+PSN client of tempmon: game currently played, for the points of the sensor
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from psnawp_api import PSNAWP
+from psnawp_api.core.psnawp_exceptions import PSNAWPNotFound, \
+    PSNAWPAuthenticationError
+from psnawp_api.utils.endpoints import BASE_PATH, API_PATH
+
+from tempmon.models import PsGame
+
+logger = logging.getLogger(__name__)
+
+
+class PSN:
+    """
+    PSN client resolving the game currently played:
+        - the presence is cached for presence_ttl seconds (TEMPMON_PSN_PRESENCE_TTL), so that the sensor points do
+          not wait for PSN at every request
+        - the PsGame pk of each title id is kept in memory
+    The hit rate of the presence cache is logged every stats_interval lookups.
+    """
+    stats_interval = 100
+
+    def __init__(self, token, presence_ttl=None, psnawp=None):
+        """
+        :param psnawp: PSNAWP client (logged in with the token by default)
+        """
+        self.psnawp = psnawp or PSNAWP(token, accept_language='ja', country='JP')
+        logger.info('Logged into PSN')
+
+        self.client = self.psnawp.me()
+        self.me = self.psnawp.user(account_id=self.client.account_id)
+
+        self.presence_ttl = presence_ttl if presence_ttl is not None else settings.TEMPMON_PSN_PRESENCE_TTL
+        self._lock = threading.Lock()
+        self._current_game = None
+        self._current_game_time = None
+        self._game_pks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_game_name_in_jp(self, title_id):
+        """The GameTitle.get_details hard code to US"""
+        game = self.psnawp.game_title(title_id=title_id,
+                                      account_id=self.client.account_id)
+        return self.psnawp._request_builder.get(
+            url=f"{BASE_PATH['game_titles']}"
+                f"{API_PATH['title_concept'].format(title_id=game.title_id)}",
+            params={"age": 99, "country": "JP", "language": "ja-JP"},
+        ).json()[0]['name']
+
+    def get_game_pk(self, title_id):
+        try:
+            return self._game_pks[title_id]
+        except KeyError:
+            pass
+
+        try:
+            ps_game = PsGame.objects.get(title_id=title_id)
+        except PsGame.DoesNotExist:
+            try:
+                ps_game = PsGame.objects.create(
+                    title_id=title_id, name=self.get_game_name_in_jp(title_id))
+            except PSNAWPNotFound:
+                ps_game = PsGame.objects.create(
+                    title_id=title_id, name='__UNKNOWN__')
+
+        self._game_pks[title_id] = ps_game.pk
+        return ps_game.pk
+
+    def get_current_game_uncached(self):
+        status = self.me.get_presence()['basicPresence']
+        if status['availability'] == 'unavailable':
+            return -1
+        else:
+            if status['primaryPlatformInfo']['onlineStatus'] == 'online':
+                try:
+                    title_id = status["gameTitleInfoList"][0]["npTitleId"]
+                    return self.get_game_pk(title_id)
+                except KeyError:
+                    return -1
+            else:
+                return -1
+
+    def get_current_game(self):
+        with self._lock:
+            now_time = time.monotonic()
+            if self._current_game_time is not None and now_time - self._current_game_time < self.presence_ttl:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._current_game = self.get_current_game_uncached()
+                self._current_game_time = now_time
+
+            if (self.hits + self.misses) % self.stats_interval == 0:
+                logger.info(f'PSN presence cache: {self.hits / (self.hits + self.misses):.1%} hit rate '
+                            f'({self.hits} hits, {self.misses} misses)')
+            return self._current_game
+
+
+def login(token):
+    """
+    :param token: npsso code (PsnApiKey)
+    :return: PSN client, None without code or if the login failed
+    """
+    if token is None or token == '__dummy__':
+        return None
+    try:
+        return PSN(token)
+    except PSNAWPAuthenticationError as e:
+        logger.error(f'Failed to login to PSN: {e}')
+    except Exception as e:
+        logger.error(f'Exception: {e}')
+    return None
@@ -1,10 +1,24 @@
 import datetime as dt
 import os
+import random
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import call, patch, MagicMock
 
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from tempmon.admin import GamePerSessionInfoAdmin
+from tempmon.management.commands.process_tempmon_queue import Command as ProcessTempmonQueueCommand
 from tempmon.models import PlaySession, DataPoint, PsGame, GamePerSessionInfo, \
-    PsnApiKey
-from tempmon.views import PSN, PlaySessionGraphView
+    PsnApiKey, QueuedPoint
+from tempmon.psn import PSN
+from tempmon.views import PlaySessionGraphView
 
 
 class TestPlaySessionModel(TestCase):
@@ -67,6 +81,21 @@ class TestPlaySessionModel(TestCase):
         self.assertEqual(ps.duration, dt.timedelta(seconds=30))
         self.assertEqual(ps.end_time.timestamp(), 1703644030)
 
+    def test_add_point_constant_writes(self):
+        def writes(current_time):
+            with CaptureQueriesContext(connection) as queries:
+                PlaySession.add_point(DataPoint(1703644000, current_time, 22.5, 30.0, 10000.2))
+            return [x['sql'].split()[0] for x in queries if x['sql'].split()[0] in ['INSERT', 'UPDATE', 'DELETE']]
+
+        PlaySession.add_point(DataPoint(1703644000, 1703644000, 22.5, 30.0, 10000.2))
+        first = writes(1703644010)
+        for i in range(2, 50):
+            PlaySession.add_point(DataPoint(1703644000, 1703644000 + i * 10, 22.5, 30.0, 10000.2))
+        self.assertEqual(first, writes(1703644500))
+        # Session, point, last played of the games of the session
+        self.assertEqual(['UPDATE', 'INSERT', 'UPDATE'], first)
+        self.assertEqual(51, len(PlaySession.objects.get().data_dict))
+
     def test_get_time_per_game(self):
         PsGame.objects.create(name='Game1', title_id='X1')
         PsGame.objects.create(name='Game2', title_id='X2')
@@ -83,7 +112,6 @@ class TestPlaySessionModel(TestCase):
 
         self.assertEqual(ps.duration, dt.timedelta(seconds=5940))
 
-        ps.update_game_per_session_info()
         game1 = GamePerSessionInfo.objects.first()
         self.assertEqual(game1.game.name, 'Game1')
         self.assertEqual(game1.duration, dt.timedelta(seconds=5179))
@@ -105,6 +133,244 @@ class TestPlaySessionModel(TestCase):
         self.assertEqual(game2.game.play_time, dt.timedelta(seconds=700))
 
 
+class TestPlayTime(TestCase):
+    def setUp(self):
+        self.games = [PsGame.objects.create(name=f'Game{i}', title_id=f'X{i}').pk for i in range(3)]
+
+    def get_totals(self):
+        return (sorted(GamePerSessionInfo.objects.values_list('session_id', 'game_id', 'duration')),
+                sorted(PsGame.objects.values_list('pk', 'play_time', 'last_played')))
+
+    def test_incremental_matches_rebuild(self):
+        rnd = random.Random(0)
+        for session_time in [1703644000, 1703700000]:
+            times = list(range(session_time, session_time + 3000, 30))
+            # Appended, out of order and overridden points, single and batches
+            points = times + rnd.sample(times, 20)
+            rnd.shuffle(points[50:])
+            for i in range(0, len(points), rnd.choice([1, 5])):
+                PlaySession.add_points([DataPoint(session_time, t, 20, 30, 1000) for t in points[i:i + 5]],
+                                       rnd.choice(self.games + [-1]))
+
+        incremental = self.get_totals()
+        GamePerSessionInfo.objects.all().delete()
+        PsGame.objects.update(play_time=dt.timedelta(days=1))
+        call_command('rebuild_play_time')
+        self.assertEqual(self.get_totals(), incremental)
+
+    def test_admin(self):
+        # Sessions of 60 seconds: 2 of Game0, 1 of Game1
+        for i in range(3):
+            session_time = 1703644000 + i * 10000
+            PlaySession.add_points([DataPoint(session_time, session_time + t, 20, 30, 1000) for t in [0, 60]],
+                                   self.games[i % 2])
+        info = GamePerSessionInfo.objects.get(game=self.games[1])
+        model_admin = GamePerSessionInfoAdmin(GamePerSessionInfo, admin.site)
+
+        # Duration and game changed
+        info.duration = dt.timedelta(seconds=100)
+        info.game_id = self.games[2]
+        model_admin.save_model(None, info, SimpleNamespace(initial={'game': self.games[1]}), True)
+        self.assertEqual([dt.timedelta(seconds=120), None, dt.timedelta(seconds=100)],
+                         [PsGame.objects.get(pk=pk).play_time for pk in self.games])
+
+        model_admin.delete_model(None, info)
+        self.assertIsNone(PsGame.objects.get(pk=self.games[2]).play_time)
+        model_admin.delete_queryset(None, GamePerSessionInfo.objects.all())
+        self.assertIsNone(PsGame.objects.get(pk=self.games[0]).play_time)
+
+    def test_constant_queries(self):
+        def count(current_time):
+            with CaptureQueriesContext(connection) as queries:
+                PlaySession.add_point(DataPoint(1703644000, current_time, 22.5, 30.0, 10000.2), self.games[0])
+            return len(queries)
+
+        for current_time in [1703644000, 1703644010]:
+            PlaySession.add_point(DataPoint(1703644000, current_time, 22.5, 30.0, 10000.2), self.games[0])
+        first = count(1703644020)
+        for i in range(3, 50):
+            PlaySession.add_point(DataPoint(1703644000, 1703644000 + i * 10, 22.5, 30.0, 10000.2), self.games[0])
+        self.assertEqual(first, count(1703644500))
+        self.assertEqual(dt.timedelta(seconds=500), PsGame.objects.get(pk=self.games[0]).play_time)
+
+
+class TestAddTempPoints(TestCase):
+    def setUp(self):
+        PsGame.objects.create(name='Game1', title_id='X1')
+
+    def post(self, points, api_key=settings.TEMPMON_API_KEY):
+        return self.client.post('/tempmon/add_temp_points/', {'API_KEY': api_key, 'points': points},
+                                content_type='application/json').json()
+
+    @staticmethod
+    def point(session_time, current_time, temperature=22.5):
+        return {'session_time': session_time, 'current_time': current_time, 'temperature': temperature,
+                'humidity': 30.0, 'pressure': 10000.2}
+
+    @staticmethod
+    def process(game_pk, batch_size=500):
+        get_current_game = MagicMock(return_value=game_pk)
+        QueuedPoint.process(get_current_game, batch_size)
+        return get_current_game
+
+    def test_batch(self):
+        points = [self.point(1703644000, 1703644000 + i * 30, 20 + i) for i in range(5)] + \
+            [self.point(1703650000, 1703650010), self.point(1703644000, 1703644060, 30)]
+        with patch('tempmon.views.psn') as psn:
+            self.assertEqual({'result': 'OK', 'count': 7}, self.post(points))
+        psn.get_current_game.assert_not_called()
+        self.assertEqual(7, QueuedPoint.objects.count())
+        self.assertFalse(PlaySession.objects.exists())
+
+        self.process(1).assert_called_once()
+        self.assertFalse(QueuedPoint.objects.exists())
+
+        ps1, ps2 = PlaySession.objects.order_by('start_time')
+        self.assertEqual(5, len(ps1.data_dict))
+        self.assertEqual((30, 30.0, 10000.2, 1), ps1.data_dict[1703644060])
+        self.assertEqual(30, ps1.max_temp)
+        self.assertEqual(20, ps1.start_temp)
+        self.assertEqual(dt.timedelta(seconds=120), ps1.duration)
+        self.assertEqual(dt.timedelta(seconds=120), PsGame.objects.get().play_time)
+        self.assertEqual(1, len(ps2.data_dict))
+
+        # Appended to the existing session
+        self.post([self.point(1703644000, 1703644150)])
+        self.process(-1)
+        self.assertEqual(6, len(PlaySession.objects.order_by('start_time').first().data_dict))
+
+    def test_invalid_batch(self):
+        with patch('tempmon.views.psn') as psn:
+            res = self.post([self.point(1703644000, 1703644010), self.point(1703644000, 1703643000)])
+            self.assertEqual('Failure: Current time before Session time', res['result'])
+            self.assertEqual('Failure - wrong API_KEY',
+                             self.post([self.point(1703644000, 1703644010)], 'wrong')['result'])
+        psn.get_current_game.assert_not_called()
+        self.assertFalse(QueuedPoint.objects.exists())
+
+    def test_process_batches(self):
+        self.post([self.point(1703644000, 1703644000 + i * 30) for i in range(7)])
+        self.assertEqual(3, self.process(1, batch_size=3).call_count)
+        self.assertEqual(7, len(PlaySession.objects.get().data_dict))
+
+    def test_queue_single_point(self):
+        with self.assertNumQueries(1):
+            res = self.client.post('/tempmon/add_temp_point/',
+                                   {'API_KEY': settings.TEMPMON_API_KEY, **self.point(1703644000, 1703644010)},
+                                   content_type='application/json').json()
+        self.assertEqual({'result': 'OK'}, res)
+
+        game_pk = PsGame.objects.get().pk
+        PsnApiKey.objects.update(code='token')
+        with patch('tempmon.management.commands.process_tempmon_queue.login') as login:
+            login.return_value.get_current_game.return_value = game_pk
+            call_command('process_tempmon_queue', stdout=StringIO())
+        # Received now: attributed to the current game, whatever the clock of the sensor
+        login.assert_called_once_with('token')
+        login.return_value.get_current_game.assert_called_once()
+        self.assertEqual({1703644010: (22.5, 30.0, 10000.2, game_pk)}, PlaySession.objects.get().data_dict)
+        self.assertFalse(QueuedPoint.objects.exists())
+
+    def test_queue_psn_login(self):
+        # Empty queue: no login
+        with patch('tempmon.management.commands.process_tempmon_queue.login') as login:
+            call_command('process_tempmon_queue', stdout=StringIO())
+        login.assert_not_called()
+
+        command = ProcessTempmonQueueCommand()
+        client = MagicMock(**{'get_current_game.return_value': 3})
+        with patch('tempmon.management.commands.process_tempmon_queue.login',
+                   side_effect=lambda token: None if token == '__dummy__' else client) as login:
+            # No npsso code
+            self.assertEqual(-1, command.get_current_game())
+            PsnApiKey.objects.update(code='token1')
+            for _ in range(2):
+                self.assertEqual(3, command.get_current_game())
+            PsnApiKey.objects.update(code='token2')
+            command.get_current_game()
+        # Logged in once per npsso code
+        self.assertEqual([call('__dummy__'), call('token1'), call('token2')], login.call_args_list)
+
+    def test_queue_stale(self):
+        self.post([self.point(1703644000, 1703644000 + i * 30) for i in range(3)])
+        # Queued while the command was not running, except the last point
+        QueuedPoint.objects.exclude(pk=QueuedPoint.objects.order_by('pk').last().pk).update(
+            received_time=now() - dt.timedelta(seconds=settings.TEMPMON_QUEUE_STALE_AFTER + 60))
+        with self.assertLogs('tempmon.models', 'WARNING') as logs:
+            get_current_game = self.process(1)
+        self.assertIn('2 queued point(s)', logs.output[0])
+        get_current_game.assert_called_once()
+        self.assertEqual([-1, -1, 1], [x[3] for _, x in sorted(PlaySession.objects.get().data_dict.items())])
+
+        # Only stale points: the current game is not needed
+        self.post([self.point(1703644000, 1703645000)])
+        QueuedPoint.objects.update(received_time=now() - dt.timedelta(hours=1))
+        with self.assertLogs('tempmon.models', 'WARNING'):
+            self.process(1).assert_not_called()
+
+
+class FakePsnawp:
+    """Local PSN client: presence of the user and Japanese names of the titles"""
+    def __init__(self, names):
+        self.names = names
+        self.title_id = None
+        self.presence_calls = 0
+        self.name_calls = 0
+        self.account_id = 'account'
+        self._request_builder = self
+
+    def me(self):
+        return self
+
+    def user(self, account_id):
+        return self
+
+    def get_presence(self):
+        self.presence_calls += 1
+        if self.title_id is None:
+            return {'basicPresence': {'availability': 'unavailable'}}
+        return {'basicPresence': {'availability': 'availableToPlay',
+                                  'primaryPlatformInfo': {'onlineStatus': 'online'},
+                                  'gameTitleInfoList': [{'npTitleId': self.title_id}]}}
+
+    def game_title(self, title_id, account_id):
+        return SimpleNamespace(title_id=title_id)
+
+    def get(self, url, params):
+        self.name_calls += 1
+        return SimpleNamespace(json=lambda: [{'name': self.names[url.split('/')[-2]]}])
+
+
+class TestPsnCache(TestCase):
+    def setUp(self):
+        self.fake = FakePsnawp({'PPSA01286_00': 'ゲーム'})
+        self.psn = PSN('token', presence_ttl=60, psnawp=self.fake)
+
+    def test_presence_ttl(self):
+        with patch('tempmon.psn.time.monotonic', return_value=1000):
+            self.assertEqual(-1, self.psn.get_current_game())
+            self.fake.title_id = 'PPSA01286_00'
+            # Cached
+            self.assertEqual(-1, self.psn.get_current_game())
+        with patch('tempmon.psn.time.monotonic', return_value=1060):
+            pk = self.psn.get_current_game()
+            self.assertEqual(PsGame.objects.get(name='ゲーム').pk, pk)
+        self.assertEqual(2, self.fake.presence_calls)
+        self.assertEqual((1, 2), (self.psn.hits, self.psn.misses))
+
+    def test_game_pk_map(self):
+        self.psn.presence_ttl = 0
+        self.fake.title_id = 'PPSA01286_00'
+        with self.assertLogs('tempmon.psn', 'INFO') as logs:
+            for _ in range(self.psn.stats_interval):
+                self.psn.get_current_game()
+        self.assertEqual(['INFO:tempmon.psn:PSN presence cache: 0.0% hit rate (0 hits, 100 misses)'], logs.output)
+        self.assertEqual(1, self.fake.name_calls)
+        self.assertEqual(1, PsGame.objects.count())
+        with self.assertNumQueries(0):
+            self.psn.get_current_game()
+
+
 class TestPsn(TestCase):
     def setUp(self) -> None:
         try:
@@ -169,3 +435,19 @@ class TestPlaySessionDetailView(TestCase):
         g = PlaySessionGraphView.get_background_matrix(
             data_dict, sorted(data_dict.keys()))
         self.assertEqual(expected_result, list(g))
+
+
+class TestPlaySessionListView(TestCase):
+    def setUp(self):
+        User.objects.create_user('test_user', password='pwd')
+        self.client.post('/login/', {'username': 'test_user', 'password': 'pwd'})
+        for i in range(3):
+            PlaySession.add_point(DataPoint(1703644000 + i * 10000, 1703644030 + i * 10000, 22.5, 30.0, 10000.2))
+
+    def test_list_without_data_points(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/tempmon/session_list/',
+                                       {'ajax': 1, 'page': 1, 'sort_by': '-start_time'})
+        self.assertEqual(3, response.json()['total_results'])
+        self.assertEqual('22.5', response.json()['table_data']['data'][0]['max_temp'])
+        self.assertFalse([x['sql'] for x in queries if 'tempmon_sessionpoint' in x['sql']])
@@ -4,6 +4,7 @@ from tempmon import views
 
 urlpatterns = [
     path('add_temp_point/', views.add_temp_point, name='add_temp_point'),
+    path('add_temp_points/', views.add_temp_points, name='add_temp_points'),
     path('session_list/', views.PlaySessionListView.as_view(),
          name='session_list'),
     path('session/<int:pk>/', views.PlaySessionGraphView.as_view(),
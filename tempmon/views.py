@@ -13,75 +13,21 @@ from django.http import JsonResponse
 from django.urls import reverse_lazy
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import DetailView, UpdateView
-from psnawp_api import PSNAWP
-from psnawp_api.core.psnawp_exceptions import PSNAWPNotFound, \
-    PSNAWPAuthenticationError
+from psnawp_api.core.psnawp_exceptions import PSNAWPAuthenticationError
 
 from kukan.filters import FGenericDateRange, FGenericMinMax, FFilter, \
     FGenericString
 from kukan.forms import BForm
 from kukan.views import AjaxList, TableData
-from tempmon.models import PlaySession, DataPoint, PsGame, PsnApiKey
-from psnawp_api.utils.endpoints import BASE_PATH, API_PATH
+from tempmon.models import PlaySession, DataPoint, PsGame, PsnApiKey, QueuedPoint
+from tempmon.psn import PSN, login
 
 logger = logging.getLogger(__name__)
 
 
-class PSN:
-    def __init__(self, token):
-        self.psnawp = PSNAWP(token, accept_language='ja', country='JP')
-        logger.info('Logged into PSN')
-
-        self.client = self.psnawp.me()
-        self.me = self.psnawp.user(account_id=self.client.account_id)
-
-    def get_game_name_in_jp(self, title_id):
-        """The GameTitle.get_details hard code to US"""
-        game = self.psnawp.game_title(title_id=title_id,
-                                      account_id=self.client.account_id)
-        return self.psnawp._request_builder.get(
-            url=f"{BASE_PATH['game_titles']}"
-                f"{API_PATH['title_concept'].format(title_id=game.title_id)}",
-            params={"age": 99, "country": "JP", "language": "ja-JP"},
-        ).json()[0]['name']
-
-    def get_game_pk(self, title_id):
-        try:
-            ps_game = PsGame.objects.get(title_id=title_id)
-        except PsGame.DoesNotExist:
-            try:
-                ps_game = PsGame.objects.create(
-                    title_id=title_id, name=self.get_game_name_in_jp(title_id))
-            except PSNAWPNotFound:
-                ps_game = PsGame.objects.create(
-                    title_id=title_id, name='__UNKNOWN__')
-
-        return ps_game.pk
-
-    def get_current_game(self):
-        status = self.me.get_presence()['basicPresence']
-        if status['availability'] == 'unavailable':
-            return -1
-        else:
-            if status['primaryPlatformInfo']['onlineStatus'] == 'online':
-                try:
-                    title_id = status["gameTitleInfoList"][0]["npTitleId"]
-                    return self.get_game_pk(title_id)
-                except KeyError:
-                    return -1
-            else:
-                return -1
-
-
 # Global instance to avoid the overhead everytime this is called
 try:
-    if (token := PsnApiKey.objects.first().code) != '__dummy__':
-        psn = PSN(token)
-    else:
-        psn = None
-except PSNAWPAuthenticationError as e:
-    logger.error(f'Failed to login to PSN: {e}')
-    psn = None
+    psn = login(PsnApiKey.objects.first().code)
 except OperationalError as e:
     # This is just a bootstrap catch-up, should not happen
     logger.error(f'OperationalError: {e}')
@@ -111,18 +57,24 @@ class PsnApiKeyForm(BForm):
         return new_token
 
 
+def check_api_key(body):
+    if body.pop('API_KEY', None) != settings.TEMPMON_API_KEY:
+        logger.error('Received tempmon data with wrong API_KEY')
+        return False
+    return True
+
+
 @csrf_exempt
 def add_temp_point(request):
     try:
         logger.info(f'New add_temp_point request, body: {request.body}')
         body = json.loads(request.body)
 
-        if body.pop('API_KEY', None) != settings.TEMPMON_API_KEY:
-            logger.error('Received tempmon data with wrong API_KEY')
+        if not check_api_key(body):
             return JsonResponse({'result': f'Failure - wrong API_KEY'})
 
-        pt = DataPoint(**body)
-        PlaySession.add_point(pt, psn.get_current_game())
+        # Added to its session by the process_tempmon_queue command
+        QueuedPoint.enqueue([DataPoint(**body)])
 
         return JsonResponse({'result': 'OK'})
     except Exception as e:
@@ -130,6 +82,28 @@ def add_temp_point(request):
         return JsonResponse({'result': f'Failure: {e}'})
 
 
+@csrf_exempt
+def add_temp_points(request):
+    """
+    Batch of points, e.g. buffered by the sensor while offline: {"API_KEY": ..., "points": [{...}, ...]}
+    All the points are validated before any is queued, and they are queued in one insert.
+    """
+    try:
+        logger.info(f'New add_temp_points request, size: {len(request.body)}')
+        body = json.loads(request.body)
+
+        if not check_api_key(body):
+            return JsonResponse({'result': f'Failure - wrong API_KEY'})
+
+        pts = [DataPoint(**x) for x in body['points']]
+        QueuedPoint.enqueue(pts)
+
+        return JsonResponse({'result': 'OK', 'count': len(pts)})
+    except Exception as e:
+        logger.error(f'Failure to handle add_temp_points, error: {e}')
+        return JsonResponse({'result': f'Failure: {e}'})
+
+
 class FGenericMinMaxDurationMin(FFilter):
     def __init__(self, title, field):
         self.field = field
@@ -1,3 +1,6 @@
+from django.db.models.signals import post_delete, post_save
+
+
 class OrderFromAttr:
     """
     Class decorator adding rich comparison methods based on one attribute of the class
@@ -30,15 +33,52 @@ class QuickGetKey:
     Example: by adding the @QuickGetKey('reference') decorator to a Book Model, the following statements are equivalent:
         Book.objects.get(reference='ABC')       # Normal Django syntax
         Book.qget('ABC')
+
+    With cached=True, for small reference tables only: all the objects are loaded in memory at the first access and
+    qget / qget_pk / qall are served without database query. The cache is process-wide, shared by all the threads,
+    and dropped when an object of the model is saved or deleted (or with qclear). The cached instances are shared:
+    they must not be modified.
     """
-    def __init__(self, key_field):
+    def __init__(self, key_field, cached=False):
         self.key_field = key_field
+        self.cached = cached
 
     def __call__(self, decorated_class):
         def _qget(cls, key):
             return cls.objects.get(**{cls.key_field: key})
 
         decorated_class.key_field = self.key_field
-        decorated_class.qget = classmethod(_qget)
+        if not self.cached:
+            decorated_class.qget = classmethod(_qget)
+            return decorated_class
+
+        # (objects in the default ordering, {key: object}, {pk: object}), None until the first access
+        cache = [None]
+
+        def _load(cls):
+            data = cache[0]
+            if data is None:
+                objects = list(cls.objects.all())
+                data = (objects, {getattr(x, cls.key_field): x for x in objects}, {x.pk: x for x in objects})
+                cache[0] = data
+            return data
+
+        def _lookup(cls, index, value, lookup):
+            try:
+                return _load(cls)[index][value]
+            except (KeyError, TypeError):
+                raise cls.DoesNotExist(f'{cls.__name__} matching {lookup}={value!r} does not exist.') from None
+
+        def _qclear(*_args, **_kwargs):
+            cache[0] = None
+
+        decorated_class.qget = classmethod(lambda cls, key: _lookup(cls, 1, key, cls.key_field))
+        decorated_class.qget_pk = classmethod(lambda cls, pk: _lookup(cls, 2, pk, 'pk'))
+        decorated_class.qall = classmethod(lambda cls: list(_load(cls)[0]))
+        decorated_class.qclear = classmethod(_qclear)
+
+        uid = f'quick_get_key_{decorated_class.__module__}.{decorated_class.__qualname__}'
+        post_save.connect(_qclear, sender=decorated_class, weak=False, dispatch_uid=uid)
+        post_delete.connect(_qclear, sender=decorated_class, weak=False, dispatch_uid=uid)
 
         return decorated_class
@@ -0,0 +1,93 @@
+import hashlib
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+class KeysetPaginator(Paginator):
+    """
+    Drop-in replacement of Paginator for a queryset ordered on a single field, with the page number interface
+    unchanged:
+        - A page is fetched by seeking after the last row of the closest previous page already served
+          (WHERE (sort, pk) > (last sort, last pk)) instead of with an OFFSET growing with the page number.
+          The page boundaries are kept in the cache, so that browsing page after page never scans the skipped rows.
+        - The total count is cached, so it can be off by the rows added / deleted during cache_timeout seconds
+
+    The standard OFFSET pagination is used when the ordering is not supported: several fields, nullable field,
+    relation to a model with a default ordering, orphans.
+    """
+    cache_timeout = 60
+    cache_prefix = 'keyset_paginator'
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True):
+        self.sort_field, self.sort_attname, self.descending = self.get_sort_field(object_list)
+        if orphans:
+            self.sort_field = None
+        if self.sort_field:
+            # pk as tie-breaker, for a strict order
+            object_list = object_list.order_by(*object_list.query.order_by, '-pk' if self.descending else 'pk')
+        super().__init__(object_list, per_page, orphans, allow_empty_first_page)
+
+    @staticmethod
+    def get_sort_field(object_list):
+        """(field name, attribute holding the sort value, descending) or (None, None, False) if not supported"""
+        order_by = object_list.query.order_by
+        if len(order_by) != 1 or not isinstance(order_by[0], str):
+            return None, None, False
+        name = order_by[0].lstrip('-')
+        descending = order_by[0].startswith('-')
+        if name in object_list.query.annotations:
+            return name, name, descending
+
+        meta = getattr(object_list.model, '_meta')
+        try:
+            fld = meta.pk if name == 'pk' else meta.get_field(name)
+        except FieldDoesNotExist:
+            return None, None, False
+        if not fld.concrete or fld.null or (fld.is_relation and getattr(fld.related_model, '_meta').ordering):
+            return None, None, False
+        return name, fld.attname, descending
+
+    @cached_property
+    def cache_key(self):
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except EmptyResultSet:
+            return None
+        digest = hashlib.md5(f'{sql}|{params}|{self.per_page}'.encode()).hexdigest()
+        return f'{self.cache_prefix}:{digest}'
+
+    @cached_property
+    def count(self):
+        if self.cache_key is None:
+            return 0
+        return cache.get_or_set(f'{self.cache_key}:count', lambda: Paginator.count.func(self), self.cache_timeout)
+
+    def seek_filter(self, value, pk):
+        op = 'lt' if self.descending else 'gt'
+        return Q(**{f'{self.sort_field}__{op}': value}) | Q(**{self.sort_field: value, f'pk__{op}': pk})
+
+    def page(self, number):
+        if not self.sort_field or self.cache_key is None:
+            return super().page(number)
+
+        number = self.validate_number(number)
+        bounds_key = f'{self.cache_key}:bounds'
+        # {page number: (sort value, pk) of the last row of the page}
+        bounds = cache.get(bounds_key, {})
+        previous = max((x for x in bounds if x < number), default=None)
+        if previous is None:
+            object_list = self.object_list
+            offset = (number - 1) * self.per_page
+        else:
+            object_list = self.object_list.filter(self.seek_filter(*bounds[previous]))
+            offset = (number - previous - 1) * self.per_page
+
+        rows = list(object_list[offset:offset + self.per_page])
+        if rows:
+            bounds[number] = (getattr(rows[-1], self.sort_attname), rows[-1].pk)
+            cache.set(bounds_key, bounds, self.cache_timeout)
+        return self._get_page(rows, number, self)
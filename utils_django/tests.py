@@ -10,7 +10,10 @@ from pathlib import Path
 from unittest.mock import patch
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
+from django.core.paginator import Paginator
+from django.db.models import Count
 from django.test import SimpleTestCase, override_settings, TestCase
 from freezegun import freeze_time
 from pyfakefs.fake_filesystem_unittest import TestCaseMixin
@@ -20,6 +23,7 @@ from utils_django.decorators import OrderFromAttr
 from utils_django.logging_ext import PerRunFileHandler
 from utils_django.management_command import FBaseCommand
 from utils_django.models import ManagementCommandRun
+from utils_django.paginator import KeysetPaginator
 
 
 class TestUtilsDjangoApps(TestCase):
@@ -405,3 +409,61 @@ class TestClearCmdLock(TestCase):
         self.assertTrue(ManagementCommandRun.objects.exists())
         call_command('clear_cmd_lock')
         self.assertFalse(ManagementCommandRun.objects.exists())
+
+
+class TestKeysetPaginator(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Many duplicates of the sort value, to check the pk tie-breaker
+        ManagementCommandRun.objects.bulk_create(
+            [ManagementCommandRun(cmd_name=f'cmd_{i % 7}', cmd_pid=i % 5) for i in range(47)])
+
+    @staticmethod
+    def get_pages(paginator, numbers):
+        return [[x.pk for x in paginator.page(n)] for n in numbers]
+
+    def assertSamePages(self, qry, numbers):
+        tie_breaker = '-pk' if qry.query.order_by[0].startswith('-') else 'pk'
+        expected = Paginator(qry.order_by(*qry.query.order_by, tie_breaker), 10)
+        self.assertEqual(self.get_pages(expected, numbers), self.get_pages(KeysetPaginator(qry, 10), numbers))
+
+    def test_pages(self):
+        for order in ['cmd_pid', '-cmd_pid', 'cmd_name', '-pk']:
+            with self.subTest(order=order):
+                cache.clear()
+                qry = ManagementCommandRun.objects.order_by(order)
+                # Sequential pages seek from the previous boundary, jumps use an offset from the closest one
+                self.assertSamePages(qry, [1, 2, 3, 5, 4, 1])
+                self.assertSamePages(qry.filter(cmd_pid__gt=1), [1, 2, 3, 2])
+
+    def test_annotation(self):
+        qry = ManagementCommandRun.objects.annotate(nb=Count('cmd_name')).order_by('-nb')
+        self.assertEqual('nb', KeysetPaginator(qry, 10).sort_field)
+        self.assertSamePages(qry, [1, 2, 3])
+
+    def test_seek(self):
+        qry = ManagementCommandRun.objects.order_by('cmd_pid')
+        paginator = KeysetPaginator(qry, 10)
+        self.get_pages(paginator, [1, 2])
+        with self.assertNumQueries(1) as queries:
+            page = paginator.page(3)
+        self.assertNotIn('OFFSET', queries.captured_queries[0]['sql'])
+        self.assertEqual(7, len(KeysetPaginator(qry, 10).page(5)))
+
+    def test_cached_count(self):
+        qry = ManagementCommandRun.objects.order_by('cmd_pid')
+        self.assertEqual(47, KeysetPaginator(qry, 10).count)
+        ManagementCommandRun.objects.create(cmd_name='cmd', cmd_pid=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(47, KeysetPaginator(qry, 10).count)
+        self.assertEqual(48, KeysetPaginator(qry.filter(cmd_pid__gte=0), 10).count)
+
+    def test_not_supported(self):
+        for qry in [ManagementCommandRun.objects.order_by('cmd_pid', 'cmd_name'),
+                    ManagementCommandRun.objects.order_by('?'),
+                    ManagementCommandRun.objects.all()]:
+            with self.subTest(order=qry.query.order_by):
+                self.assertIsNone(KeysetPaginator(qry, 10).sort_field)
+        qry = ManagementCommandRun.objects.order_by('cmd_pid', 'cmd_name')
+        self.assertEqual(self.get_pages(Paginator(qry, 10), [1, 3]), self.get_pages(KeysetPaginator(qry, 10), [1, 3]))
+        self.assertEqual(0, KeysetPaginator(ManagementCommandRun.objects.filter(pk__in=[]).order_by('pk'), 10).count)
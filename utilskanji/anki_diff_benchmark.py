@@ -0,0 +1,124 @@
+"""
+AnkiProfile.delete_missing_notes: legacy per-deck merge (import file, Anki export and notes table read for each deck),
+against the single pass over all the decks, on a synthetic collection.
+
+Run from the project root:
+    python -m utilskanji.anki_diff_benchmark --notes 100000
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kukansite.settings')
+
+from kukan.anki_dj import AnkiProfile  # noqa: E402
+
+
+class FakeCollection:
+    """Notes table and note removal of an Anki collection"""
+    def __init__(self, notes):
+        self.notes = notes
+        self.queries = 0
+        self.removed = []
+        self.db = self
+
+    def all(self, sql):
+        self.queries += 1
+        return self.notes
+
+    def remove_notes(self, note_ids):
+        self.removed.extend(note_ids)
+
+    def close(self):
+        pass
+
+
+def legacy_delete_missing_notes(profile, deck, df_anki_export_all):
+    """Same merge as AnkiProfile.delete_missing_notes before the single pass, for one deck"""
+    file_name = profile.get_deck_import_file(deck)
+    df_anki_export = df_anki_export_all[df_anki_export_all.iloc[:, 2] == deck.name]
+
+    df_web_side = profile.read_anki_csv(file_name)
+    df_web_side[2] = df_web_side[2].astype(str)
+    df_web_side.columns = [1, 2, 3]
+    assert not df_web_side.duplicated().any()
+
+    df_merge = pd.merge(df_anki_export.set_index([1, 2, 3]), df_web_side.set_index([1, 2, 3]),
+                        left_index=True, right_index=True, how='outer', indicator=True)
+    df_merge.columns = ['GUID', '_merge']
+    assert df_merge[df_merge['_merge'] == 'right_only'].empty
+
+    df_ids = pd.DataFrame(profile.col.db.all('select guid, id from notes'), columns=['GUID', 'ID'])
+    list_to_delete = pd.merge(df_ids, df_merge[df_merge['_merge'] == 'left_only'])['ID'].to_list()
+    return profile.remove_notes(list_to_delete)
+
+
+def make_collection(rnd, profile, nb_notes, deleted_ratio, import_dir):
+    """Import file of each deck and Anki export: the notes of the export missing from the import files are deleted"""
+    decks = profile.profile['decks']
+    export_rows, web_rows, notes = [], {deck.name: [] for deck in decks}, []
+    for i in range(nb_notes):
+        deck = decks[i % len(decks)]
+        # Keys: pk for the examples, yoji for the yoji deck
+        key = f'{i:06d}字' if deck.model == 'Cloze Yoji' else str(i)
+        guid = f'g{i}'
+        export_rows.append([guid, deck.model, deck.name, key])
+        notes.append((guid, i))
+        if rnd.random() >= deleted_ratio:
+            web_rows[deck.name].append([deck.model, deck.name, key])
+
+    def write(file_name, rows, header):
+        with open(file_name, 'w', newline='', encoding='utf-8') as f:
+            f.write('\n'.join(header) + '\n')
+            csv.writer(f, delimiter='\t').writerows(rows)
+
+    header = ['#separator:tab', '#html:true']
+    for deck in decks:
+        write(os.path.join(import_dir, deck.file_name), web_rows[deck.name],
+              header + ['#notetype column:1', '#deck column:2'])
+    export_file = os.path.join(import_dir, 'anki_export.csv')
+    write(export_file, export_rows, header + ['#guid column:1', '#notetype column:2', '#deck column:3'])
+    return AnkiProfile.read_anki_csv(export_file, True), notes
+
+
+def measure(fn):
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notes', type=int, default=100000, help='Number of notes of the collection')
+    parser.add_argument('--deleted', type=float, default=0.001, help='Ratio of notes deleted from the web')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as import_dir:
+        profile = AnkiProfile(next(iter(AnkiProfile.profile_list())), max_delete_count=args.notes,
+                              import_dir=import_dir)
+        df_anki_export_all, notes = make_collection(rnd, profile, args.notes, args.deleted, import_dir)
+
+        profile.col = FakeCollection(notes)
+        legacy_ms, legacy_res = measure(lambda: {deck.name: legacy_delete_missing_notes(profile, deck,
+                                                                                        df_anki_export_all)
+                                                 for deck in profile.profile['decks']})
+        legacy_removed, legacy_queries = sorted(profile.col.removed), profile.col.queries
+
+        profile.col = FakeCollection(notes)
+        single_ms, single_res = measure(lambda: profile.delete_missing_notes(df_anki_export_all))
+        assert legacy_res == single_res and legacy_removed == sorted(profile.col.removed)
+
+    print(f'{args.notes} notes, {len(legacy_removed)} deleted, {len(profile.profile["decks"])} decks')
+    print(f'{"":<14}{"time (ms)":>12}{"notes queries":>16}')
+    print(f'{"legacy":<14}{legacy_ms:>12.1f}{legacy_queries:>16}')
+    print(f'{"single pass":<14}{single_ms:>12.1f}{profile.col.queries:>16}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Per-call latency of the furigana parsing (JpnText) and of the ja_tags template filters, on a synthetic corpus of
+sentences, comparing the compiled patterns of kukan.jautils with the previous string patterns (LegacyJpnText).
+
+Run from the project root:
+    python -m utilskanji.furigana_benchmark --sentences 10000
+"""
+import argparse
+import os
+import random
+import re
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kukansite.settings')
+
+from kukan.jautils import JpnText, kat2hir, katakana_chart  # noqa: E402
+from kukan.templatetags.ja_tags import furigana_ruby, furigana_remove, furigana_bracket  # noqa: E402
+
+FRAGMENTS = [
+    '[部屋|へや|f]から町を[俯瞰|ふかん|f]する',
+    'ご[飯|はん|f]に[差し支|さしつか|f]えない[様|よう|f]に',
+    '[破鏡|はきょう|f][再|ふたた|f]び[照|て|f]らさず',
+    'しくじるは[稽古|けいこ|f]のため。',
+    '膨大な資料を閲覧する',
+    '[一竿|いっかん|f]の[風月|ふうげつ|f]',
+    'お[試|ため|f]し',
+]
+
+
+class LegacyJpnText(JpnText):
+    """JpnText parsing as it was before the compiled patterns"""
+
+    class TextToken(JpnText.TextToken):
+        @classmethod
+        def get_sub_token(cls, origin, furigana_raw):
+            token_list = []
+            furigana = furigana_raw.translate(kat2hir)
+
+            sentinel_text = 'sentinel'
+            kanji_pattern = '[一-龥]'
+            if re.search(kanji_pattern, origin):
+                split_token = re.split(u'({}+)'.format(kanji_pattern), '{0}{1}{0}'.format(sentinel_text, origin))
+
+                pre_kanji = split_token[0][len(sentinel_text):] if split_token[0] != sentinel_text else ''
+                post_kanji = split_token[-1][:-len(sentinel_text)] if split_token[-1] != sentinel_text else ''
+
+                kanji = origin[len(pre_kanji):-len(post_kanji) or None]
+                kana = furigana[len(pre_kanji):-len(post_kanji) or None]
+
+                if not all([furigana.startswith(pre_kanji.translate(kat2hir)),
+                            furigana.endswith(post_kanji.translate(kat2hir)),
+                            kanji, kana]):
+                    raise ValueError('origin [{}] does not match furigana [{}]'.format(origin, furigana))
+
+                if pre_kanji:
+                    token_list.append(cls(pre_kanji))
+                token_list.append(cls(kanji, kana))
+                if post_kanji:
+                    token_list.append(cls(post_kanji))
+            else:
+                if origin.translate(kat2hir) != furigana and origin not in katakana_chart:
+                    raise ValueError('origin [{}] does not match furigana [{}]'.format(origin, furigana))
+                token_list = [cls(origin)]
+
+            return token_list
+
+    @classmethod
+    def from_ruby(cls, text):
+        token_list = []
+        pattern_all = r'(<ruby>.+?</ruby>)'
+        pattern_sub = r'<ruby>(.+?)<rt>(.*?)</rt></ruby>'
+        for item in re.split(pattern_all, text):
+            if not item:
+                pass
+            elif item[:6] == '<ruby>' and item[-7:] == '</ruby>':
+                match_obj = re.match(pattern_sub, item)
+                token_list.extend(cls.TextToken.get_sub_token(match_obj[1], match_obj[2]))
+            else:
+                token_list.append(cls.TextToken(item))
+        return cls(text, token_list=token_list)
+
+    @classmethod
+    def from_furigana_format(cls, furigana_format, text=None, expected_yomi=None):
+        token_list = []
+        pattern_all = r'(\[.+?\|.+?\|f\])'
+        pattern_sub = r'\[(.+?)\|(.+?)\|f\]'
+        for item in re.split(pattern_all, furigana_format):
+            if not item:
+                pass
+            elif item[:1] == '[' and item[-1:] == ']':
+                match_obj = re.match(pattern_sub, item)
+                token_list.extend(cls.TextToken.get_sub_token(match_obj[1], match_obj[2]))
+            else:
+                token_list.append(cls.TextToken(item))
+        return cls(text, token_list=token_list, expected_yomi=expected_yomi)
+
+
+def legacy_furigana_ruby(sentence):
+    return re.sub(r'\[(.*?)\|(.*?)\|f\]', '<ruby>{}<rt>{}</rt></ruby>'.format(r'\1', r'\2'), sentence)
+
+
+def legacy_furigana_remove(sentence):
+    return re.sub(r'\[(.*?)\|(.*?)\|f\]', '{}'.format(r'\1'), sentence)
+
+
+def legacy_furigana_bracket(sentence):
+    return re.sub(r'\[(.*?)\|(.*?)\|f\]', '{}({})'.format(r'\1', r'\2'), sentence)
+
+
+def make_corpus(nb_sentences, seed=0):
+    rnd = random.Random(seed)
+    return [''.join(rnd.choices(FRAGMENTS, k=rnd.randint(1, 3))) for _ in range(nb_sentences)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sentences', type=int, default=10000, help='Size of the corpus')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of n runs')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.sentences)
+    ruby_corpus = [furigana_ruby(s) for s in corpus]
+    sub_tokens = [(m[1], m[2]) for s in corpus for m in re.finditer(r'\[(.+?)\|(.+?)\|f\]', s)]
+
+    cases = [
+        ('from_furigana_format', corpus,
+         lambda s: LegacyJpnText.from_furigana_format(s), lambda s: JpnText.from_furigana_format(s)),
+        ('from_ruby', ruby_corpus, lambda s: LegacyJpnText.from_ruby(s), lambda s: JpnText.from_ruby(s)),
+        ('get_sub_token', sub_tokens, lambda t: LegacyJpnText.TextToken.get_sub_token(*t),
+         lambda t: JpnText.TextToken.get_sub_token(*t)),
+        ('furigana_ruby', corpus, legacy_furigana_ruby, furigana_ruby),
+        ('furigana_remove', corpus, legacy_furigana_remove, furigana_remove),
+        ('furigana_bracket', corpus, legacy_furigana_bracket, furigana_bracket),
+    ]
+
+    print(f'{args.sentences} sentences, per-call latency in µs (best of {args.repeat})')
+    print(f'{"":<22}{"legacy":>10}{"compiled":>10}{"speedup":>10}')
+    for name, items, legacy_fn, new_fn in cases:
+        res = []
+        for fn in [legacy_fn, new_fn]:
+            total = min(timeit.repeat(lambda: [fn(x) for x in items], number=1, repeat=args.repeat))
+            res.append(total / len(items) * 1e6)
+        print(f'{name:<22}{res[0]:>10.2f}{res[1]:>10.2f}{res[0] / res[1]:>9.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Throughput of the resident tokenizer: legacy daemon (one connection per request, served sequentially) against
+TokenizerServer used through the TokenizerConnectionPool, one text per request and in batches.
+
+Run from the project root:
+    python -m utilskanji.janome_benchmark --clients 8 --requests 200
+"""
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kukansite.settings')
+
+from kukan.jautils import TokenizerConnectionPool  # noqa: E402
+from utilskanji.janome_daemon import TokenizerServer  # noqa: E402
+
+AUTHKEY = b'benchmark'
+SENTENCES = [
+    '身体は芭蕉の如し、風に従って破れ易し。',
+    'ご飯に差し支えない様に',
+    '膨大な資料を閲覧する',
+    '部屋から町を俯瞰する',
+    '恩師の斌斌たる人柄が偲ばれる',
+    'しくじるは稽古のため。',
+    '破鏡再び照らさず',
+    '一竿の風月',
+]
+
+
+def run_legacy_server(port, ready):
+    """Same loop as the daemon before the pooled TokenizerServer"""
+    from janome.tokenizer import Tokenizer
+    tokenizer = Tokenizer()
+    with Listener(('localhost', port), authkey=AUTHKEY) as listener:
+        ready.set()
+        while True:
+            with listener.accept() as conn:
+                args = conn.recv()
+                if args == b'stop server':
+                    break
+                conn.send([(t.surface, t.reading) for t in tokenizer.tokenize(args[0])])
+
+
+def run_pooled_server(port, ready):
+    TokenizerServer(('localhost', port), AUTHKEY).serve_forever(ready)
+
+
+def legacy_client(port, texts):
+    for text in texts:
+        with Client(('localhost', port), authkey=AUTHKEY) as conn:
+            conn.send([text])
+            conn.recv()
+
+
+def pooled_client(pool, texts, batch_size):
+    for i in range(0, len(texts), batch_size):
+        pool.request(('batch', texts[i:i + batch_size]))
+
+
+def measure(nb_clients, nb_requests, client_fn, *args):
+    texts = [SENTENCES[i % len(SENTENCES)] for i in range(nb_requests)]
+    threads = [threading.Thread(target=client_fn, args=(*args, texts)) for _ in range(nb_clients)]
+    start = time.perf_counter()
+    list(map(threading.Thread.start, threads))
+    list(map(threading.Thread.join, threads))
+    elapsed = time.perf_counter() - start
+    return nb_clients * nb_requests / elapsed, elapsed
+
+
+def start_server(target, port):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=target, args=(port, ready), daemon=True)
+    process.start()
+    ready.wait(60)
+    return process
+
+
+def stop_server(port, process):
+    with Client(('localhost', port), authkey=AUTHKEY) as conn:
+        conn.send(b'stop server')
+    process.join(10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent client threads')
+    parser.add_argument('--requests', type=int, default=200, help='Number of texts tokenized per client')
+    parser.add_argument('--batch', type=int, default=20, help='Batch size for the batch mode')
+    parser.add_argument('--port', type=int, default=50123)
+    args = parser.parse_args()
+
+    results = []
+    process = start_server(run_legacy_server, args.port)
+    results.append(('legacy daemon', *measure(args.clients, args.requests,
+                                              lambda texts: legacy_client(args.port, texts))))
+    stop_server(args.port, process)
+
+    port = args.port + 1
+    process = start_server(run_pooled_server, port)
+    pool = TokenizerConnectionPool(('localhost', port), AUTHKEY, max_size=args.clients)
+    results.append(('pooled, 1 text/request', *measure(args.clients, args.requests,
+                                                       lambda texts: pooled_client(pool, texts, 1))))
+    results.append((f'pooled, {args.batch} texts/request', *measure(args.clients, args.requests,
+                                                                    lambda texts: pooled_client(pool, texts,
+                                                                                                args.batch))))
+    pool.close()
+    stop_server(port, process)
+
+    print(f'{args.clients} clients x {args.requests} texts')
+    for name, throughput, elapsed in results:
+        print(f'{name:<28}{throughput:>10.0f} texts/s {elapsed:>8.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,88 @@
-from multiprocessing.connection import Listener
-from janome.tokenizer import Tokenizer
+"""
+Resident Janome tokenizer, shared by all the Apache workers (see JpnText.LightTokenizer)
+
+Each client connection is served by its own thread and stays open until the client closes it, so that the
+connect / authentication handshake is only paid once per pooled connection. Supported requests:
+    ('batch', [text, ...])  -> [[(surface, reading), ...], ...], one token list per text
+    b'stop server'          -> stop the daemon
+A failed request is answered by b'Error: <message>'.
+"""
 import sys
-sys.path.extend([r'/home/fred/kukan/kukansite'])
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from janome.tokenizer import Tokenizer
+
+
+class TokenizerServer:
+    def __init__(self, address, authkey, tokenizer=None):
+        self.address = address
+        self.authkey = authkey
+        self.tokenizer = tokenizer or Tokenizer()
+        # Janome does not document its Tokenizer as thread safe
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def tokenize_batch(self, texts):
+        with self._lock:
+            return [[(t.surface, t.reading) for t in self.tokenizer.tokenize(text)] for text in texts]
+
+    def handle_request(self, args):
+        # Very basic check, must be more secure in production
+        if isinstance(args, tuple) and len(args) == 2 and args[0] == 'batch' and isinstance(args[1], list):
+            try:
+                return self.tokenize_batch(args[1])
+            except Exception as e:
+                return f'Error: {e!r}'.encode()
+        return b'Error: invalid request'
+
+    def serve_connection(self, conn):
+        with conn:
+            while not self._stop.is_set():
+                try:
+                    args = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                if args == b'stop server':
+                    print('Goodnight')
+                    self.stop()
+                    break
+                try:
+                    conn.send(self.handle_request(args))
+                except (EOFError, OSError):
+                    break
+
+    def stop(self):
+        self._stop.set()
+        # Wake up the accept() of the main loop
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
 
-import settings_prod as settings
+    def serve_forever(self, ready=None):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            # Actual address, in case port 0 was requested
+            self.address = listener.address
+            if ready:
+                ready.set()
+            while not self._stop.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    # Failed authentication, or client gone during the handshake
+                    continue
+                if self._stop.is_set():
+                    conn.close()
+                    break
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
 
-tokenizer = Tokenizer()
 
+if __name__ == '__main__':
+    sys.path.extend([r'/home/fred/kukan/kukansite'])
 
-with Listener(('localhost', settings.JANOME_PORT), authkey=settings.JANOME_KEY) as listener:
-    # Looping here so that the clients / party goers can
-    # always come back for more than a single request
-    while True:
-        with listener.accept() as conn:
-            args = conn.recv()
+    import settings_prod as settings
 
-            if args == b'stop server':
-                print('Goodnight')
-                break
-            elif isinstance(args, list):
-                # Very basic check, must be more secure in production
-                conn.send(tokenizer.tokenize(args[0]))
-            else:
-                conn.send(b'Error')
+    TokenizerServer(('localhost', settings.JANOME_PORT), settings.JANOME_KEY).serve_forever()
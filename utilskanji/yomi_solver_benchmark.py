@@ -0,0 +1,69 @@
+"""
+Example.find_yomi_pk: legacy scan of itertools.product over the readings of each kanji, against the pruned search
+of jautils.find_reading_combinations, on synthetic yoji / jukugo with many readings per kanji.
+
+Run from the project root:
+    python -m utilskanji.yomi_solver_benchmark --words 10
+"""
+import argparse
+import itertools as it
+import os
+import random
+import re
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kukansite.settings')
+
+from kukan.jautils import find_reading_combinations, katakana_chart  # noqa: E402
+
+# Most kana of the chart, without the small ones and the iteration marks
+KANA = katakana_chart[10:80]
+
+
+def legacy_find(candidates, yomi):
+    """Same loop as Example.find_yomi_pk before the pruned search"""
+    for candidate in it.product(*candidates):
+        if ''.join([re.sub('[（）]', '', r) for _, r in candidate]) == yomi:
+            return [key for key, _ in candidate]
+    return []
+
+
+def make_word(rnd, nb_kanji, nb_readings):
+    """Readings of each kanji (some sharing prefixes, as on'yomi do) and the yomi of a random choice of them"""
+    candidates = []
+    for pos in range(nb_kanji):
+        stem = ''.join(rnd.choices(KANA, k=1))
+        readings = {stem + ''.join(rnd.choices(KANA, k=rnd.randint(0, 2))) for _ in range(nb_readings)}
+        readings |= {''.join(rnd.choices(KANA, k=rnd.randint(1, 3))) for _ in range(nb_readings // 2)}
+        candidates.append([(f'{pos}-{i}', r) for i, r in enumerate(sorted(readings))])
+    # The last reading of each kanji: worst case for the product order
+    yomi = ''.join(x[-1][1] for x in candidates)
+    return candidates, yomi
+
+
+def measure(fn, words):
+    start = time.perf_counter()
+    results = [fn(candidates, yomi) for candidates, yomi in words]
+    return (time.perf_counter() - start) / len(words) * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--words', type=int, default=10, help='Number of words per case')
+    parser.add_argument('--readings', type=int, default=12, help='Readings per kanji')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    print(f'{args.readings} readings per kanji, average time per word in ms')
+    print(f'{"":<22}{"legacy":>12}{"pruned":>12}{"all (pruned)":>14}')
+    for name, nb_kanji in [('2 kanji jukugo', 2), ('3 kanji jukugo', 3), ('4 kanji yoji', 4), ('5 kanji jukugo', 5)]:
+        words = [make_word(rnd, nb_kanji, args.readings) for _ in range(args.words)]
+        legacy_ms, legacy_res = measure(legacy_find, words)
+        pruned_ms, pruned_res = measure(lambda c, y: (find_reading_combinations(c, y) or [[]])[0], words)
+        all_ms, _ = measure(lambda c, y: find_reading_combinations(c, y, find_all=True), words)
+        assert legacy_res == pruned_res
+        print(f'{name:<22}{legacy_ms:>12.3f}{pruned_ms:>12.3f}{all_ms:>14.3f}')
+
+
+if __name__ == '__main__':
+    main()